@@ -0,0 +1,21 @@
+# app/agents/base_tool.py
+import logging
+
+# --- PydenticAI Hypothetical Structure ---
+# This is based on common patterns in libraries like LangChain.
+# Actual PydenticAI imports and base classes might differ.
+# All tools import BaseTool from here, so the fallback is defined (and warned about) once.
+try:
+    from pydenticai.core.tool import BaseTool # Attempting a plausible import
+except ImportError:
+    logger_dummy = logging.getLogger(__name__ + ".dummy_tool")
+    logger_dummy.warning("PydenticAI BaseTool not found. Using a dummy BaseTool for the agent tools.")
+    class BaseTool: # Dummy BaseTool
+        name: str = "UnnamedTool"
+        description: str = "This is a dummy tool."
+        input_schema = None
+        def __init__(self, *args, **kwargs): # Accept any args for dummy
+            pass
+        async def _execute(self, *args, **kwargs): # Dummy execute
+            raise NotImplementedError("Dummy _execute called.")
+# --- End PydenticAI Hypothetical Structure ---
@@ -1,31 +1,25 @@
 # app/agents/challenge_tool.py
 import logging
-from app.services.gemini_service import GeminiService
+from typing import Optional
+from app.services.gemini_service import GeminiService, GeminiServiceError, get_gemini_service
+from app.agents.base_tool import BaseTool
 
-# --- PydenticAI Hypothetical Structure ---
-# This is based on common patterns in libraries like LangChain.
-# Actual PydenticAI imports and base classes might differ.
-# from pydantic import BaseModel, Field # If using Pydantic for schemas
-# from some_pydenticai_module import BaseTool # Hypothetical base tool
 
-# For the purpose of this exercise, let's define a dummy BaseTool
-# if the actual PydenticAI library isn't available in the environment.
-try:
-    from pydenticai.core.tool import BaseTool # Attempting a plausible import
-except ImportError:
-    logger = logging.getLogger(__name__)
-    logger.warning("PydenticAI BaseTool not found. Using a dummy BaseTool for ChallengeGenerationTool.")
-    class BaseTool: # Dummy BaseTool
-        name: str = "UnnamedTool"
-        description: str = "This is a dummy tool."
-        def __init__(self, *args, **kwargs): # Accept any args for dummy
-            pass
-        def _execute(self, *args, **kwargs): # Dummy execute
-            raise NotImplementedError("Dummy _execute called.")
-# --- End PydenticAI Hypothetical Structure ---
+logger = logging.getLogger(__name__)
 
+_CHALLENGE_PROMPT = (
+    "אתה מנחה משחק אתגרים יצירתי ומהנה. משימתך היא ליצור אתגר עבור המשתמש. "
+    "האתגר צריך להיות מיועד לאדם אחד, לדרוש חשיבה יצירתית ולהשתמש בחפצים נפוצים הנמצאים בדרך כלל בבית. "
+    "ההוראות באתגר חייבות להיות ברורות לחלוטין, ולהסביר בדיוק מה על המשתתף ליצור או לעשות כך שיוכל לצלם תמונה ולהוכיח עמידה באתגר. "
+    "האתגר צריך להיות פשוט לביצוע מעשי, אך מעניין ומפעיל את הדמיון. "
+    "נסח את האתגר בשפה העברית, באורך של שורה אחת עד שתי שורות קצרות."
+)
 
-logger = logging.getLogger(__name__)
+# Fixed replies returned instead of a challenge. They are the only failure results of
+# _execute, so callers can detect failure by membership instead of scanning the text.
+CHALLENGE_UNAVAILABLE_MESSAGE = "מצטער, היתה בעיה ביצירת האתגר כרגע. נסה שוב מאוחר יותר."
+CHALLENGE_INTERNAL_ERROR_MESSAGE = "שגיאה פנימית בעת יצירת אתגר."
+CHALLENGE_FAILURE_MESSAGES = frozenset({CHALLENGE_UNAVAILABLE_MESSAGE, CHALLENGE_INTERNAL_ERROR_MESSAGE})
 
 class ChallengeGenerationTool(BaseTool):
     """
@@ -38,16 +32,11 @@ class ChallengeGenerationTool(BaseTool):
     #     trigger: bool = Field(default=True, description="A dummy trigger field if schema is required.")
 
 
-    def __init__(self, gemini_service: GeminiService, **kwargs): # Added **kwargs for BaseTool flexibility
+    def __init__(self, gemini_service: Optional[GeminiService] = None, **kwargs): # Added **kwargs for BaseTool flexibility
         super().__init__(**kwargs) # Pass any extra args to BaseTool
+        # None means the shared service from get_gemini_service(), resolved on first use.
         self.gemini_service = gemini_service
-        self.challenge_prompt_template = (
-            "אתה מנחה משחק אתגרים יצירתי ומהנה. משימתך היא ליצור אתגר עבור המשתמש. "
-            "האתגר צריך להיות מיועד לאדם אחד, לדרוש חשיבה יצירתית ולהשתמש בחפצים נפוצים הנמצאים בדרך כלל בבית. "
-            "ההוראות באתגר חייבות להיות ברורות לחלוטין, ולהסביר בדיוק מה על המשתתף ליצור או לעשות כך שיוכל לצלם תמונה ולהוכיח עמידה באתגר. "
-            "האתגר צריך להיות פשוט לביצוע מעשי, אך מעניין ומפעיל את הדמיון. "
-            "נסח את האתגר בשפה העברית, באורך של שורה אחת עד שתי שורות קצרות."
-        )
+        self.challenge_prompt_template = _CHALLENGE_PROMPT
         logger.info(f"ChallengeGenerationTool '{self.name}' initialized.")
 
     # Assuming PydenticAI calls an '_execute' method.
@@ -59,18 +48,20 @@ class ChallengeGenerationTool(BaseTool):
         Returns:
             str: The generated challenge topic, or an error message.
         """
-        logger.info(f"Executing {self.name} tool.")
+        logger.info("Executing %s tool.", self.name)
         try:
-            topic = await self.gemini_service.generate_text(prompt=self.challenge_prompt_template) # Await async call
-            if not topic or "Placeholder response" in topic or "Error:" in topic: 
-                logger.warning(f"Challenge generation via GeminiService returned a non-ideal response: {topic}")
-                # Fallback or more specific error based on GeminiService's actual error reporting
-                return "מצטער, היתה בעיה ביצירת האתגר כרגע. נסה שוב מאוחר יותר."
-            logger.info(f"Challenge generated: {topic}")
+            if self.gemini_service is None:
+                self.gemini_service = await get_gemini_service()
+            topic = await self.gemini_service.generate(self.challenge_prompt_template) # Await async call
+            logger.info("Challenge generated: %s", topic)
             return topic
+        except GeminiServiceError as e:
+            logger.warning(f"Challenge generation via GeminiService failed: {e}")
+            return CHALLENGE_UNAVAILABLE_MESSAGE
         except Exception as e:
-            logger.error(f"Error in {self.name}: {e}", exc_info=True)
-            return "שגיאה פנימית בעת יצירת אתגר."
+            # Full tracebacks only at DEBUG level; formatting them on every failure is costly.
+            logger.error("Error in %s: %s", self.name, e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            return CHALLENGE_INTERNAL_ERROR_MESSAGE
 
 if __name__ == '__main__':
     import asyncio
@@ -94,8 +85,8 @@ async def main_challenge_tool_test(): # Renamed and made async
         logger.warning("ChallengeGenerationTool test will use a DummyGeminiService.")
         
         class DummyGeminiService:
-            async def generate_text(self, prompt: str): # Made async
-                logger.info(f"DummyGeminiService.generate_text called with prompt: {prompt[:30]}...")
+            async def generate(self, prompt: str): # Made async
+                logger.info(f"DummyGeminiService.generate called with prompt: {prompt[:30]}...")
                 await asyncio.sleep(0) # Simulate async
                 if "אתגר" in prompt: 
                     return "אתגר לדוגמה מהשירות הדמה: צור כובע מנייר."
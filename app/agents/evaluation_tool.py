@@ -1,33 +1,85 @@
 # app/agents/evaluation_tool.py
+import io
 import logging
-from app.services.gemini_service import GeminiService
+from typing import Any, Dict, Optional
+from PIL import Image
+from app.services.gemini_service import GeminiService, GeminiServiceError, get_gemini_service
+from app.services.llm_cache import cached_generate
 import asyncio # Added for async operations
 
-# --- PydenticAI Hypothetical Structure ---
 from pydantic import BaseModel, Field 
-
-try:
-    from pydenticai.core.tool import BaseTool 
-except ImportError:
-    logger_dummy_eval = logging.getLogger(__name__ + ".dummy_eval") # Unique logger name
-    logger_dummy_eval.warning("PydenticAI BaseTool not found. Using a dummy BaseTool for EvaluationTool.")
-    class BaseTool: 
-        name: str = "UnnamedTool"
-        description: str = "This is a dummy tool."
-        input_schema = None 
-        def __init__(self, *args, **kwargs):
-            pass
-        async def _execute(self, *args, **kwargs): # Made async
-            raise NotImplementedError("Dummy _execute called.")
-# --- End PydenticAI Hypothetical Structure ---
+from app.agents.base_tool import BaseTool
 
 logger = logging.getLogger(__name__)
 
+# Opening of both evaluation prompts: the judge's role and the challenge.
+_EVAL_PROMPT_HEADER = (
+    "אתה שופט מומחה וחסר פניות במשחק אתגר תמונות. תפקידך להעריך שתי הגשות לאתגר נתון.\n"
+    "בהתחשב באתגר: '{topic}'.\n"
+)
+
+# Scoring instructions and output format, shared by the caption and the image prompts so the
+# two judging paths cannot drift apart.
+_EVAL_RUBRIC = (
+    "עבור כל תמונה, אנא ספק ציון מ-1 עד 10 המייצג את מידת ההצלחה בביצוע האתגר. שקול יצירתיות, בהירות ועד כמה התמונה מייצגת חזותית את הפתרון לאתגר.\n"
+    "לאחר מכן, הכרז על התמונה הזוכה (תמונה 1 או תמונה 2).\n"
+    "לבסוף, ספק הסבר קצר וקולע (עד שתי שורות) מדוע התמונה הזו נבחרה כמנצחת, תוך התמקדות בסיבה המרכזית להחלטה. היה אובייקטיבי וברור.\n\n"
+    "הפלט הרצוי בעברית ובפורמט הבא:\n"
+    "תמונה 1 - ציון: [הציון כאן]/10\n"
+    "תמונה 2 - ציון: [הציון כאן]/10\n"
+    "התמונה הזוכה היא: תמונה [1/2]\n"
+    "הסבר קצר לזכייה: [ההסבר הקצר כאן]"
+)
+
+_EVAL_PROMPT_TEMPLATE = _EVAL_PROMPT_HEADER + (
+    "להלן תיאורים של שתי תמונות שהוגשו כפתרונות לאתגר (התיאורים נוצרו על ידי AI אחר ומתארים את תוכן התמונות):\n"
+    "תמונה 1: {caption1}\n"
+    "תמונה 2: {caption2}\n\n"
+) + _EVAL_RUBRIC
+
+# For the two images themselves, sent right after this text.
+_IMAGE_EVAL_PROMPT_TEMPLATE = _EVAL_PROMPT_HEADER + (
+    "מצורפות שתי תמונות שהוגשו כפתרונות לאתגר: התמונה הראשונה היא תמונה 1 והתמונה השנייה היא תמונה 2.\n\n"
+) + _EVAL_RUBRIC
+
+_MISSING_INPUT_MESSAGE = "שגיאה: יש לספק את נושא האתגר ושני תיאורי תמונות לצורך הערכה."
+_EVAL_UNAVAILABLE_MESSAGE = "מצטער, היתה בעיה בעיבוד ההערכה כרגע. נסה שוב מאוחר יותר."
+_EVAL_INTERNAL_ERROR_MESSAGE = "שגיאה פנימית בעת הערכת התוצאות."
+
+# Submitted images are shrunk to fit this size and re-encoded as JPEG before upload to Gemini.
+# Phone photos are often 12 MP PNGs from the browser; Gemini does not need that resolution
+# to judge them, and the smaller payload uploads much faster.
+UPLOAD_IMAGE_MAX_SIZE = 768
+UPLOAD_JPEG_QUALITY = 85
+
+def _encode_for_upload(image: Image.Image) -> Dict[str, Any]:
+    """Returns the image downscaled to UPLOAD_IMAGE_MAX_SIZE and JPEG-encoded, as a Gemini inline blob."""
+    image = image.copy()
+    # Bilinear, like ImageService._prepare_image: the judge does not need a sharper downscale.
+    image.thumbnail((UPLOAD_IMAGE_MAX_SIZE, UPLOAD_IMAGE_MAX_SIZE), Image.Resampling.BILINEAR)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=UPLOAD_JPEG_QUALITY)
+    return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+
+def _split_eval_template(template: str) -> tuple:
+    """
+    Splits the template around its three slots once, so _execute only concatenates
+    instead of re-parsing the template with str.format on every call.
+    """
+    head, rest = template.split("{topic}", 1)
+    mid1, rest = rest.split("{caption1}", 1)
+    mid2, tail = rest.split("{caption2}", 1)
+    return (head, mid1, mid2, tail)
+
+_EVAL_PROMPT_PARTS = _split_eval_template(_EVAL_PROMPT_TEMPLATE)
+
 class EvaluationInput(BaseModel):
     """Input schema for the SubmissionEvaluator tool."""
-    topic: str = Field(description="The challenge topic against which submissions are evaluated.")
-    caption1: str = Field(description="Text caption describing the first image submission.")
-    caption2: str = Field(description="Text caption describing the second image submission.")
+    topic: str = Field(min_length=1, description="The challenge topic against which submissions are evaluated.")
+    caption1: str = Field(min_length=1, description="Text caption describing the first image submission.")
+    caption2: str = Field(min_length=1, description="Text caption describing the second image submission.")
 
 
 class EvaluationTool(BaseTool):
@@ -42,24 +94,12 @@ class EvaluationTool(BaseTool):
     )
     input_schema = EvaluationInput
 
-    def __init__(self, gemini_service: GeminiService, **kwargs):
+    def __init__(self, gemini_service: Optional[GeminiService] = None, **kwargs):
         super().__init__(**kwargs)
+        # Falls back to the shared get_gemini_service() instance on first use when None.
         self.gemini_service = gemini_service
-        self.evaluation_prompt_template = (
-            "אתה שופט מומחה וחסר פניות במשחק אתגר תמונות. תפקידך להעריך שתי הגשות לאתגר נתון.\n"
-            "בהתחשב באתגר: '{topic}'.\n"
-            "להלן תיאורים של שתי תמונות שהוגשו כפתרונות לאתגר (התיאורים נוצרו על ידי AI אחר ומתארים את תוכן התמונות):\n"
-            "תמונה 1: {caption1}\n"
-            "תמונה 2: {caption2}\n\n"
-            "עבור כל תמונה, אנא ספק ציון מ-1 עד 10 המייצג את מידת ההצלחה בביצוע האתגר. שקול יצירתיות, בהירות ועד כמה התמונה מייצגת חזותית את הפתרון לאתגר.\n"
-            "לאחר מכן, הכרז על התמונה הזוכה (תמונה 1 או תמונה 2).\n"
-            "לבסוף, ספק הסבר קצר וקולע (עד שתי שורות) מדוע התמונה הזו נבחרה כמנצחת, תוך התמקדות בסיבה המרכזית להחלטה. היה אובייקטיבי וברור.\n\n"
-            "הפלט הרצוי בעברית ובפורמט הבא:\n"
-            "תמונה 1 - ציון: [הציון כאן]/10\n"
-            "תמונה 2 - ציון: [הציון כאן]/10\n"
-            "התמונה הזוכה היא: תמונה [1/2]\n"
-            "הסבר קצר לזכייה: [ההסבר הקצר כאן]"
-        )
+        self.evaluation_prompt_template = _EVAL_PROMPT_TEMPLATE
+        self._tmpl_parts = _EVAL_PROMPT_PARTS
         logger.info(f"EvaluationTool '{self.name}' initialized.")
 
     async def _execute(self, inputs: EvaluationInput) -> str: # Made async
@@ -70,27 +110,81 @@ class EvaluationTool(BaseTool):
         Returns:
             str: The evaluation result from the LLM, or an error message.
         """
-        logger.info(f"Executing {self.name} tool for topic: {inputs.topic}")
+        return await self._execute_raw(inputs.topic, inputs.caption1, inputs.caption2)
+
+    async def _execute_raw(self, topic: str, caption1: str, caption2: str) -> str:
+        """
+        Evaluates submissions from plain strings, without building an EvaluationInput.
+        Used by trusted internal callers (the agent); the schema is kept for tool metadata.
+        Args:
+            topic: The challenge topic.
+            caption1: Caption of the first image.
+            caption2: Caption of the second image.
+        Returns:
+            str: The evaluation result from the LLM, or an error message.
+        """
+        logger.info("Executing %s tool for topic: %s", self.name, topic)
         
-        if not all([inputs.topic, inputs.caption1, inputs.caption2]): 
+        # EvaluationInput rejects empty fields at parse time; this guards the raw (unvalidated) path.
+        if not (topic and caption1 and caption2):
             logger.warning("EvaluationTool _execute called with missing data in input model.")
-            return "שגיאה: יש לספק את נושא האתגר ושני תיאורי תמונות לצורך הערכה."
+            return _MISSING_INPUT_MESSAGE
 
         try:
-            prompt = self.evaluation_prompt_template.format(
-                topic=inputs.topic, caption1=inputs.caption1, caption2=inputs.caption2
+            if self.gemini_service is None:
+                self.gemini_service = await get_gemini_service()
+            # Topic, both captions and the required verdict format all go into this one call;
+            # there is no separate per-caption LLM round trip to fuse away.
+            p = self._tmpl_parts
+            prompt = f"{p[0]}{topic}{p[1]}{caption1}{p[2]}{caption2}{p[3]}"
+            result = await cached_generate(
+                self.gemini_service, prompt, template_id=self.name,
+                slots={"topic": topic, "caption1": caption1, "caption2": caption2},
             )
-            result = await self.gemini_service.generate_text(prompt=prompt) # Await async call
-            
-            if not result or "Placeholder response" in result or "Error:" in result:
-                 logger.warning(f"Evaluation via GeminiService returned a non-ideal response: {result}")
-                 return "מצטער, היתה בעיה בעיבוד ההערכה כרגע. נסה שוב מאוחר יותר."
-            
             logger.info("Evaluation successful.")
             return result
+        except GeminiServiceError as e:
+            logger.warning(f"Evaluation via GeminiService failed: {e}")
+            return _EVAL_UNAVAILABLE_MESSAGE
+        except Exception as e:
+            # Full tracebacks only at DEBUG level; formatting them on every failure is costly.
+            logger.error("Error in %s: %s", self.name, e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            return _EVAL_INTERNAL_ERROR_MESSAGE
+
+    async def _execute_images(self, topic: str, image1: Image.Image, image2: Image.Image) -> str:
+        """
+        Evaluates submissions by sending the two images themselves to Gemini, in a single
+        multimodal request, instead of judging locally generated captions.
+        The images are downscaled and JPEG-encoded first (see _encode_for_upload), in worker threads.
+        Args:
+            topic: The challenge topic.
+            image1: The first submitted image.
+            image2: The second submitted image.
+        Returns:
+            str: The evaluation result from the LLM, or an error message.
+        """
+        logger.info("Executing %s tool on images for topic: %s", self.name, topic)
+        if not topic or image1 is None or image2 is None:
+            logger.warning("EvaluationTool _execute_images called with missing topic or image.")
+            return _MISSING_INPUT_MESSAGE
+
+        try:
+            if self.gemini_service is None:
+                self.gemini_service = await get_gemini_service()
+            upload1, upload2 = await asyncio.gather(
+                asyncio.to_thread(_encode_for_upload, image1),
+                asyncio.to_thread(_encode_for_upload, image2),
+            )
+            result = await self.gemini_service.generate([_IMAGE_EVAL_PROMPT_TEMPLATE.format(topic=topic), upload1, upload2])
+            logger.info("Image evaluation successful.")
+            return result
+        except GeminiServiceError as e:
+            logger.warning(f"Image evaluation via GeminiService failed: {e}")
+            return _EVAL_UNAVAILABLE_MESSAGE
         except Exception as e:
-            logger.error(f"Error in {self.name}: {e}", exc_info=True)
-            return "שגיאה פנימית בעת הערכת התוצאות."
+            # Full tracebacks only at DEBUG level; formatting them on every failure is costly.
+            logger.error("Error in %s: %s", self.name, e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            return _EVAL_INTERNAL_ERROR_MESSAGE
 
 async def main_evaluation_tool_test(): # Renamed and made async
     logging.basicConfig(level=logging.INFO)
@@ -110,8 +204,8 @@ async def main_evaluation_tool_test(): # Renamed and made async
         logger.warning("EvaluationTool test will use a DummyGeminiService.")
 
         class DummyGeminiService:
-            async def generate_text(self, prompt: str): # Made async
-                logger.info(f"DummyGeminiService.generate_text called with prompt: {prompt[:30]}...")
+            async def generate(self, prompt: str): # Made async
+                logger.info(f"DummyGeminiService.generate called with prompt: {prompt[:30]}...")
                 await asyncio.sleep(0) # Simulate async
                 if "תמונה 1 - ציון" in prompt: 
                      return "תמונה 1 - ציון: 8/10\nתמונה 2 - ציון: 7/10\nהתמונה הזוכה היא: תמונה 1\nהסבר קצר לזכייה: יצירתיות גבוהה יותר."
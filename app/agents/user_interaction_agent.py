@@ -1,24 +1,30 @@
 # app/agents/user_interaction_agent.py
 import logging
-from typing import List, Optional, Dict, Any # Any will be replaced by PydenticAI's Tool type
+import re
+from typing import AsyncIterator, List, Optional, Dict, Any, Tuple # Any will be replaced by PydenticAI's Tool type
 import asyncio # For async operations if needed
 
-from app.services.gemini_service import GeminiService
-from app.agents.challenge_tool import ChallengeGenerationTool
+from PIL import Image
+
+from cachetools import TTLCache
+
+from app.services.gemini_service import GeminiService, GeminiServiceError
+from app.agents.challenge_tool import ChallengeGenerationTool, CHALLENGE_FAILURE_MESSAGES
 from app.agents.evaluation_tool import EvaluationTool
+from app.agents.base_tool import BaseTool as PydenticAIToolType
 
 # --- PydenticAI Hypothetical Structure ---
 try:
     from pydenticai.core.agent import BaseAgent
-    from pydenticai.core.tool import BaseTool as PydenticAIToolType 
 except ImportError:
     logger_dummy = logging.getLogger(__name__ + ".dummy_agent_infra") 
-    logger_dummy.warning("PydenticAI BaseAgent or BaseTool not found. Using dummy base classes.")
+    logger_dummy.warning("PydenticAI BaseAgent not found. Using a dummy BaseAgent.")
     
     class BaseAgent: 
         def __init__(self, llm: Any, tools: List[Any], system_prompt: str, *args, **kwargs):
             self.llm = llm
             self.tools = tools
+            self._tool_by_name: Dict[str, Any] = {t.name: t for t in tools}
             self.system_prompt = system_prompt # Store the system prompt
             logger_dummy.info(f"DummyBaseAgent initialized. System prompt received: '{system_prompt[:50]}...'")
             pass
@@ -27,13 +33,13 @@ except ImportError:
             logger_dummy.info(f"DummyBaseAgent.run called with: {input_message}")
             # Simplified logic for dummy agent based on system prompt and tools
             if "ChallengeGenerator" in self.system_prompt and "אתגר חדש" in input_message:
-                challenge_tool = next((t for t in self.tools if t.name == "ChallengeGenerator"), None)
+                challenge_tool = self._tool_by_name.get("ChallengeGenerator")
                 if challenge_tool: return await challenge_tool._execute()
                 return "שגיאה: כלי יצירת אתגר לא נמצא (דמה)."
             
             image_captions = kwargs.get('image_captions')
             if "SubmissionEvaluator" in self.system_prompt and image_captions:
-                eval_tool = next((t for t in self.tools if t.name == "SubmissionEvaluator"), None)
+                eval_tool = self._tool_by_name.get("SubmissionEvaluator")
                 if eval_tool:
                     return "הערכה בוצעה על ידי כלי הערכה (דמה)."
                 return "שגיאה: כלי הערכה לא נמצא (דמה)."
@@ -41,17 +47,90 @@ except ImportError:
             if hasattr(self.llm, 'generate_text') and self.llm:
                  return await self.llm.generate_text(prompt=f"{self.system_prompt}\nUser: {input_message}\nAI:")
             return "תגובה כללית (סוכן דמה)."
-
-    class PydenticAIToolType: 
-        name: str = "DummyTool"
 # --- End PydenticAI Hypothetical Structure ---
 
 logger = logging.getLogger(__name__)
 
+# Per-session state: the current challenge topic of each session is kept for
+# SESSION_TTL_SECONDS after its last update, for at most SESSION_MAX_ENTRIES sessions.
+SESSION_MAX_ENTRIES = 10_000
+SESSION_TTL_SECONDS = 1800
+DEFAULT_SESSION_ID = "default"
+
+# Number of challenges generated ahead of time by the background producer. After a failed
+# generation the producer retries with exponential backoff, from the first to the max delay.
+CHALLENGE_PREFETCH_SIZE = 2
+CHALLENGE_PREFETCH_RETRY_SECONDS = 30
+CHALLENGE_PREFETCH_MAX_RETRY_SECONDS = 600
+# How long a request waits for the producer's challenge before generating its own.
+CHALLENGE_PREFETCH_WAIT_SECONDS = 15
+
+# Intent keywords, matched in a single pass; the name of the matching group is the intent.
+# The keywords are Hebrew, which has no letter case, so messages are matched as-is.
+_INTENT_RE = re.compile(r"(?P<rules>כללים|הוראות|איך משחקים)|(?P<new_challenge>אתגר חדש|צור אתגר)")
+
+_AGENT_SYSTEM_PROMPT = (
+    "אתה 'מנחה משחק אתגר התמונות', סוכן AI ידידותי, מסביר פנים ומומחה בהנחיית משחקים. "
+    "מטרתך היא לנהל את המשחק בצורה חלקה ומהנה עבור המשתמשים.\n"
+    "יש לך גישה לכלים הבאים: 'ChallengeGenerator' (ליצירת אתגרים חדשים) ו-'SubmissionEvaluator' (להערכת הגשות לאתגרים).\n\n"
+    "התנהלות מול המשתמש:\n"
+    "- התחל בהסבר קצר של כללי המשחק אם המשתמש חדש או מבקש זאת.\n"
+    "- אם המשתמש מבקש 'אתגר חדש', 'משימה חדשה' או דומה, השתמש בכלי 'ChallengeGenerator' כדי ליצור אתגר והצג אותו למשתמש. זכור את נושא האתגר שנוצר.\n"
+    "- אם המשתמש מעלה תמונות (שיגיעו אליך כתיאורי טקסט מוכנים) וקיים אתגר פעיל, השתמש בכלי 'SubmissionEvaluator' כדי להעריך את ההגשות. הצג את התוצאה למשתמש.\n"
+    "- אם המשתמש שואל שאלה כללית על המשחק או מנהל שיחה שאינה קשורה ישירות לבקשת אתגר או הערכת הגשות, השב בצורה ידידותית ואינפורמטיבית מבלי להשתמש בכלים, אלא אם כן נדרש במפורש.\n"
+    "- שמור על טון שיחה חיובי, סבלני ועוזר. אם אינך בטוח כיצד להגיב או מה כוונת המשתמש, בקש הבהרה.\n"
+    "- נהל רישום פנימי של 'נושא האתגר הנוכחי' כדי להעבירו כראוי לכלי ההערכה."
+)
+
+_GAME_RULES = (
+    "ברוכים הבאים לאתגר התמונות! המשחק עובד כך:\n"
+    "1. בקשו ממני 'אתגר חדש' ואני אצור לכם משימה יצירתית.\n"
+    "2. כל אחד משני המשתתפים (או שחקן יחיד בשני תפקידים) מעלה תמונה המייצגת את הפתרון שלו לאתגר.\n"
+    "3. לאחר העלאת שתי התמונות, אני אעריך אותן ואכריז על המנצח!\n"
+    "מוכנים להתחיל? בקשו אתגר חדש או שאלו אם משהו לא ברור."
+)
+
+# Fixed replies, built once instead of per request.
+_INTERNAL_ERROR_REPLY = "מצטער, היתה לי שגיאה פנימית."
+_UNSURE_REPLY = "אני לא בטוח איך להגיב על זה. אפשר לנסות משהו אחר?"
+_NO_CHALLENGE_REPLY = "לא נוצר עדיין אתגר. אנא בקשו 'אתגר חדש' תחילה."
+
+# Opcodes returned by _route_intent.
+_ROUTE_GENERIC = 0
+_ROUTE_RULES = 1
+_ROUTE_NEW_CHALLENGE = 2
+_ROUTE_BY_INTENT = {"rules": _ROUTE_RULES, "new_challenge": _ROUTE_NEW_CHALLENGE}
+
+def _build_generic_prompt(user_message: str, current_topic: Optional[str]) -> str:
+    return (
+        f"{_AGENT_SYSTEM_PROMPT}\n\n" 
+        f"האתגר הנוכחי הוא: {current_topic if current_topic else 'לא נקבע עדיין'}\n\n"
+        f"המשתמש אומר: \"{user_message}\"\n\n"
+        "כיצד עליך להגיב באופן מועיל ושיחתי בהתאם לתפקידך כמנהל המשחק? "
+        "אם המשתמש שואל על משהו שאינו קשור ישירות למשחק, הזכר לו בעדינות את מטרת המשחק או הצע להתחיל אתגר חדש."
+    )
+
+def _route_intent(user_message: str, current_topic: Optional[str]) -> Tuple[int, str]:
+    """
+    Classifies a user message and, for the generic route, assembles the LLM prompt.
+    This is all of the CPU-only work between the agent's awaits, kept free of I/O and
+    agent state so it can be profiled (or compiled) on its own.
+    Args:
+        user_message: The user's chat message.
+        current_topic: The session's current challenge topic, if any.
+    Returns:
+        Tuple[int, str]: The route opcode, and the generic prompt ("" for other routes).
+    """
+    intent_match = _INTENT_RE.search(user_message)
+    if intent_match is not None:
+        return _ROUTE_BY_INTENT[intent_match.lastgroup], ""
+    return _ROUTE_GENERIC, _build_generic_prompt(user_message, current_topic)
+
 class UserInteractionAgent(BaseAgent): 
     """
     The main PydenticAI Agent that manages user interaction,
     explains game rules, and uses tools to generate challenges and evaluate submissions.
+    A single instance is shared by all users; per-user state is keyed by session id.
     """
 
     def __init__(self, gemini_service: GeminiService):
@@ -60,79 +139,217 @@ class UserInteractionAgent(BaseAgent):
         
         agent_tools: List[PydenticAIToolType] = [self.challenge_tool, self.evaluation_tool]
         
-        agent_system_prompt = (
-            "אתה 'מנחה משחק אתגר התמונות', סוכן AI ידידותי, מסביר פנים ומומחה בהנחיית משחקים. "
-            "מטרתך היא לנהל את המשחק בצורה חלקה ומהנה עבור המשתמשים.\n"
-            "יש לך גישה לכלים הבאים: 'ChallengeGenerator' (ליצירת אתגרים חדשים) ו-'SubmissionEvaluator' (להערכת הגשות לאתגרים).\n\n"
-            "התנהלות מול המשתמש:\n"
-            "- התחל בהסבר קצר של כללי המשחק אם המשתמש חדש או מבקש זאת.\n"
-            "- אם המשתמש מבקש 'אתגר חדש', 'משימה חדשה' או דומה, השתמש בכלי 'ChallengeGenerator' כדי ליצור אתגר והצג אותו למשתמש. זכור את נושא האתגר שנוצר.\n"
-            "- אם המשתמש מעלה תמונות (שיגיעו אליך כתיאורי טקסט מוכנים) וקיים אתגר פעיל, השתמש בכלי 'SubmissionEvaluator' כדי להעריך את ההגשות. הצג את התוצאה למשתמש.\n"
-            "- אם המשתמש שואל שאלה כללית על המשחק או מנהל שיחה שאינה קשורה ישירות לבקשת אתגר או הערכת הגשות, השב בצורה ידידותית ואינפורמטיבית מבלי להשתמש בכלים, אלא אם כן נדרש במפורש.\n"
-            "- שמור על טון שיחה חיובי, סבלני ועוזר. אם אינך בטוח כיצד להגיב או מה כוונת המשתמש, בקש הבהרה.\n"
-            "- נהל רישום פנימי של 'נושא האתגר הנוכחי' כדי להעבירו כראוי לכלי ההערכה."
-        )
+        agent_system_prompt = _AGENT_SYSTEM_PROMPT
         
         super().__init__(llm=gemini_service, tools=agent_tools, system_prompt=agent_system_prompt)
         
         self.gemini_service = gemini_service 
+        # The real PydenticAI BaseAgent may not build a name index, so keep our own.
+        self._tool_by_name: Dict[str, PydenticAIToolType] = {t.name: t for t in agent_tools}
         
-        self.current_challenge_topic: Optional[str] = None
-        self.game_rules: str = (
-            "ברוכים הבאים לאתגר התמונות! המשחק עובד כך:\n"
-            "1. בקשו ממני 'אתגר חדש' ואני אצור לכם משימה יצירתית.\n"
-            "2. כל אחד משני המשתתפים (או שחקן יחיד בשני תפקידים) מעלה תמונה המייצגת את הפתרון שלו לאתגר.\n"
-            "3. לאחר העלאת שתי התמונות, אני אעריך אותן ואכריז על המנצח!\n"
-            "מוכנים להתחיל? בקשו אתגר חדש או שאלו אם משהו לא ברור."
-        )
+        self._session_topics: TTLCache = TTLCache(maxsize=SESSION_MAX_ENTRIES, ttl=SESSION_TTL_SECONDS)
+        self.game_rules: str = _GAME_RULES
+        # Created by start_challenge_prefetch, since they must belong to the serving event loop.
+        self._challenge_queue: Optional[asyncio.Queue] = None
+        self._challenge_producer_task: Optional[asyncio.Task] = None
+        # Set while the producer is backing off after failed generations.
+        self._challenge_producer_failing = False
         logger.info("UserInteractionAgent initialized with refined system prompt.")
 
+    def get_tool(self, name: str) -> Optional[PydenticAIToolType]:
+        """
+        Returns the agent tool with the given name, or None if there is none.
+        Args:
+            name: The tool name (e.g. 'ChallengeGenerator').
+        Returns:
+            Optional[PydenticAIToolType]: The tool instance.
+        """
+        return self._tool_by_name.get(name)
+
+    @staticmethod
+    def _is_challenge_failure(topic: str) -> bool:
+        return topic in CHALLENGE_FAILURE_MESSAGES
+
+    def _challenge_producer_running(self) -> bool:
+        return self._challenge_producer_task is not None and not self._challenge_producer_task.done()
 
-    async def process_user_interaction(self, user_message: str, image_captions: Optional[Dict[str, str]] = None) -> str:
-        logger.info(f"UserInteractionAgent processing interaction: '{user_message}', Captions: {image_captions is not None}")
+    def start_challenge_prefetch(self) -> None:
+        """
+        Starts the background producer that keeps CHALLENGE_PREFETCH_SIZE challenges ready, so a
+        request for a new challenge is usually served without waiting for Gemini.
+        Call it once from the event loop that serves requests (e.g. at server startup), and
+        stop_challenge_prefetch on shutdown. Without it, every challenge is generated on request.
+        """
+        if self._challenge_producer_running():
+            return
+        self._challenge_queue = asyncio.Queue(maxsize=CHALLENGE_PREFETCH_SIZE)
+        self._challenge_producer_failing = False
+        self._challenge_producer_task = asyncio.create_task(self._challenge_producer())
+        logger.info("Started background challenge producer.")
 
-        if any(keyword in user_message.lower() for keyword in ["כללים", "הוראות", "איך משחקים"]):
+    async def _challenge_producer(self) -> None:
+        """Keeps the challenge queue filled, backing off exponentially while generation fails."""
+        retry_seconds = CHALLENGE_PREFETCH_RETRY_SECONDS
+        while True:
+            topic = await self.challenge_tool._execute()
+            if self._is_challenge_failure(topic):
+                self._challenge_producer_failing = True
+                logger.warning("Background challenge generation failed; retrying in %d s.", retry_seconds)
+                await asyncio.sleep(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, CHALLENGE_PREFETCH_MAX_RETRY_SECONDS)
+                continue
+            self._challenge_producer_failing = False
+            retry_seconds = CHALLENGE_PREFETCH_RETRY_SECONDS
+            await self._challenge_queue.put(topic) # Blocks while the queue is full.
+
+    async def _next_challenge(self) -> str:
+        """
+        Returns a pre-generated challenge. If none is ready, waits for the one the producer is
+        generating rather than generating another in parallel. Generates one inline only if
+        the producer is not running, is backing off after failures, or does not deliver in time.
+        """
+        if self._challenge_queue is not None:
+            try:
+                topic = self._challenge_queue.get_nowait()
+                logger.info("Serving a pre-generated challenge.")
+                return topic
+            except asyncio.QueueEmpty:
+                pass
+        if not self._challenge_producer_running() or self._challenge_producer_failing:
+            return await self.challenge_tool._execute()
+        try:
+            topic = await asyncio.wait_for(self._challenge_queue.get(), CHALLENGE_PREFETCH_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("No pre-generated challenge after %d s; generating one inline.", CHALLENGE_PREFETCH_WAIT_SECONDS)
+            return await self.challenge_tool._execute()
+        logger.info("Serving a challenge from the background producer.")
+        return topic
+
+    async def stop_challenge_prefetch(self) -> None:
+        """Cancels the background challenge producer, if running."""
+        task, self._challenge_producer_task = self._challenge_producer_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        logger.info("Stopped background challenge producer.")
+
+    def get_current_topic(self, session_id: str = DEFAULT_SESSION_ID) -> Optional[str]:
+        """Returns the active challenge topic of the session, or None if there is none."""
+        return self._session_topics.get(session_id)
+
+    async def stream_user_interaction(self, user_message: str, image_captions: Optional[Dict[str, str]] = None,
+                                      session_id: str = DEFAULT_SESSION_ID) -> AsyncIterator[str]:
+        """
+        Like process_user_interaction, but streams the generic LLM fallback response
+        chunk by chunk. Rules, new-challenge and evaluation replies are yielded whole.
+        Args:
+            user_message: The user's chat message.
+            image_captions: Optional dict with 'caption1' and 'caption2'.
+            session_id: The UI session the interaction belongs to.
+        Returns:
+            AsyncIterator[str]: Successive chunks of the response text.
+        """
+        route, prompt = _route_intent(user_message, self.get_current_topic(session_id))
+        has_captions = bool(image_captions and image_captions.get("caption1") and image_captions.get("caption2"))
+        if route != _ROUTE_GENERIC or has_captions:
+            yield await self.process_user_interaction(user_message, image_captions, session_id=session_id)
+            return
+
+        logger.info("Streaming generic response for session '%s': '%s'", session_id, user_message)
+        yielded_any = False
+        try:
+            async for chunk in self.gemini_service.generate_text_stream(prompt=prompt):
+                yielded_any = True
+                yield chunk
+        except GeminiServiceError as e:
+            logger.warning(f"Generic response stream via GeminiService failed: {e}")
+            if not yielded_any:
+                yield _UNSURE_REPLY
+            return
+        except Exception as e:
+            # Full tracebacks only at DEBUG level; formatting them on every failure is costly.
+            logger.error("Error streaming generic response via GeminiService: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            if not yielded_any:
+                yield _INTERNAL_ERROR_REPLY
+            return
+
+    async def evaluate_images(self, image1: Image.Image, image2: Image.Image,
+                              session_id: str = DEFAULT_SESSION_ID, topic: Optional[str] = None) -> str:
+        """
+        Evaluates two submitted images against the session's current challenge by sending
+        them directly to Gemini (see EvaluationTool._execute_images), with no captioning step.
+        Args:
+            image1: The first submitted image.
+            image2: The second submitted image.
+            session_id: The UI session the submission belongs to.
+            topic: The challenge to evaluate against, e.g. the one the UI is showing.
+                Defaults to the session's current topic.
+        Returns:
+            str: The evaluation result, or a message explaining why there is none.
+        """
+        logger.info("UserInteractionAgent evaluating submitted images for session '%s'.", session_id)
+        current_topic = topic or self.get_current_topic(session_id)
+        if not current_topic:
+            return _NO_CHALLENGE_REPLY
+        evaluation_result = await self.evaluation_tool._execute_images(current_topic, image1, image2)
+        return f"תוצאות ההערכה:\n{evaluation_result}"
+
+    async def process_user_interaction(self, user_message: str, image_captions: Optional[Dict[str, str]] = None,
+                                       session_id: str = DEFAULT_SESSION_ID, topic: Optional[str] = None) -> str:
+        """
+        Answers a user message: the rules, a new challenge, an evaluation of the given captions,
+        or a generic LLM reply.
+        Args:
+            user_message: The user's chat message.
+            image_captions: Optional dict with 'caption1' and 'caption2'.
+            session_id: The UI session the interaction belongs to.
+            topic: The current challenge as the caller knows it (e.g. the UI's session state),
+                used instead of the session's stored topic so both sides evaluate the same challenge.
+        Returns:
+            str: The reply text.
+        """
+        logger.info("UserInteractionAgent processing interaction for session '%s': '%s', Captions: %s", session_id, user_message, image_captions is not None)
+        current_topic = topic or self.get_current_topic(session_id)
+
+        route, generic_prompt_for_llm = _route_intent(user_message, current_topic)
+
+        if route == _ROUTE_RULES:
             return self.game_rules
 
-        if "אתגר חדש" in user_message or "צור אתגר" in user_message:
+        if route == _ROUTE_NEW_CHALLENGE:
             logger.info("User requested a new challenge. Using ChallengeGenerationTool.")
-            topic_generated = await self.challenge_tool._execute() 
-            if "מצטער" in topic_generated or "שגיאה" in topic_generated:
-                self.current_challenge_topic = None 
+            topic_generated = await self._next_challenge()
+            if self._is_challenge_failure(topic_generated):
+                self._session_topics.pop(session_id, None)
                 return topic_generated 
-            self.current_challenge_topic = topic_generated
-            logger.info(f"New challenge set: {self.current_challenge_topic}")
-            return f"האתגר החדש שלכם הוא:\n{self.current_challenge_topic}"
+            self._session_topics[session_id] = topic_generated
+            logger.info("New challenge set: %s", topic_generated)
+            return f"האתגר החדש שלכם הוא:\n{topic_generated}"
 
         if image_captions and image_captions.get("caption1") and image_captions.get("caption2"):
             logger.info("User submitted images for evaluation. Using EvaluationTool.")
-            if not self.current_challenge_topic:
-                return "לא נוצר עדיין אתגר. אנא בקשו 'אתגר חדש' תחילה."
+            if not current_topic:
+                return _NO_CHALLENGE_REPLY
             
-            from app.agents.evaluation_tool import EvaluationInput 
-            eval_input = EvaluationInput(
-                topic=self.current_challenge_topic,
-                caption1=image_captions["caption1"],
-                caption2=image_captions["caption2"]
+            # Captions come from our own ImageService, so skip EvaluationInput validation.
+            evaluation_result = await self.evaluation_tool._execute_raw(
+                current_topic, image_captions["caption1"], image_captions["caption2"]
             )
-            evaluation_result = await self.evaluation_tool._execute(inputs=eval_input)
             return f"תוצאות ההערכה:\n{evaluation_result}"
         
         logger.info("No specific command/tool triggered by keywords. Generating generic response via PydenticAI agent or direct LLM call.")
-        
-        generic_prompt_for_llm = (
-            f"{self.system_prompt}\n\n" 
-            f"האתגר הנוכחי הוא: {self.current_challenge_topic if self.current_challenge_topic else 'לא נקבע עדיין'}\n\n"
-            f"המשתמש אומר: \"{user_message}\"\n\n"
-            "כיצד עליך להגיב באופן מועיל ושיחתי בהתאם לתפקידך כמנהל המשחק? "
-            "אם המשתמש שואל על משהו שאינו קשור ישירות למשחק, הזכר לו בעדינות את מטרת המשחק או הצע להתחיל אתגר חדש."
-        )
         try:
-            response = await self.gemini_service.generate_text(prompt=generic_prompt_for_llm) 
-            return response if response and "Placeholder response" not in response else "אני לא בטוח איך להגיב על זה. אפשר לנסות משהו אחר?"
+            return await self.gemini_service.generate(generic_prompt_for_llm)
+        except GeminiServiceError as e:
+            logger.warning(f"Generic response via GeminiService failed: {e}")
+            return _UNSURE_REPLY
         except Exception as e:
-            logger.error(f"Error generating generic response via GeminiService: {e}", exc_info=True)
-            return "מצטער, היתה לי שגיאה פנימית."
+            # Full tracebacks only at DEBUG level; formatting them on every failure is costly.
+            logger.error("Error generating generic response via GeminiService: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            return _INTERNAL_ERROR_REPLY
 
 
 async def main_test(): 
@@ -149,9 +366,9 @@ async def main_test():
 
 
     class DummyGeminiService: 
-        async def generate_text(self, prompt: str): 
+        async def generate(self, prompt: str): 
             prompt_snippet = prompt[:70].replace('\n', ' ') # Corrected line
-            logger.info(f"DummyGeminiService.generate_text called with prompt snippet: '{prompt_snippet}...'")
+            logger.info(f"DummyGeminiService.generate called with prompt snippet: '{prompt_snippet}...'")
             if "אתה מנחה משחק אתגרים יצירתי ומהנה" in prompt: 
                 return "אתגר דמה: צור יצור מכוכב אחר באמצעות שלושה פריטי מטבח."
             elif "אתה שופט מומחה וחסר פניות" in prompt: 
@@ -165,16 +382,18 @@ async def main_test():
 
     try:
         agent = UserInteractionAgent(gemini_service=gemini_service_instance)
+        agent.start_challenge_prefetch()
         
         response_rules = await agent.process_user_interaction('ספר לי את הכללים')
         logger.info(f"Agent (Rules): {response_rules}")
 
         response_new_challenge = await agent.process_user_interaction('אתגר חדש')
         logger.info(f"Agent (New Challenge): {response_new_challenge}")
-        logger.info(f"Current topic in agent: {agent.current_challenge_topic}")
+        current_topic = agent.get_current_topic()
+        logger.info(f"Current topic in agent: {current_topic}")
         
         dummy_captions = {"caption1": "יצור עם עיני זיתים ואף גזר", "caption2": "צלחת ריקה"}
-        if agent.current_challenge_topic and "מצטער" not in agent.current_challenge_topic and "שגיאה" not in agent.current_challenge_topic:
+        if current_topic and not agent._is_challenge_failure(current_topic):
             response_eval = await agent.process_user_interaction('הנה ההגשות שלי', image_captions=dummy_captions)
             logger.info(f"Agent (Evaluation): {response_eval}")
         else:
@@ -183,10 +402,19 @@ async def main_test():
         response_generic = await agent.process_user_interaction('מה מזג האוויר היום?')
         logger.info(f"Agent (Generic): {response_generic}")
 
+        response_second_challenge = await agent.process_user_interaction('אתגר חדש')
+        logger.info(f"Agent (Second Challenge, pre-generated): {response_second_challenge}")
+        await agent.stop_challenge_prefetch()
+
     except ImportError as e:
         logger.error(f"PydenticAI library not found or not correctly mocked: {e}. This test is conceptual.")
     except Exception as e:
         logger.error(f"Error during conceptual agent test: {e}", exc_info=True)
 
 if __name__ == '__main__':
+    try:
+        import uvloop # Faster drop-in event loop; not available on Windows.
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     asyncio.run(main_test())
@@ -1,11 +1,14 @@
 import os
 import logging
+import functools
 
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=1)
 def get_openai_api_key():
     """
     Retrieves the OpenAI API key from the environment variable OPENAI_API_KEY.
+    The result is cached for the lifetime of the process; see invalidate_config_cache().
 
     Raises:
         ValueError: If the OPENAI_API_KEY environment variable is not set.
@@ -31,10 +34,13 @@ def get_openai_api_key():
 # For now, let's stick to the function `get_openai_api_key()` to be called explicitly.
 
 
+@functools.lru_cache(maxsize=1)
 def get_google_application_credentials():
     """
     Retrieves the path to Google Application Credentials from the environment variable.
     This is more of a check, as Google libraries often auto-detect this.
+    The result (including the file-existence check) is cached for the lifetime of the
+    process; failures are not cached. See invalidate_config_cache().
 
     Returns:
         str: The path to the service account JSON file, if set.
@@ -59,6 +65,86 @@ def get_google_application_credentials():
     logger.info(f"GOOGLE_APPLICATION_CREDENTIALS found at: {credentials_path}")
     return credentials_path
 
+# How submitted images are judged: sent directly to Gemini together with the topic
+# ("multimodal"), or first captioned locally with BLIP and judged from the captions
+# ("captions", for deployments where images may not leave the machine).
+EVALUATION_MODE_MULTIMODAL = "multimodal"
+EVALUATION_MODE_CAPTIONS = "captions"
+
+@functools.lru_cache(maxsize=1)
+def get_image_evaluation_mode():
+    """
+    Retrieves the image evaluation mode from the IMAGE_EVALUATION_MODE environment variable.
+    The result is cached for the lifetime of the process; see invalidate_config_cache().
+
+    Returns:
+        str: EVALUATION_MODE_MULTIMODAL (the default) or EVALUATION_MODE_CAPTIONS.
+    """
+    mode = os.getenv("IMAGE_EVALUATION_MODE", EVALUATION_MODE_MULTIMODAL).strip().lower()
+    if mode not in (EVALUATION_MODE_MULTIMODAL, EVALUATION_MODE_CAPTIONS):
+        logger.warning(f"Unknown IMAGE_EVALUATION_MODE '{mode}', using '{EVALUATION_MODE_MULTIMODAL}'.")
+        return EVALUATION_MODE_MULTIMODAL
+    logger.info(f"Image evaluation mode: {mode}")
+    return mode
+
+@functools.lru_cache(maxsize=1)
+def get_blip_use_onnx():
+    """
+    Retrieves whether BLIP should run with ONNX Runtime, from the BLIP_USE_ONNX environment variable.
+    Only relevant in captions mode. The result is cached; see invalidate_config_cache().
+
+    Returns:
+        bool: True if BLIP_USE_ONNX is "1", "true" or "yes" (case-insensitive); False by default.
+    """
+    return os.getenv("BLIP_USE_ONNX", "").strip().lower() in ("1", "true", "yes")
+
+DEFAULT_LLM_MAX_CONCURRENCY = 20
+
+@functools.lru_cache(maxsize=1)
+def get_llm_max_concurrency():
+    """
+    Retrieves the maximum number of concurrent OpenAI requests from the LLM_MAX_CONCURRENCY
+    environment variable. The result is cached; see invalidate_config_cache().
+
+    Returns:
+        int: The configured limit, or DEFAULT_LLM_MAX_CONCURRENCY if unset or not a positive integer.
+    """
+    value = os.getenv("LLM_MAX_CONCURRENCY", "").strip()
+    if not value:
+        return DEFAULT_LLM_MAX_CONCURRENCY
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        logger.warning(f"Invalid LLM_MAX_CONCURRENCY '{value}', using {DEFAULT_LLM_MAX_CONCURRENCY}.")
+        return DEFAULT_LLM_MAX_CONCURRENCY
+    return limit
+
+@functools.lru_cache(maxsize=1)
+def get_llm_cache_path():
+    """
+    Retrieves the SQLite file that persists LLM response caches across restarts, from the
+    LLM_CACHE_PATH environment variable. The result is cached; see invalidate_config_cache().
+
+    Returns:
+        Optional[str]: The file path, or None (the default) to keep the caches in memory only.
+    """
+    return os.getenv("LLM_CACHE_PATH", "").strip() or None
+
+def invalidate_config_cache():
+    """
+    Clears the cached configuration values, so the next call re-reads the environment.
+    Useful after changing environment variables at runtime (e.g. on a config reload).
+    """
+    get_openai_api_key.cache_clear()
+    get_google_application_credentials.cache_clear()
+    get_image_evaluation_mode.cache_clear()
+    get_blip_use_onnx.cache_clear()
+    get_llm_max_concurrency.cache_clear()
+    get_llm_cache_path.cache_clear()
+    logger.info("Configuration cache cleared.")
+
 # Example of how it might be called during setup (optional here, GeminiService will handle init)
 # try:
 #     GOOGLE_CREDENTIALS = get_google_application_credentials()
@@ -1,12 +1,14 @@
 # app/main.py
+import asyncio
+import contextlib
 import logging
-from PIL import Image # Keep for type hinting if GradioInterface uses it, though not directly used here.
 
 # Application specific imports
-from app.services.gemini_service import GeminiService
+from app.services.gemini_service import get_gemini_service
 from app.services.image_service import ImageService
 from app.agents.user_interaction_agent import UserInteractionAgent
 from app.ui.gradio_interface import GradioInterface
+from app.config import EVALUATION_MODE_CAPTIONS, get_blip_use_onnx, get_image_evaluation_mode
 
 # Configure basic logging for the entire application
 # This will be effective once any part of the app starts logging.
@@ -14,52 +16,77 @@ from app.ui.gradio_interface import GradioInterface
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__) # Logger for main.py itself
 
-# Original ChallengeApplication class - to be removed or refactored if PydenticAI agent replaces its full functionality.
-# For now, we are replacing its direct instantiation in main with the agent-based setup.
-# class ChallengeApplication:
-#     """
-#     Core application class that orchestrates the challenge generation and evaluation.
-#     (This class is being replaced by UserInteractionAgent for core logic)
-#     """
-#     def __init__(self):
-#         logger.info("Initializing ChallengeApplication (legacy)...")
-#         # ... (old init logic)
-
-#     def generate_new_challenge(self) -> str:
-#         # ... (old logic)
-#         pass
+def _install_uvloop():
+    """
+    Uses uvloop as the asyncio event loop policy when it is installed (it is not available on Windows).
+    Gradio's uvicorn server also picks uvloop up automatically once it is installed.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop not installed; using the default asyncio event loop.")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Using uvloop event loop policy.")
 
-#     def evaluate_challenge_submissions(self, image1_pil: Image, image2_pil: Image, topic: str) -> str:
-#         # ... (old logic)
-#         pass
+def _serving_lifespan(gemini_service, user_agent, image_service=None):
+    """
+    Returns the lifespan handler of the Gradio server, which runs in the server's own event loop.
+    The Gemini warmup must run there: google-generativeai caches one process-wide grpc-asyncio
+    client, bound to the event loop that first uses it, so warming it up in a short-lived
+    asyncio.run() loop would leave every later call on a closed loop. The agent's challenge
+    producer is started there for the same reason, and stopped on shutdown together with the
+    ImageService's caption micro-batcher, if there is one.
+    """
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        await gemini_service.warmup()
+        user_agent.start_challenge_prefetch()
+        try:
+            yield
+        finally:
+            await user_agent.stop_challenge_prefetch()
+            if image_service is not None:
+                await image_service.stop_caption_batcher()
+    return lifespan
 
 
 if __name__ == '__main__':
     logger.info("Application starting...")
+    _install_uvloop()
     
     # This structure assumes GOOGLE_APPLICATION_CREDENTIALS is set for GeminiService
     # and BLIP models for ImageService are accessible (downloaded or cached).
     try:
         logger.info("Initializing services...")
         # GeminiService is primary for the agent's LLM
-        gemini_service = GeminiService()
+        # The shared instance is created up front so configuration errors stop startup.
+        gemini_service = asyncio.run(get_gemini_service())
         
-        # ImageService is used by Gradio to get captions before passing to the agent
-        image_service = ImageService() 
+        # In captions mode, ImageService is used by Gradio to get captions before passing to the agent.
+        # In multimodal mode Gemini sees the images directly, so BLIP is not loaded at all.
+        evaluation_mode = get_image_evaluation_mode()
+        image_service = ImageService(use_onnx=get_blip_use_onnx()) if evaluation_mode == EVALUATION_MODE_CAPTIONS else None
+
+        # Pay first-call setup costs now rather than on the first user's request.
+        # Gemini is warmed up when the server starts, in its event loop (see _serving_lifespan).
+        if image_service is not None:
+            image_service.warmup()
         
         logger.info("Initializing UserInteractionAgent...")
         # UserInteractionAgent now uses GeminiService for its LLM calls (via tools or direct responses).
         user_agent = UserInteractionAgent(gemini_service=gemini_service)
         
         logger.info("Initializing GradioInterface...")
-        # Pass both the PydenticAI agent and the ImageService to GradioInterface
-        gradio_ui = GradioInterface(agent=user_agent, image_service=image_service)
+        # Pass both the PydenticAI agent and the ImageService to GradioInterface.
+        # They are created once here and shared by every Gradio event; handlers never construct services.
+        gradio_ui = GradioInterface(agent=user_agent, image_service=image_service, evaluation_mode=evaluation_mode)
         
         gradio_ui.create_ui()
         logger.info("Launching Gradio interface...")
         # server_name="0.0.0.0" makes it accessible on the local network
         # share=True would create a temporary public link (requires internet & Gradio setup)
-        gradio_ui.launch(server_name="0.0.0.0") 
+        gradio_ui.launch(server_name="0.0.0.0", app_kwargs={"lifespan": _serving_lifespan(gemini_service, user_agent, image_service)})
         
     except RuntimeError as re: # Catch specific init errors from services/agents
         logger.critical(f"Critical Error during initialization: {re}", exc_info=True)
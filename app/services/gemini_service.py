@@ -3,6 +3,7 @@ import google.generativeai as genai
 import logging
 import os
 import asyncio # Added import
+from typing import Any, AsyncIterator, List, Optional, Union
 # Assuming get_google_application_credentials is in app.config for a pre-check,
 # though genai.configure might not strictly need it if GOOGLE_APPLICATION_CREDENTIALS is set.
 from app.config import get_google_application_credentials 
@@ -12,6 +13,10 @@ logger = logging.getLogger(__name__)
 # The specific model name for Gemini 1.5 Flash.
 DEFAULT_GEMINI_MODEL = "gemini-1.5-flash-latest" 
 
+class GeminiServiceError(Exception):
+    """Raised by GeminiService when a request produces no usable text."""
+
+
 class GeminiService:
     """
     Service for interacting with Google Gemini models.
@@ -66,44 +71,128 @@ class GeminiService:
             logger.error(f"Failed to initialize Gemini client: {e}", exc_info=True)
             raise RuntimeError(f"GeminiService initialization failed: {e}")
 
+    async def generate(self, contents: Union[str, List[Any]]) -> str:
+        """
+        Generates text using the configured Gemini model, raising on failure.
+        Uses the client's native async call, so concurrent requests overlap on the network
+        without occupying worker threads.
+        Args:
+            contents: A prompt string, or a list of parts (strings and PIL images) sent in one request.
+        Returns:
+            str: The generated text (never empty).
+        Raises:
+            GeminiServiceError: If the client is not initialized, the call fails,
+                or the response has no usable text (e.g. it was blocked).
+        """
+        prompt = contents if isinstance(contents, str) else next((part for part in contents if isinstance(part, str)), "")
+        logger.info("Generating text with model %s for prompt: '%.70s...'", self.model_name, prompt)
+        if not self.client:
+            logger.error("Gemini client not initialized. Cannot generate text.")
+            raise GeminiServiceError("Gemini client not initialized.")
+        try:
+            response = await self.client.generate_content_async(contents)
+        except Exception as e:
+            logger.error(f"Error during Gemini text generation: {e}", exc_info=True)
+            raise GeminiServiceError(f"LLM call failed - {str(e)}") from e
+        return self._response_text(response, prompt)
+
     async def generate_text(self, prompt: str) -> str:
         """
         Generates text using the configured Gemini model.
-        The actual model call is run in a separate thread.
+        Failures are returned as an "Error: ..." message rather than raised; see generate().
+        """
+        try:
+            return await self.generate(prompt)
+        except GeminiServiceError as e:
+            return f"Error: {e}"
+
+    async def warmup(self) -> None:
+        """
+        Sends a tiny request so connection and auth setup happen at startup instead of
+        during the first user request. Failures are only logged.
+        Call it from the event loop that will serve requests: the library's async client
+        is shared process-wide and stays bound to the loop that first used it.
         """
-        logger.info(f"Generating text with model {self.model_name} for prompt: '{prompt[:70]}...'")
+        logger.info("Warming up the Gemini client...")
+        try:
+            await self.generate("ping")
+        except GeminiServiceError as e:
+            logger.warning(f"Gemini warmup request failed: {e}")
+            return
+        logger.info("Gemini client warmup finished.")
+
+    @staticmethod
+    def _response_text(response, prompt: str) -> str:
+        """Extracts the text of a generate_content response, raising GeminiServiceError if it has none."""
+        # Safer response parsing
+        if response.parts:
+            # Concatenate text from all parts
+            full_text = "".join(part.text for part in response.parts if hasattr(part, 'text'))
+            if full_text:
+                logger.info("Gemini generated text successfully (from parts). Length: %d", len(full_text))
+                return full_text
+        
+        # Fallback to response.text if parts are empty but text attribute exists
+        if hasattr(response, 'text') and response.text:
+            logger.info("Gemini generated text successfully (from .text attribute). Length: %d", len(response.text))
+            return response.text
+
+        # Handle cases like blocked prompts or no content
+        logger.warning("Gemini response for prompt '%.70s...' had no usable text parts or was blocked.", prompt)
+        if hasattr(response, 'prompt_feedbacks') and response.prompt_feedbacks:
+            for feedback in response.prompt_feedbacks:
+                # Log the feedback. Actual structure of feedback might vary.
+                logger.warning("Prompt Feedback: %s", feedback)
+        raise GeminiServiceError("LLM returned no usable content or request was blocked.")
+
+    async def generate_text_stream(self, prompt: str) -> AsyncIterator[str]:
+        """
+        Generates text using the configured Gemini model, yielding text chunks as they arrive
+        so callers can show the start of the response before generation finishes.
+        Raises:
+            GeminiServiceError: Like generate(); possibly after some chunks were already yielded.
+        """
+        logger.info("Streaming text with model %s for prompt: '%.70s...'", self.model_name, prompt)
         if not self.client:
             logger.error("Gemini client not initialized. Cannot generate text.")
-            return "Error: Gemini client not initialized."
+            raise GeminiServiceError("Gemini client not initialized.")
         try:
-            # self.client.generate_content is a synchronous (blocking) call
-            response = await asyncio.to_thread(self.client.generate_content, prompt)
-            
-            # Safer response parsing
-            if response.parts:
-                # Concatenate text from all parts
-                full_text = "".join(part.text for part in response.parts if hasattr(part, 'text'))
-                if full_text:
-                    logger.info(f"Gemini generated text successfully (from parts). Length: {len(full_text)}")
-                    return full_text
-            
-            # Fallback to response.text if parts are empty but text attribute exists
-            if hasattr(response, 'text') and response.text:
-                logger.info(f"Gemini generated text successfully (from .text attribute). Length: {len(response.text)}")
-                return response.text
-
-            # Handle cases like blocked prompts or no content
-            logger.warning(f"Gemini response for prompt '{prompt[:70]}...' had no usable text parts or was blocked.")
-            if hasattr(response, 'prompt_feedbacks') and response.prompt_feedbacks:
-                for feedback in response.prompt_feedbacks:
-                    # Log the feedback. Actual structure of feedback might vary.
-                    logger.warning(f"Prompt Feedback: {feedback}") 
-            return "Error: LLM returned no usable content or request was blocked."
-            
+            response = await self.client.generate_content_async(prompt, stream=True)
+            yielded_any = False
+            async for chunk in response:
+                text = "".join(part.text for part in chunk.parts if hasattr(part, 'text'))
+                if text:
+                    yielded_any = True
+                    yield text
         except Exception as e:
-            logger.error(f"Error during Gemini text generation: {e}", exc_info=True)
-            return f"Error: LLM call failed - {str(e)}"
+            logger.error(f"Error during Gemini text streaming: {e}", exc_info=True)
+            raise GeminiServiceError(f"LLM call failed - {str(e)}") from e
+        if not yielded_any:
+            logger.warning("Gemini stream for prompt '%.70s...' had no usable text parts or was blocked.", prompt)
+            raise GeminiServiceError("LLM returned no usable content or request was blocked.")
 
+# Process-wide GeminiService, shared by every agent and tool so the Gemini client
+# (credentials, transport) is set up only once.
+_global_service: Optional[GeminiService] = None
+_global_service_lock = asyncio.Lock()
+
+async def get_gemini_service() -> GeminiService:
+    """
+    Returns the shared GeminiService, creating it on first use.
+    Concurrent first callers wait on a lock, so only one instance is ever built.
+    Returns:
+        GeminiService: The shared service instance.
+    Raises:
+        RuntimeError: If the service fails to initialize (see GeminiService.__init__).
+    """
+    global _global_service
+    if _global_service is not None:
+        return _global_service
+    async with _global_service_lock:
+        if _global_service is None:
+            # Client setup does blocking I/O (credentials lookup), so keep it off the event loop.
+            _global_service = await asyncio.to_thread(GeminiService)
+    return _global_service
 
 async def run_gemini_service_test():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -5,38 +5,192 @@ import torch
 from transformers import BlipProcessor, BlipForConditionalGeneration
 import asyncio # For asyncio.to_thread
 import os # For path operations
+import hashlib
+import random
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    # Optional: exports BLIP to ONNX and runs it with ONNX Runtime (pip install optimum[onnxruntime]).
+    from optimum.onnxruntime import ORTModelForVision2Seq
+except ImportError:
+    ORTModelForVision2Seq = None
 
 logger = logging.getLogger(__name__)
 
+# Number of captions remembered by image content, so resubmitted images skip BLIP entirely.
+CAPTION_CACHE_MAX_ENTRIES = 256
+
+# Micro-batching of concurrent caption requests (see ImageService.submit): a batch is sent
+# to the model once it has CAPTION_MAX_BATCH images or its first image has waited CAPTION_MAX_WAIT_MS.
+CAPTION_MAX_BATCH = 8
+CAPTION_MAX_WAIT_MS = 20
+
+BLIP_MODEL_NAME = "Salesforce/blip-image-captioning-base"
+
+# Greedy decoding of a short caption: the caption only feeds the LLM judge, so beam search
+# is not worth its extra decoder passes. min_length avoids degenerate empty captions.
+CAPTION_GENERATE_KWARGS = {"max_length": 30, "min_length": 5, "num_beams": 1, "do_sample": False}
+
+# Side length of the square images the BLIP processor produces.
+BLIP_IMAGE_SIZE = 384
+
+# Larger inputs (e.g. phone photos) are shrunk to fit this size with a cheap bilinear
+# thumbnail before the processor's own, much slower, bicubic resize to BLIP_IMAGE_SIZE.
+MAX_INPUT_IMAGE_SIZE = 512
+
+# Fraction of model calls after which the CUDA caching allocator is trimmed. Doing it on every
+# call would stall the GPU; never doing it lets fragmentation build up on a long-running server.
+CUDA_EMPTY_CACHE_PROBABILITY = 0.01
+
+# Messages returned in place of a caption when captioning fails. Callers check membership
+# in CAPTION_FAILURE_MESSAGES rather than searching captions for error text.
+CAPTION_GENERATION_ERROR = "Error generating image caption."
+CAPTION_MODEL_UNAVAILABLE = "Error: Image captioning model not available."
+CAPTION_NO_IMAGE = "Error: No image provided for captioning."
+CAPTION_ASYNC_ERROR = "Error during async caption processing."
+CAPTION_FAILURE_MESSAGES = frozenset({
+    CAPTION_GENERATION_ERROR, CAPTION_MODEL_UNAVAILABLE, CAPTION_NO_IMAGE, CAPTION_ASYNC_ERROR,
+})
+
+# BLIP processor/model pairs shared by every ImageService, keyed by (device, quantized, compiled, onnx),
+# so constructing another service does not load a second copy of the weights.
+_BLIP_MODELS: Dict[Tuple[str, bool, bool, bool], Tuple[Any, Any]] = {}
+_BLIP_MODELS_LOCK = threading.Lock()
+
+def _quantize_dynamic(model):
+    """
+    Returns the model with its nn.Linear layers dynamically quantized to int8,
+    or the unchanged model if quantization is not supported on this platform.
+    """
+    try:
+        quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info("Applied dynamic int8 quantization to the BLIP model for CPU inference.")
+        return quantized
+    except Exception as e:
+        logger.warning(f"Dynamic int8 quantization failed, using the fp32 model: {e}")
+        return model
+
+def _compile_vision_encoder(model, device: str):
+    """
+    Compiles the model's vision encoder with torch.compile and runs it once, so compilation
+    happens at startup rather than on the first request. The encoder always sees fixed-size
+    images, which suits compilation; the text decoder's growing sequence length does not, so
+    it is left eager. Returns the model unchanged if compilation fails.
+    """
+    vision_model = model.vision_model
+    try:
+        model.vision_model = torch.compile(vision_model, mode="reduce-overhead")
+        dtype = next(model.parameters()).dtype
+        with torch.inference_mode():
+            model.vision_model(pixel_values=torch.zeros(1, 3, BLIP_IMAGE_SIZE, BLIP_IMAGE_SIZE, device=device, dtype=dtype))
+        logger.info("Compiled the BLIP vision encoder with torch.compile.")
+    except Exception as e:
+        model.vision_model = vision_model
+        logger.warning(f"torch.compile of the BLIP vision encoder failed, running it eagerly: {e}")
+    return model
+
+def _load_onnx_model(cache_dir: str, device: str):
+    """
+    Exports BLIP to ONNX (once; optimum caches the export) and loads it into ONNX Runtime,
+    whose fused attention kernels and lack of PyTorch dispatch overhead speed up inference.
+    Returns None if optimum/onnxruntime is not installed or the export fails.
+    """
+    if ORTModelForVision2Seq is None:
+        logger.warning("ONNX Runtime requested but optimum[onnxruntime] is not installed; using PyTorch.")
+        return None
+    provider = "CUDAExecutionProvider" if device == "cuda" else "CPUExecutionProvider"
+    try:
+        model = ORTModelForVision2Seq.from_pretrained(BLIP_MODEL_NAME, export=True, cache_dir=cache_dir, provider=provider)
+        logger.info(f"Loaded the BLIP model into ONNX Runtime ({provider}).")
+        return model
+    except Exception as e:
+        logger.warning(f"ONNX export of the BLIP model failed, using PyTorch: {e}")
+        return None
+
+def _get_blip(device: str, quantize_cpu: bool, compile_model: bool = False, use_onnx: bool = False) -> Tuple[Any, Any]:
+    """
+    Returns the shared BLIP (processor, model) for the device, loading it on first use.
+    Args:
+        device: "cuda" or "cpu".
+        quantize_cpu: Whether a CPU model should be int8-quantized.
+        compile_model: Whether to compile the vision encoder with torch.compile.
+        use_onnx: Whether to run the model with ONNX Runtime (falls back to PyTorch if unavailable).
+    Returns:
+        Tuple[Any, Any]: The BlipProcessor and the BlipForConditionalGeneration (or ONNX Runtime) model.
+    Raises:
+        Exception: Whatever from_pretrained raises if the weights cannot be loaded; nothing is cached then.
+    """
+    key = (device, device == "cpu" and quantize_cpu, compile_model, use_onnx)
+    with _BLIP_MODELS_LOCK:
+        if key in _BLIP_MODELS:
+            logger.info("Reusing the already loaded BLIP model and processor.")
+            return _BLIP_MODELS[key]
+
+        # Using a local cache directory within the app for Hugging Face models
+        # This can be beneficial in environments where the default cache is not writable or persistent.
+        # Assuming this script is in app/services/image_service.py
+        # project_root/app/services/ -> project_root/app/ -> project_root/
+        base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        cache_dir = os.path.join(base_dir, 'hf_cache') # Store cache in project_root/hf_cache
+        os.makedirs(cache_dir, exist_ok=True)
+        logger.info(f"Using Hugging Face cache directory: {cache_dir}")
+
+        processor = BlipProcessor.from_pretrained(BLIP_MODEL_NAME, cache_dir=cache_dir)
+        if use_onnx:
+            model = _load_onnx_model(cache_dir, device)
+            if model is not None:
+                _BLIP_MODELS[key] = (processor, model)
+                return processor, model
+        # On GPU the weights are loaded straight into fp16, never materializing an fp32 copy.
+        dtype = torch.float16 if device == "cuda" else torch.float32
+        model = BlipForConditionalGeneration.from_pretrained(BLIP_MODEL_NAME, cache_dir=cache_dir, torch_dtype=dtype).to(device)
+        model.eval() # Inference only: disables dropout.
+        if device == "cpu" and quantize_cpu:
+            model = _quantize_dynamic(model)
+        if compile_model:
+            model = _compile_vision_encoder(model, device)
+        logger.info("BLIP model and processor loaded successfully using local cache.")
+        _BLIP_MODELS[key] = (processor, model)
+        return processor, model
+
 class ImageService:
     """
     Service for handling image-related operations, primarily caption generation.
-    The BLIP model is loaded upon instantiation.
+    The BLIP model is loaded by the first instantiation and shared with later ones.
     """
-    def __init__(self):
+    def __init__(self, quantize_cpu: bool = True, compile_model: bool = False, use_onnx: bool = False):
         """
-        Initializes the ImageService, loading the BLIP model and processor.
+        Initializes the ImageService, loading the BLIP model and processor (or reusing the shared ones).
+        Args:
+            quantize_cpu: On CPU, apply dynamic int8 quantization to the model's linear layers,
+                which speeds up generation at a small cost in caption quality.
+            compile_model: Compile the vision encoder with torch.compile. Off by default, since
+                compilation adds tens of seconds to startup and needs a working compiler toolchain.
+            use_onnx: Run BLIP with ONNX Runtime instead of PyTorch (requires optimum[onnxruntime];
+                the first start exports the model). quantize_cpu and compile_model only apply to the PyTorch model.
         """
         logger.info("Initializing ImageService and loading BLIP model...")
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         logger.info(f"ImageService will use device: {self.device}")
+        # Half precision on GPU halves weight memory traffic; CPUs gain little from fp16, so keep fp32 there.
+        self.dtype = torch.float16 if self.device == "cuda" else torch.float32
         
         self.processor = None
         self.model = None
+        # Captions keyed by a hash of the RGB pixel data. Captioning runs in worker threads, hence the lock.
+        self._caption_cache: "OrderedDict[bytes, str]" = OrderedDict()
+        self._caption_cache_lock = threading.Lock()
+        # Created lazily on first submit(), since they must belong to the running event loop.
+        self._submit_queue: Optional[asyncio.Queue] = None
+        self._batcher_task: Optional[asyncio.Task] = None
 
         try:
-            # Using a local cache directory within the app for Hugging Face models
-            # This can be beneficial in environments where the default cache is not writable or persistent.
-            # Assuming this script is in app/services/image_service.py
-            # project_root/app/services/ -> project_root/app/ -> project_root/
-            base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-            cache_dir = os.path.join(base_dir, 'hf_cache') # Store cache in project_root/hf_cache
-            os.makedirs(cache_dir, exist_ok=True)
-            logger.info(f"Using Hugging Face cache directory: {cache_dir}")
-
-            self.processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base", cache_dir=cache_dir)
-            self.model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base", cache_dir=cache_dir).to(self.device)
-            logger.info("BLIP model and processor loaded successfully using local cache.")
+            self.processor, self.model = _get_blip(self.device, quantize_cpu, compile_model, use_onnx)
+            if ORTModelForVision2Seq is not None and isinstance(self.model, ORTModelForVision2Seq):
+                # The exported graph takes fp32 inputs, also on GPU.
+                self.dtype = torch.float32
         except Exception as e:
             logger.error(f"Error loading BLIP model: {e}", exc_info=True)
             # Model and processor remain None if loading fails
@@ -44,32 +198,252 @@ class ImageService:
             # Optionally, could raise RuntimeError here if model is critical for app to even start.
             # raise RuntimeError(f"Failed to load BLIP model: {e}")
 
-    def _blocking_generate_caption(self, image_pil: Image.Image) -> str:
+    @staticmethod
+    def _prepare_image(image_pil: Image.Image) -> Image.Image:
         """
-        The actual blocking (synchronous) caption generation logic.
+        Returns the image shrunk to at most MAX_INPUT_IMAGE_SIZE per side and in RGB mode.
+        The caller's image is never modified.
+        """
+        if max(image_pil.size) > MAX_INPUT_IMAGE_SIZE:
+            image_pil = image_pil.copy()
+            image_pil.thumbnail((MAX_INPUT_IMAGE_SIZE, MAX_INPUT_IMAGE_SIZE), Image.Resampling.BILINEAR)
+        if image_pil.mode != "RGB":
+            logger.info("Image is not in RGB mode, converting to RGB.")
+            image_pil = image_pil.convert("RGB")
+        return image_pil
+
+    def warmup(self) -> None:
+        """
+        Captions one blank image and discards the result, so one-off costs (CUDA context and
+        kernel setup, allocator growth) are paid at startup instead of by the first user.
         """
         if not self.model or not self.processor:
-            logger.error("ImageService model/processor not loaded. Cannot generate caption.")
-            return "Error: Image captioning model not available."
-        
-        if image_pil is None:
-            logger.warning("Image is None, cannot generate caption.") # Logged in previous version
-            return "Error: No image provided for captioning." # Changed from "Error: No image provided." for clarity
+            logger.warning("ImageService model/processor not loaded; skipping warmup.")
+            return
+        logger.info("Warming up the BLIP model...")
+        self._blocking_generate_caption(Image.new("RGB", (BLIP_IMAGE_SIZE, BLIP_IMAGE_SIZE)))
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+        logger.info("BLIP model warmup finished.")
+
+    def _to_device(self, inputs):
+        """
+        Moves processor outputs to the model's device, casting floating point tensors to its dtype.
+        On CUDA the tensors are pinned first, so the host-to-device copy runs asynchronously.
+        """
+        if self.device != "cuda":
+            return inputs.to(self.device, dtype=self.dtype)
+        for name, tensor in inputs.items():
+            inputs[name] = tensor.pin_memory()
+        return inputs.to(self.device, dtype=self.dtype, non_blocking=True)
 
+    def preprocess_many(self, images: List[Image.Image]):
+        """
+        Runs the BLIP processor once over all the images and moves the result to the model's device.
+        One processor call resizes and normalizes the whole list into a single batched
+        pixel_values tensor, instead of a separate processor pass per image.
+        Args:
+            images: Prepared (RGB, see _prepare_image) images.
+        Returns:
+            The processor outputs on the model's device, ready for model.generate(**inputs).
+        """
+        return self._to_device(self.processor(images=images, return_tensors="pt"))
+
+    @staticmethod
+    def _image_key(image_pil: Image.Image) -> bytes:
+        """Returns a content hash of an RGB image, including its size so reshaped pixel data cannot collide."""
+        digest = hashlib.blake2b(repr(image_pil.size).encode("ascii"), digest_size=16)
+        digest.update(image_pil.tobytes())
+        return digest.digest()
+
+    def _cached_caption(self, key: bytes) -> Optional[str]:
+        with self._caption_cache_lock:
+            caption = self._caption_cache.get(key)
+            if caption is not None:
+                self._caption_cache.move_to_end(key)
+            return caption
+
+    def _cache_caption(self, key: bytes, caption: str) -> None:
+        with self._caption_cache_lock:
+            self._caption_cache[key] = caption
+            self._caption_cache.move_to_end(key)
+            while len(self._caption_cache) > CAPTION_CACHE_MAX_ENTRIES:
+                self._caption_cache.popitem(last=False)
+
+    def _release_cuda_memory(self) -> None:
+        """
+        Occasionally returns cached, unused CUDA blocks to the driver; called right after the
+        caption tensors are dropped so they are among the blocks released.
+        """
+        if self.device == "cuda" and random.random() < CUDA_EMPTY_CACHE_PROBABILITY:
+            torch.cuda.empty_cache()
+
+    def _blocking_generate_caption(self, image_pil: Image.Image) -> str:
+        """
+        The actual blocking (synchronous) caption generation logic.
+        Expects a loaded model and an image; generate_caption checks both before dispatching
+        here, so invalid requests never take a thread-pool round trip. Image conversion stays
+        here, off the event loop.
+        """
         try:
-            logger.info(f"Processing image for caption generation (mode: {image_pil.mode}).") # Added image mode log
-            if image_pil.mode != "RGB":
-                logger.info("Image is not in RGB mode, converting to RGB.")
-                image_pil = image_pil.convert("RGB")
+            logger.info("Processing image for caption generation (mode: %s).", image_pil.mode) # Added image mode log
+            image_pil = self._prepare_image(image_pil)
+
+            key = self._image_key(image_pil)
+            caption = self._cached_caption(key)
+            if caption is not None:
+                logger.info("Caption cache hit; skipping model inference.")
+                return caption
                 
-            inputs = self.processor(images=image_pil, return_tensors="pt").to(self.device)
-            out = self.model.generate(**inputs, max_length=50) 
+            inputs = self.preprocess_many([image_pil])
+            with torch.inference_mode():
+                out = self.model.generate(**inputs, **CAPTION_GENERATE_KWARGS)
             caption = self.processor.decode(out[0], skip_special_tokens=True)
-            logger.info(f"Caption generated successfully (length: {len(caption)}).")
+            del inputs, out, image_pil
+            self._release_cuda_memory()
+            logger.info("Caption generated successfully (length: %d).", len(caption))
+            self._cache_caption(key, caption)
             return caption
         except Exception as e:
             logger.error(f"Error during blocking caption generation: {e}", exc_info=True) # More specific log
-            return "Error generating image caption."
+            return CAPTION_GENERATION_ERROR
+
+    def _blocking_generate_captions_batch(self, images: List[Image.Image]) -> List[str]:
+        """
+        Blocking caption generation for several images in a single BLIP forward pass.
+        Like _blocking_generate_caption, expects inputs already validated by the async wrapper.
+        """
+        try:
+            logger.info("Processing batch of %d images for caption generation.", len(images))
+            rgb_images = [self._prepare_image(image) for image in images]
+            keys = [self._image_key(image) for image in rgb_images]
+            captions = [self._cached_caption(key) for key in keys]
+
+            # Only images with neither a cached caption nor an identical image earlier in the batch go to the model.
+            pending = {}
+            for i, (key, caption) in enumerate(zip(keys, captions)):
+                if caption is None and key not in pending:
+                    pending[key] = rgb_images[i]
+            if pending:
+                inputs = self.preprocess_many(list(pending.values()))
+                with torch.inference_mode():
+                    out = self.model.generate(**inputs, **CAPTION_GENERATE_KWARGS)
+                for key, caption in zip(pending, self.processor.batch_decode(out, skip_special_tokens=True)):
+                    self._cache_caption(key, caption)
+                    pending[key] = caption
+                del inputs, out, rgb_images
+                self._release_cuda_memory()
+                captions = [caption if caption is not None else pending[key] for key, caption in zip(keys, captions)]
+            logger.info("Batch of %d captions generated successfully (%d by the model).", len(captions), len(pending))
+            return captions
+        except Exception as e:
+            logger.error(f"Error during blocking batch caption generation: {e}", exc_info=True)
+            return [CAPTION_GENERATION_ERROR] * len(images)
+
+    async def generate_captions_batch(self, images: List[Optional[Image.Image]]) -> List[str]:
+        """
+        Generates captions for several PIL images with one batched model call, which is
+        considerably cheaper than captioning them one by one.
+        The model inference is run in a separate thread to avoid blocking the event loop.
+        Args:
+            images: The images to caption.
+        Returns:
+            List[str]: One caption (or error message) per input image, in input order.
+        """
+        logger.info("Async generate_captions_batch called for %d images.", len(images))
+        if not self.model or not self.processor:
+            logger.error("ImageService model/processor not loaded. Cannot generate captions.")
+            return [CAPTION_MODEL_UNAVAILABLE] * len(images)
+        captions = [CAPTION_NO_IMAGE] * len(images)
+        present = [i for i, image in enumerate(images) if image is not None]
+        if len(present) < len(images):
+            logger.warning("Some images are None, captioning only the provided ones.")
+        if not present:
+            return captions
+
+        try:
+            batch_captions = await asyncio.to_thread(self._blocking_generate_captions_batch, [images[i] for i in present])
+        except Exception as e:
+            logger.error(f"Unexpected error in async generate_captions_batch wrapper: {e}", exc_info=True)
+            batch_captions = [CAPTION_ASYNC_ERROR] * len(present)
+        for i, caption in zip(present, batch_captions):
+            captions[i] = caption
+        return captions
+
+    async def submit(self, image_pil: Image.Image) -> str:
+        """
+        Generates a caption for the image through the shared micro-batcher: requests arriving
+        close together (from any session) are captioned in one batched model call.
+        Args:
+            image_pil: The image to caption.
+        Returns:
+            str: The caption, or an error message.
+        """
+        if not self.model or not self.processor:
+            logger.error("ImageService model/processor not loaded. Cannot generate caption.")
+            return CAPTION_MODEL_UNAVAILABLE
+        if image_pil is None:
+            logger.warning("Image is None, cannot generate caption.")
+            return CAPTION_NO_IMAGE
+
+        if self._submit_queue is None:
+            self._submit_queue = asyncio.Queue()
+        if self._batcher_task is None or self._batcher_task.done():
+            self._batcher_task = asyncio.create_task(self._caption_batcher())
+            logger.info("Started caption micro-batcher.")
+        future = asyncio.get_running_loop().create_future()
+        await self._submit_queue.put((image_pil, future))
+        return await future
+
+    async def _caption_batcher(self) -> None:
+        """
+        Collects submitted images into batches and resolves each submitter's future with its caption.
+        When cancelled, fails the batch in progress and every queued submission with
+        CAPTION_ASYNC_ERROR, so no submitter is left waiting.
+        """
+        loop = asyncio.get_running_loop()
+        batch: List[Tuple[Image.Image, asyncio.Future]] = []
+        try:
+            while True:
+                batch = [await self._submit_queue.get()]
+                deadline = loop.time() + CAPTION_MAX_WAIT_MS / 1000
+                while len(batch) < CAPTION_MAX_BATCH:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._submit_queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                logger.info("Caption micro-batcher dispatching %d images.", len(batch))
+                try:
+                    captions = await asyncio.to_thread(self._blocking_generate_captions_batch, [image for image, _ in batch])
+                except Exception as e:
+                    logger.error(f"Unexpected error in caption micro-batcher: {e}", exc_info=True)
+                    captions = [CAPTION_ASYNC_ERROR] * len(batch)
+                for (_, future), caption in zip(batch, captions):
+                    if not future.done(): # The submitter may have been cancelled meanwhile.
+                        future.set_result(caption)
+                batch = []
+        except asyncio.CancelledError:
+            while not self._submit_queue.empty():
+                batch.append(self._submit_queue.get_nowait())
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(CAPTION_ASYNC_ERROR)
+            logger.info("Caption micro-batcher stopped; failed %d pending submissions.", len(batch))
+            raise
+
+    async def stop_caption_batcher(self) -> None:
+        """Cancels the background micro-batcher task, if running, failing its pending submissions."""
+        task, self._batcher_task = self._batcher_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
 
     async def generate_caption(self, image_pil: Image.Image) -> str:
         """
@@ -77,19 +451,20 @@ class ImageService:
         The actual model inference is run in a separate thread to avoid blocking the event loop.
         """
         logger.info("Async generate_caption called.")
-        if not self.model or not self.processor: # Early exit if model isn't loaded
-            logger.error("ImageService model/processor not loaded (checked in async wrapper). Cannot generate caption.")
-            return "Error: Image captioning model not available."
-        if image_pil is None: # Handle None image input directly in async wrapper too
-            logger.warning("Image is None (checked in async wrapper), cannot generate caption.")
-            return "Error: No image provided for captioning."
+        # All input validation happens here, before paying for the thread-pool hop.
+        if not self.model or not self.processor:
+            logger.error("ImageService model/processor not loaded. Cannot generate caption.")
+            return CAPTION_MODEL_UNAVAILABLE
+        if image_pil is None:
+            logger.warning("Image is None, cannot generate caption.")
+            return CAPTION_NO_IMAGE
             
         try:
             caption = await asyncio.to_thread(self._blocking_generate_caption, image_pil)
             return caption
         except Exception as e: 
             logger.error(f"Unexpected error in async generate_caption wrapper: {e}", exc_info=True)
-            return "Error during async caption processing."
+            return CAPTION_ASYNC_ERROR
 
 
 if __name__ == '__main__':
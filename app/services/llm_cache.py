@@ -0,0 +1,276 @@
+# app/services/llm_cache.py
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.config import get_llm_cache_path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_MAX_ENTRIES = 4096
+DEFAULT_CACHE_TTL_SECONDS = 3600
+
+# Minimum cosine similarity between request embeddings for a semantic cache hit.
+DEFAULT_SEMANTIC_THRESHOLD = 0.92
+DEFAULT_SEMANTIC_MAX_ENTRIES = 1024
+
+
+class ResponseCache:
+    """
+    Bounded, TTL-based in-memory cache for LLM responses.
+
+    Tier 1 is keyed by a hash of the final prompt text.
+    Tier 2 is keyed by the template id plus the normalized slot values that were
+    rendered into the template, so trivially different inputs (case, surrounding
+    whitespace) still reuse a previous response.
+
+    With a path, entries are also written to a SQLite file and read back on in-memory
+    misses, so the cache stays warm across process restarts. The file is opened on first
+    use. SQLite calls block, so async callers use aget/aset, which run them in a worker thread.
+    """
+    def __init__(self, max_entries: int = DEFAULT_CACHE_MAX_ENTRIES, ttl_seconds: float = DEFAULT_CACHE_TTL_SECONDS,
+                 path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self._exact: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
+        self._by_slots: "OrderedDict[Tuple, Tuple[float, str]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        # Serializes SQLite access, which happens in worker threads for aget/aset.
+        self._db_lock = threading.Lock()
+
+    @staticmethod
+    def _open_db(path: str) -> sqlite3.Connection:
+        db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # WAL with synchronous=NORMAL keeps each write to a cheap append, without an fsync.
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS responses (key BLOB PRIMARY KEY, expires_at REAL NOT NULL, response TEXT NOT NULL)")
+        db.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+        logger.info(f"Persistent LLM response cache opened at {path}.")
+        return db
+
+    def _connection(self) -> sqlite3.Connection:
+        """The SQLite connection, opened on first use. Call with _db_lock held."""
+        if self._db is None:
+            self._db = self._open_db(self.path)
+        return self._db
+
+    @staticmethod
+    def _prompt_key(prompt: str) -> bytes:
+        return hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).digest()
+
+    @staticmethod
+    def _slots_key(template_id: str, slots: Dict[str, Any]) -> Tuple:
+        normalized = tuple(
+            (name, " ".join(str(value).lower().split())) for name, value in sorted(slots.items())
+        )
+        return (template_id, normalized)
+
+    @staticmethod
+    def _db_key(store_name: bytes, key) -> bytes:
+        """The SQLite key of an entry: the tier name plus a digest of its in-memory key."""
+        return store_name + hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).digest()
+
+    def _tiers(self, prompt: str, template_id: Optional[str], slots: Optional[Dict[str, Any]]) -> List[Tuple[OrderedDict, bytes, Any]]:
+        """The (store, store name, key) of each tier the request is cached under, tier 1 first."""
+        tiers = [(self._exact, b"p", self._prompt_key(prompt))]
+        if template_id is not None and slots:
+            tiers.append((self._by_slots, b"s", self._slots_key(template_id, slots)))
+        return tiers
+
+    def _lookup_memory(self, store: OrderedDict, key) -> Optional[str]:
+        entry = store.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at < time.monotonic():
+            del store[key]
+            return None
+        store.move_to_end(key)
+        return response
+
+    def _remember(self, store: OrderedDict, key, response: str, ttl_seconds: float) -> None:
+        store[key] = (time.monotonic() + ttl_seconds, response)
+        store.move_to_end(key)
+        while len(store) > self.max_entries:
+            store.popitem(last=False)
+
+    def _read_db(self, tiers: List[Tuple[OrderedDict, bytes, Any]]) -> Optional[Tuple[OrderedDict, Any, float, str]]:
+        """Blocking: the first live SQLite entry of the tiers, as (store, key, remaining seconds, response)."""
+        with self._db_lock:
+            db = self._connection()
+            for store, store_name, key in tiers:
+                row = db.execute(
+                    "SELECT expires_at, response FROM responses WHERE key = ?", (self._db_key(store_name, key),)
+                ).fetchone()
+                if row is not None and row[0] > time.time():
+                    return store, key, row[0] - time.time(), row[1]
+        return None
+
+    def _write_db(self, tiers: List[Tuple[OrderedDict, bytes, Any]], response: str) -> None:
+        """Blocking: writes the response to SQLite under every tier's key."""
+        expires_at = time.time() + self.ttl_seconds
+        with self._db_lock:
+            self._connection().executemany(
+                "INSERT OR REPLACE INTO responses (key, expires_at, response) VALUES (?, ?, ?)",
+                [(self._db_key(store_name, key), expires_at, response) for _, store_name, key in tiers],
+            )
+
+    def _lookup(self, tiers: List[Tuple[OrderedDict, bytes, Any]]) -> Optional[str]:
+        for store, _, key in tiers:
+            response = self._lookup_memory(store, key)
+            if response is not None:
+                return response
+        return None
+
+    def _from_db(self, found: Optional[Tuple[OrderedDict, Any, float, str]]) -> Optional[str]:
+        if found is None:
+            return None
+        store, key, remaining, response = found
+        # Keep it in memory for the rest of its lifetime, so later hits skip SQLite.
+        self._remember(store, key, response, remaining)
+        return response
+
+    def get(self, prompt: str, template_id: Optional[str] = None, slots: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """
+        Returns a cached response for the prompt (tier 1) or for the normalized
+        template slots (tier 2), or None on a miss. Blocks on SQLite on in-memory misses.
+        """
+        tiers = self._tiers(prompt, template_id, slots)
+        response = self._lookup(tiers)
+        if response is None and self.path is not None:
+            response = self._from_db(self._read_db(tiers))
+        return response
+
+    def set(self, prompt: str, response: str, template_id: Optional[str] = None, slots: Optional[Dict[str, Any]] = None) -> None:
+        tiers = self._tiers(prompt, template_id, slots)
+        for store, _, key in tiers:
+            self._remember(store, key, response, self.ttl_seconds)
+        if self.path is not None:
+            self._write_db(tiers, response)
+
+    async def aget(self, prompt: str, template_id: Optional[str] = None, slots: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Like get, but reads SQLite in a worker thread so the event loop is not blocked."""
+        tiers = self._tiers(prompt, template_id, slots)
+        response = self._lookup(tiers)
+        if response is None and self.path is not None:
+            response = self._from_db(await asyncio.to_thread(self._read_db, tiers))
+        return response
+
+    async def aset(self, prompt: str, response: str, template_id: Optional[str] = None, slots: Optional[Dict[str, Any]] = None) -> None:
+        """Like set, but writes SQLite in a worker thread so the event loop is not blocked."""
+        tiers = self._tiers(prompt, template_id, slots)
+        for store, _, key in tiers:
+            self._remember(store, key, response, self.ttl_seconds)
+        if self.path is not None:
+            await asyncio.to_thread(self._write_db, tiers, response)
+
+    def clear(self) -> None:
+        self._exact.clear()
+        self._by_slots.clear()
+        if self.path is not None:
+            with self._db_lock:
+                self._connection().execute("DELETE FROM responses")
+
+    def __len__(self) -> int:
+        return len(self._exact)
+
+
+class SemanticCache:
+    """
+    Bounded, TTL-based in-memory cache of LLM responses looked up by embedding similarity,
+    for requests whose free text is paraphrased between calls.
+
+    Entries are partitioned by an exact scope string (e.g. the challenge topic), so a
+    similar text under a different scope never matches. Each entry holds one embedding per
+    position (e.g. one per player's caption) and matches only when every position is similar
+    to the same position of the query, so reordered parts never match. Embeddings are
+    normalized on insert, making the inner product the cosine similarity.
+    """
+    def __init__(self, threshold: float = DEFAULT_SEMANTIC_THRESHOLD, max_entries: int = DEFAULT_SEMANTIC_MAX_ENTRIES,
+                 ttl_seconds: float = DEFAULT_CACHE_TTL_SECONDS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # Oldest first: (expires_at, scope, unit embeddings of shape (positions, dims), response).
+        self._entries: List[Tuple[float, str, np.ndarray, str]] = []
+
+    @staticmethod
+    def _normalize(embeddings: Sequence[Sequence[float]]) -> np.ndarray:
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    def _live_entries(self) -> List[Tuple[float, str, np.ndarray, str]]:
+        now = time.monotonic()
+        self._entries = [entry for entry in self._entries if entry[0] >= now]
+        return self._entries
+
+    def has_scope(self, scope: str) -> bool:
+        """Whether any live entry belongs to the scope, i.e. whether a lookup there could hit at all."""
+        return any(entry[1] == scope for entry in self._live_entries())
+
+    def get(self, scope: str, embeddings: Sequence[Sequence[float]]) -> Optional[str]:
+        """
+        Returns the response of the most similar live entry in the scope whose every position
+        reaches the threshold against the same position of embeddings, or None.
+        """
+        query = self._normalize(embeddings)
+        candidates = [entry for entry in self._live_entries() if entry[1] == scope and entry[2].shape == query.shape]
+        if not candidates:
+            return None
+        # An entry scores as its least similar position.
+        scores = (np.stack([entry[2] for entry in candidates]) * query).sum(axis=-1).min(axis=-1)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        return candidates[best][3]
+
+    def set(self, scope: str, embeddings: Sequence[Sequence[float]], response: str) -> None:
+        self._entries.append((time.monotonic() + self.ttl_seconds, scope, self._normalize(embeddings), response))
+        del self._entries[:-self.max_entries]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_default_cache = ResponseCache(path=get_llm_cache_path())
+
+
+async def cached_generate(gemini_service, prompt: str, template_id: str, slots: Dict[str, Any],
+                          cache: Optional[ResponseCache] = None) -> str:
+    """
+    Returns a cached response for the prompt if one exists, otherwise awaits
+    gemini_service.generate and caches the result.
+
+    Args:
+        gemini_service: Any object exposing `async generate(prompt)` (see GeminiService.generate).
+        prompt: The fully rendered prompt.
+        template_id: Identifier of the prompt template the prompt was rendered from.
+        slots: The values rendered into the template.
+        cache: The cache to use. Defaults to the process-wide cache.
+    Returns:
+        str: The model response (cached or fresh).
+    Raises:
+        GeminiServiceError: Propagated from gemini_service.generate; failures are never cached.
+    """
+    cache = _default_cache if cache is None else cache
+    cached = await cache.aget(prompt, template_id=template_id, slots=slots)
+    if cached is not None:
+        logger.info("LLM cache hit for template '%s'.", template_id)
+        return cached
+
+    response = await gemini_service.generate(prompt)
+    await cache.aset(prompt, response, template_id=template_id, slots=slots)
+    return response
@@ -1,25 +1,178 @@
-from openai import OpenAI, APIError 
-from app.config import get_openai_api_key
+from openai import AsyncOpenAI, APIConnectionError, APIError, APITimeoutError, InternalServerError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from app.config import get_llm_cache_path, get_llm_max_concurrency, get_openai_api_key
+from app.services.llm_cache import ResponseCache, SemanticCache
+import asyncio
+import functools
+import httpx
+import json
 import logging
+import string
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, NamedTuple, Optional, Tuple, Union
 
 logger = logging.getLogger(__name__)
 
+# httpx speaks HTTP/2 only when the h2 package is installed (pip install httpx[http2]).
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+class LLMError(Exception):
+    """Raised by LLMService when the OpenAI request fails or returns no content."""
+
+
+# Connection pool of the shared OpenAI client; kept-alive connections skip the TCP/TLS handshake.
+OPENAI_MAX_CONNECTIONS = 100
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 50
+
+OPENAI_MODEL = "gpt-4o-mini"
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+_EVALUATION_TEMPLATE_ID = "openai_evaluation"
+
+# Prompts are built once at import; per call only the variable parts are filled in.
+# Each request starts with a long static prefix (system message, instructions) and ends with
+# the variable data, so the provider's prompt-prefix cache can reuse the shared part.
+_TOPIC_SYSTEM_MESSAGE = "אתה מומחה ביצירת בעברית אתגרים המפעילים חשיבה ויצירתיות"
+_TOPIC_PROMPT_TEMPLATE = string.Template(
+    "צור אתגרים יצירתיים ומחשבתיים שונים זה מזה, כל אחד לאדם אחד. כל אתגר צריך לדרוש שימוש בחפצים נפוצים הנמצאים בדרך כלל בבית. "
+    "חשוב שההוראות בכל אתגר יהיו ברורות לחלוטין ויסבירו בדיוק מה על המשתתף ליצור או לעשות כך שניתן יהיה לצלם תמונה ולהוכיח עמידה באתגר. "
+    "כל אתגר צריך להיות קל לביצוע מעשי, אך מעניין ומפעיל את הדמיון. "
+    "נסח כל אתגר בשורה אחת או שתיים, בשפה העברית. "
+    'החזר אובייקט JSON בצורה {"challenges": ["...", "..."]}.\n'
+    "מספר האתגרים: $n"
+)
+
+# The whole rubric and output format live in the system message, identical on every call;
+# the user message carries only the topic and the captions.
+_EVAL_SYSTEM_MESSAGE = (
+    "אתה מומחה בהשוואת תוצאות האתגרים בין מתחרים.\n"
+    "תקבל אתגר ותיאורים של תמונות שהוגשו כפתרונות לאתגר, תמונה אחת לכל מתחרה.\n"
+    "עבור כל תמונה, אנא ספק ציון מ-1 עד 10 המייצג את מידת ההצלחה בביצוע האתגר, בהתבסס על יצירתיות, בהירות וייצוג חזותי של הפתרון.\n"
+    "לאחר מכן, הכרז על התמונה הזוכה.\n"
+    "לבסוף, ספק הסבר קצר וקולע (עד שתי שורות) מדוע התמונה הזו נבחרה כמנצחת, תוך התמקדות בסיבה המרכזית להחלטה.\n\n"
+    "הפלט הרצוי בעברית ובפורמט הבא, עם שורת ציון לכל תמונה לפי הסדר:\n"
+    "תמונה [מספר התמונה] - ציון: [הציון כאן]/10\n"
+    "התמונה הזוכה היא: תמונה [מספר התמונה]\n"
+    "הסבר קצר לזכייה: [ההסבר הקצר כאן]"
+)
+# OpenAI caches prompt prefixes automatically. Its cache is per server, and requests with
+# the same prompt_cache_key are routed together, so evaluations keep hitting a warm prefix.
+# (The Anthropic-style cache_control marker is not part of the OpenAI API.)
+_EVAL_PROMPT_CACHE_KEY = "mission-challenge-evaluation"
+
+# Identical submissions need no judge; they are declared a draw without an API call.
+_IDENTICAL_SUBMISSIONS_VERDICT = "התיאורים של כל התמונות זהים, ולכן אין מנצח: התוצאה היא תיקו."
+# Longer captions are cut before they reach the prompt. BLIP captions are far shorter; the cap
+# only guards the token budget against unexpectedly long input.
+_EVAL_MAX_CAPTION_CHARS = 500
+
+# Topics requested per API call; generate_challenge_topic hands them out one at a time.
+TOPIC_BATCH_SIZE = 10
+
+# Sampling settings. Output lengths are capped near what the prompts ask for, since decode
+# time grows with every generated token: a topic is one or two lines, and an evaluation is
+# one score line per image plus a winner line and a short explanation.
+_TOPIC_SAMPLING = {"temperature": 0.9, "top_p": 0.95}
+_TOPIC_MAX_TOKENS_PER_TOPIC = 80
+_EVAL_SAMPLING = {"temperature": 0.3}
+_EVAL_MAX_TOKENS_BASE = 120
+_EVAL_MAX_TOKENS_PER_IMAGE = 40
+
+def _eval_max_tokens(num_images: int) -> int:
+    return _EVAL_MAX_TOKENS_BASE + _EVAL_MAX_TOKENS_PER_IMAGE * num_images
+
+# Evaluations shared by every LLMService; identical (topic, captions) requests skip the API call.
+_evaluation_cache = ResponseCache(path=get_llm_cache_path())
+# Evaluations of paraphrased captions under the same topic, matched by embedding similarity.
+_semantic_evaluation_cache = SemanticCache()
+
+def _request_key(model: str, messages: List[Dict[str, str]]) -> str:
+    """Canonical text of a chat request, used as its exact-match cache key."""
+    return json.dumps({"model": model, "messages": messages}, sort_keys=True, ensure_ascii=False)
+
+def _all_identical(captions: List[str]) -> bool:
+    """
+    Whether every caption is the same text as the prompt sends it: cut to _EVAL_MAX_CAPTION_CHARS,
+    ignoring case and surrounding whitespace.
+    """
+    return len({caption[:_EVAL_MAX_CAPTION_CHARS].strip().casefold() for caption in captions}) == 1
+
+def _parse_topics(content: Optional[str]) -> List[str]:
+    """
+    Extracts the topic list from a {"challenges": [...]} JSON reply. A reply that is not
+    such JSON is taken as a single topic, so a model ignoring the format still yields one.
+    """
+    if not content:
+        return []
+    try:
+        topics = json.loads(content)["challenges"]
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Topic batch reply was not the expected JSON; using it as a single topic.")
+        return [content.strip()]
+    return [topic.strip() for topic in topics if isinstance(topic, str) and topic.strip()]
+
+# Caps in-flight OpenAI requests across all LLMService instances, keeping bursts of users
+# below the account's rate limit instead of triggering 429s and retry storms.
+_request_semaphore = asyncio.Semaphore(get_llm_max_concurrency())
+
+# Transient OpenAI failures (rate limits, timeouts, dropped connections, 5xx) are retried with
+# jittered exponential backoff; client errors such as 400/401 are not, since retrying cannot help.
+_RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+OPENAI_MAX_ATTEMPTS = 5
+
+@functools.lru_cache(maxsize=4)
+def _get_client(api_key: str) -> AsyncOpenAI:
+    """
+    Returns the process-wide AsyncOpenAI client for the API key, creating it on first use,
+    so every LLMService shares one HTTP connection pool instead of opening its own.
+    With HTTP/2 available, concurrent requests are multiplexed over a few connections.
+    """
+    logger.info(f"Creating shared AsyncOpenAI client (HTTP/2: {HTTP2_AVAILABLE}).")
+    http_client = httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    ))
+    return AsyncOpenAI(api_key=api_key, http_client=http_client)
+
+class EvaluationRequest(NamedTuple):
+    """One evaluation of a Batch API job (see LLMService.submit_batch_evaluations)."""
+    custom_id: str
+    topic: str
+    captions: List[str]
+
+# Batch jobs that will not produce (more) results.
+_BATCH_FAILED_STATUSES = frozenset({"failed", "expired", "cancelled"})
+
 class LLMService:
     """
     Service for interacting with the OpenAI LLM.
     Handles challenge generation and submission evaluation.
     """
-    def __init__(self):
+    def __init__(self, cache: Optional[ResponseCache] = None, semantic_cache: Optional[SemanticCache] = None,
+                 max_concurrency: Optional[int] = None):
         """
-        Initializes the LLMService, setting up the OpenAI client.
+        Initializes the LLMService with the shared async OpenAI client for the configured key.
+        Args:
+            cache: Cache for evaluation responses. Defaults to the process-wide one.
+            semantic_cache: Similarity cache for evaluation responses. Defaults to the process-wide one.
+            max_concurrency: Cap on this instance's in-flight OpenAI requests. Defaults to sharing the
+                process-wide cap (LLM_MAX_CONCURRENCY) with every other LLMService.
         Raises:
             ValueError: If the OpenAI API key is not configured.
         """
         logger.info("Initializing LLMService...")
+        self.cache = _evaluation_cache if cache is None else cache
+        self.semantic_cache = _semantic_evaluation_cache if semantic_cache is None else semantic_cache
+        self._semaphore = _request_semaphore if max_concurrency is None else asyncio.Semaphore(max_concurrency)
+        self._topics: Deque[str] = deque()
+        self._topics_lock = asyncio.Lock()
         try:
             logger.info("Attempting to retrieve OpenAI API key.")
             self.api_key = get_openai_api_key() # get_openai_api_key already logs success/failure
-            self.client = OpenAI(api_key=self.api_key)
+            self.client = _get_client(self.api_key)
             logger.info("OpenAI client initialized successfully.")
         except ValueError as e: # This will be caught if get_openai_api_key raises it
             logger.error(f"ValueError during LLMService initialization: {e}", exc_info=True)
@@ -30,45 +183,95 @@ class LLMService:
             logger.exception("An unexpected error occurred during LLMService initialization.")
             raise
 
-    def generate_challenge_topic(self) -> str:
+    @retry(
+        retry=retry_if_exception_type(_RETRYABLE_ERRORS),
+        wait=wait_random_exponential(min=1, max=30),
+        stop=stop_after_attempt(OPENAI_MAX_ATTEMPTS),
+        reraise=True,
+    )
+    async def _create_chat(self, **kwargs):
+        """
+        Sends a chat completion request, under the shared concurrency limit, retrying transient failures.
+        With stream=True, only opening the stream is retried and limited; the caller reads it.
+        Raises:
+            APIError: The last error, once retries are exhausted or for a non-retryable error.
         """
-        Generates a new challenge topic using the LLM.
+        async with self._semaphore:
+            return await self.client.chat.completions.create(**kwargs)
 
+    async def generate_challenge_topics(self, n: int) -> List[str]:
+        """
+        Generates n challenge topics with a single LLM call, returned by the model as a JSON list.
+
+        Args:
+            n: The number of topics to request.
         Returns:
-            str: The generated challenge topic, or an error message if generation fails.
+            List[str]: The generated topics; possibly fewer than n, but never empty.
+        Raises:
+            LLMError: If the OpenAI request fails or returns no topics.
         """
-        logger.info("Attempting to generate a new challenge topic.")
-        prompt_content = (
-            "צור לי אתגר יצירתי ומחשבתי לאדם אחד. האתגר צריך לדרוש שימוש בחפצים נפוצים הנמצאים בדרך כלל בבית. "
-            "חשוב שההוראות באתגר יהיו ברורות לחלוטין ויסבירו בדיוק מה על המשתתף ליצור או לעשות כך שניתן יהיה לצלם תמונה ולהוכיח עמידה באתגר. "
-            "האתגר צריך להיות קל לביצוע מעשי, אך מעניין ומפעיל את הדמיון. "
-            "נסח את האתגר בשורה אחת או שתיים, בשפה העברית."
-        )
+        logger.info("Requesting a batch of %d challenge topics.", n)
+        prompt_content = _TOPIC_PROMPT_TEMPLATE.substitute(n=n)
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
+            response = await self._create_chat(
+                model=OPENAI_MODEL,
                 messages=[
-                    {"role": "system", "content": "אתה מומחה ביצירת בעברית אתגרים המפעילים חשיבה ויצירתיות"},
+                    {"role": "system", "content": _TOPIC_SYSTEM_MESSAGE},
                     {"role": "user", "content": prompt_content}
-                ]
+                ],
+                response_format={"type": "json_object"},
+                max_tokens=_TOPIC_MAX_TOKENS_PER_TOPIC * n,
+                **_TOPIC_SAMPLING
             )
-            topic = response.choices[0].message.content
-            if topic:
-                logger.info(f"Successfully generated challenge topic: {topic}")
-                return topic
-            else:
-                logger.warning("LLM did not return a topic.")
-                return "Error: LLM did not return a topic."
         except APIError as e:
-            logger.error(f"OpenAI API error while generating topic: {e}")
-            return f"OpenAI API error: {e}"
+            logger.error("OpenAI API error while generating topic: %s", e)
+            raise LLMError(f"OpenAI API error: {e}") from e
         except Exception as e:
             logger.exception("Unexpected error while generating topic.")
-            return f"Unexpected error: {e}"
+            raise LLMError(f"Unexpected error: {e}") from e
+        topics = _parse_topics(response.choices[0].message.content)
+        if not topics:
+            logger.warning("LLM did not return a topic.")
+            raise LLMError("LLM did not return a topic.")
+        return topics
+
+    async def generate_challenge_topic(self) -> str:
+        """
+        Returns a new challenge topic. Topics are generated TOPIC_BATCH_SIZE at a time
+        (see generate_challenge_topics) and handed out one per call, so most calls need no API request.
+        Not cached: every call gets a topic that was not handed out before.
+
+        Returns:
+            str: The generated challenge topic.
+        Raises:
+            LLMError: If a needed batch of topics could not be generated.
+        """
+        logger.info("Attempting to generate a new challenge topic.")
+        # The lock keeps concurrent callers on an empty buffer from each requesting a batch.
+        async with self._topics_lock:
+            if not self._topics:
+                self._topics.extend(await self.generate_challenge_topics(TOPIC_BATCH_SIZE))
+            topic = self._topics.popleft()
+        logger.info("Successfully generated challenge topic: %s", topic)
+        return topic
+
+    async def _embed(self, texts: List[str]) -> Optional[List[List[float]]]:
+        """
+        Returns one embedding per text, in order, from a single embeddings call, or None if
+        the call fails, in which case the caller simply skips the semantic cache.
+        """
+        try:
+            async with self._semaphore:
+                response = await self.client.embeddings.create(model=OPENAI_EMBEDDING_MODEL, input=texts)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except Exception as e:
+            logger.warning(f"Embedding request failed, skipping the semantic cache: {e}")
+            return None
 
-    def evaluate_submissions(self, topic: str, caption1: str, caption2: str) -> str:
+    async def evaluate_submissions(self, topic: str, caption1: str, caption2: str) -> str:
         """
         Evaluates two image submissions based on their captions and a given challenge topic.
+        See evaluate_captions, which this delegates to.
 
         Args:
             topic: The challenge topic.
@@ -76,47 +279,279 @@ class LLMService:
             caption2: The caption for the second image.
 
         Returns:
-            str: The LLM's evaluation and winner declaration, or an error message if evaluation fails.
+            str: The LLM's evaluation and winner declaration.
+        Raises:
+            ValueError: If the topic or a caption is missing.
+            LLMError: If the evaluation request fails or returns no content.
         """
-        logger.info(f"Attempting to evaluate submissions for topic: '{topic}'. Caption1 provided: {bool(caption1)}, Caption2 provided: {bool(caption2)}")
-        if not all([topic, caption1, caption2]):
-            logger.warning("Evaluation called with missing topic or captions.")
-            return "Error: Topic and both captions must be provided for evaluation."
-
-        prompt_content = (
-            f"בהתחשב באתגר: '{topic}'.\n"
-            f"להלן תיאורים של שתי תמונות שהוגשו כפתרונות לאתגר:\n"
-            f"תמונה 1: {caption1}\n"
-            f"תמונה 2: {caption2}\n\n"
-            "עבור כל תמונה, אנא ספק ציון מ-1 עד 10 המייצג את מידת ההצלחה בביצוע האתגר, בהתבסס על יצירתיות, בהירות וייצוג بصری של הפתרון.\n" # Note: "בصری" seems to have a typo, likely meant "חזותי" or "ויזואלי". I will assume "חזותי" for correction.
-            "לאחר מכן, הכרז על התמונה הזוכה.\n"
-            "לבסוף, ספק הסבר קצר וקולע (עד שתי שורות) מדוע התמונה הזו נבחרה כמנצחת, תוך התמקדות בסיבה המרכזית להחלטה.\n\n"
-            "הפלט הרצוי בעברית ובפורמט הבא:\n"
-            "תמונה 1 - ציון: [הציון כאן]/10\n"
-            "תמונה 2 - ציון: [הציון כאן]/10\n"
-            "התמונה הזוכה היא: תמונה [1/2]\n"
-            "הסבר קצר לזכייה: [ההסבר הקצר כאן]"
+        logger.info("Attempting to evaluate submissions for topic: '%s'. Caption1 provided: %s, Caption2 provided: %s",
+                    topic, bool(caption1), bool(caption2))
+        return await self.evaluate_captions(topic, [caption1, caption2])
+
+    async def evaluate_submissions_batch(self, items: List[Tuple[str, str, str]]) -> List[Union[str, Exception]]:
+        """
+        Evaluates many (topic, caption1, caption2) submissions concurrently, so a tournament
+        round takes about one round-trip instead of one per match. In-flight requests are
+        still bounded by the shared request semaphore.
+
+        Args:
+            items: The (topic, caption1, caption2) submissions to evaluate.
+
+        Returns:
+            List[Union[str, Exception]]: One entry per item, in order: the evaluation, or the
+                ValueError / LLMError that evaluate_submissions raised for it, so one failed
+                match does not discard the others.
+        """
+        logger.info("Evaluating a batch of %d submissions concurrently.", len(items))
+        return await asyncio.gather(
+            *(self.evaluate_captions(topic, [caption1, caption2]) for topic, caption1, caption2 in items),
+            return_exceptions=True,
         )
-        # Correcting potential typo in the prompt from "בصری" to "חזותי"
-        prompt_content = prompt_content.replace("בصری", "חזותי")
+
+    def _evaluation_request(self, topic: str, captions: List[str]) -> Tuple[List[Dict[str, str]], Dict[str, str]]:
+        """
+        Builds the chat messages and the cache slots of an evaluation, cutting each caption
+        to _EVAL_MAX_CAPTION_CHARS.
+        Raises:
+            ValueError: If the topic is missing, a caption is empty, or there are fewer than two captions.
+        """
+        if not topic or len(captions) < 2 or not all(captions):
+            logger.warning("Evaluation called with missing topic or captions.")
+            raise ValueError("Topic and both captions must be provided for evaluation.")
+        captions = [caption[:_EVAL_MAX_CAPTION_CHARS] for caption in captions]
+
+        numbers = range(1, len(captions) + 1)
+        prompt_content = f"אתגר: {topic}\n" + "\n".join(f"תמונה {i}: {caption}" for i, caption in zip(numbers, captions))
+        messages = [
+            {"role": "system", "content": _EVAL_SYSTEM_MESSAGE},
+            {"role": "user", "content": prompt_content}
+        ]
+        slots = {"topic": topic, **{f"caption{i}": caption for i, caption in zip(numbers, captions)}}
+        return messages, slots
+
+    async def _cached_evaluation(self, topic: str, captions: List[str], messages: List[Dict[str, str]],
+                                 slots: Dict[str, str]) -> Tuple[Optional[str], Optional["asyncio.Task"]]:
+        """
+        Looks an evaluation up in the exact cache, then in the semantic cache, which compares
+        each caption's embedding with the caption at the same position, so swapped submissions
+        never reuse a verdict naming the other player.
+        The embeddings are only awaited here when the semantic cache holds entries for the topic;
+        otherwise they are computed in the background, alongside the evaluation request.
+        Returns:
+            The cached evaluation (or None on a miss) and the task computing the captions'
+            embeddings, which the caller passes on to _store_evaluation and cancels when it is
+            done (None on an exact hit).
+        """
+        cached = await self.cache.aget(_request_key(OPENAI_MODEL, messages), template_id=_EVALUATION_TEMPLATE_ID, slots=slots)
+        if cached is not None:
+            logger.info("Evaluation cache hit; skipping the OpenAI call.")
+            return cached, None
+        embeddings = asyncio.ensure_future(self._embed(captions))
+        if self.semantic_cache.has_scope(topic):
+            vectors = await embeddings
+            if vectors is not None:
+                cached = self.semantic_cache.get(topic, vectors)
+                if cached is not None:
+                    logger.info("Semantic evaluation cache hit; skipping the OpenAI call.")
+        return cached, embeddings
+
+    async def _store_evaluation(self, topic: str, messages: List[Dict[str, str]], slots: Dict[str, str],
+                                embeddings: "asyncio.Task", result: str) -> None:
+        await self.cache.aset(_request_key(OPENAI_MODEL, messages), result, template_id=_EVALUATION_TEMPLATE_ID, slots=slots)
+        vectors = await embeddings
+        if vectors is not None:
+            self.semantic_cache.set(topic, vectors, result)
+
+    async def evaluate_captions(self, topic: str, captions: List[str]) -> str:
+        """
+        Scores any number of image submissions, given by their captions, in a single LLM call.
+        Successful evaluations are cached by the exact request, and by the normalized
+        topic and captions, so repeated submissions are answered without an API call.
+        On an exact miss, an evaluation for the same topic with near-identical (paraphrased)
+        captions is reused, judged caption by caption (in player order) by the similarity of their embeddings.
+        If all captions are the same text, a draw is returned without calling the model.
+
+        Args:
+            topic: The challenge topic.
+            captions: One caption per submitted image, in player order (at least two).
+
+        Returns:
+            str: The LLM's evaluation and winner declaration.
+        Raises:
+            ValueError: If the topic is missing, a caption is empty, or there are fewer than two captions.
+            LLMError: If the evaluation request fails or returns no content.
+        """
+        messages, slots = self._evaluation_request(topic, captions)
+        if _all_identical(captions):
+            logger.info("All submitted captions are identical; declaring a draw without an OpenAI call.")
+            return _IDENTICAL_SUBMISSIONS_VERDICT
+        cached, embeddings = await self._cached_evaluation(topic, captions, messages, slots)
+        if cached is not None:
+            return cached
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "אתה מומחה בהשוואת תוצאות האתגרים בין שני מתחרים."},
-                    {"role": "user", "content": prompt_content}
-                ]
+            result = await self._request_evaluation(messages, len(captions))
+            await self._store_evaluation(topic, messages, slots, embeddings, result)
+            return result
+        finally:
+            embeddings.cancel()
+
+    async def _request_evaluation(self, messages: List[Dict[str, str]], num_captions: int) -> str:
+        """Sends an evaluation request (see evaluate_captions) and returns its non-empty text."""
+        try:
+            response = await self._create_chat(
+                model=OPENAI_MODEL,
+                messages=messages,
+                max_tokens=_eval_max_tokens(num_captions),
+                prompt_cache_key=_EVAL_PROMPT_CACHE_KEY,
+                **_EVAL_SAMPLING
             )
-            result = response.choices[0].message.content
-            if result:
-                logger.info("Submissions evaluated successfully by LLM.")
-                return result
-            else:
-                logger.warning("LLM did not return an evaluation.")
-                return "Error: LLM did not return an evaluation."
         except APIError as e:
             logger.error(f"OpenAI API error during evaluation: {e}")
-            return f"OpenAI API error: {e}"
+            raise LLMError(f"OpenAI API error: {e}") from e
         except Exception as e:
             logger.exception("Unexpected error during evaluation.")
-            return f"Unexpected error: {e}"
+            raise LLMError(f"Unexpected error: {e}") from e
+        result = response.choices[0].message.content
+        if not result:
+            logger.warning("LLM did not return an evaluation.")
+            raise LLMError("LLM did not return an evaluation.")
+        logger.info("Submissions evaluated successfully by LLM.")
+        return result
+
+    async def stream_evaluation(self, topic: str, captions: List[str]) -> AsyncIterator[str]:
+        """
+        Like evaluate_captions, but yields the evaluation text chunk by chunk as the model
+        produces it, so a UI can show its start long before generation finishes.
+        A cached evaluation is yielded as a single chunk; a fully streamed one is cached.
+
+        Args:
+            topic: The challenge topic.
+            captions: One caption per submitted image, in player order (at least two).
+
+        Returns:
+            AsyncIterator[str]: Successive chunks of the evaluation text.
+        Raises:
+            ValueError: If the topic is missing, a caption is empty, or there are fewer than two captions.
+            LLMError: If the request fails (possibly after some chunks were yielded) or returns no content.
+        """
+        messages, slots = self._evaluation_request(topic, captions)
+        if _all_identical(captions):
+            logger.info("All submitted captions are identical; declaring a draw without an OpenAI call.")
+            yield _IDENTICAL_SUBMISSIONS_VERDICT
+            return
+        cached, embeddings = await self._cached_evaluation(topic, captions, messages, slots)
+        if cached is not None:
+            yield cached
+            return
+        try:
+            chunks = []
+            try:
+                stream = await self._create_chat(
+                    model=OPENAI_MODEL,
+                    messages=messages,
+                    stream=True,
+                    max_tokens=_eval_max_tokens(len(captions)),
+                    prompt_cache_key=_EVAL_PROMPT_CACHE_KEY,
+                    **_EVAL_SAMPLING
+                )
+                async for chunk in stream:
+                    text = chunk.choices[0].delta.content if chunk.choices else None
+                    if text:
+                        chunks.append(text)
+                        yield text
+            except APIError as e:
+                logger.error(f"OpenAI API error during evaluation stream: {e}")
+                raise LLMError(f"OpenAI API error: {e}") from e
+            except Exception as e:
+                logger.exception("Unexpected error during evaluation stream.")
+                raise LLMError(f"Unexpected error: {e}") from e
+            if not chunks:
+                logger.warning("LLM did not return an evaluation.")
+                raise LLMError("LLM did not return an evaluation.")
+            logger.info("Submissions evaluation streamed successfully by LLM.")
+            await self._store_evaluation(topic, messages, slots, embeddings, "".join(chunks))
+        finally:
+            # The embeddings are not needed once the stream ends, however it ends.
+            embeddings.cancel()
+
+    async def submit_batch_evaluations(self, requests: List[EvaluationRequest]) -> str:
+        """
+        Submits many evaluations as one OpenAI Batch API job, for offline workloads (regression
+        runs, asynchronously scored tournaments) that can wait up to 24 hours. Batch requests
+        cost about half as much and do not count against the interactive rate limits.
+        Interactive play should keep using evaluate_captions.
+
+        Args:
+            requests: The evaluations to run; their custom_ids must be unique.
+        Returns:
+            str: The id of the batch job, for fetch_batch_results.
+        Raises:
+            ValueError: If a request has a missing topic or caption.
+            LLMError: If uploading the requests or creating the job fails.
+        """
+        lines = []
+        for request in requests:
+            messages, _ = self._evaluation_request(request.topic, request.captions)
+            body = {"model": OPENAI_MODEL, "messages": messages, "max_tokens": _eval_max_tokens(len(request.captions)),
+                    "prompt_cache_key": _EVAL_PROMPT_CACHE_KEY, **_EVAL_SAMPLING}
+            lines.append(json.dumps(
+                {"custom_id": request.custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body},
+                ensure_ascii=False,
+            ))
+        logger.info("Submitting a batch of %d evaluations.", len(lines))
+        try:
+            batch_file = await self.client.files.create(
+                file=("evaluations.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch"
+            )
+            batch = await self.client.batches.create(
+                input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h"
+            )
+        except APIError as e:
+            logger.error("OpenAI API error while submitting evaluation batch: %s", e)
+            raise LLMError(f"OpenAI API error: {e}") from e
+        logger.info("Evaluation batch submitted: %s", batch.id)
+        return batch.id
+
+    async def fetch_batch_results(self, batch_id: str, poll_interval: Optional[float] = None) -> Optional[Dict[str, str]]:
+        """
+        Returns the evaluations of a job from submit_batch_evaluations.
+
+        Args:
+            batch_id: The job id.
+            poll_interval: If given, wait for the job to finish, checking every poll_interval
+                seconds; otherwise check once.
+        Returns:
+            Optional[Dict[str, str]]: The evaluation text by custom_id (requests that failed
+                are left out), or None if the job has not finished and poll_interval is None.
+        Raises:
+            LLMError: If the job failed, expired or was cancelled, or an API call fails.
+        """
+        try:
+            while True:
+                batch = await self.client.batches.retrieve(batch_id)
+                if batch.status == "completed":
+                    break
+                if batch.status in _BATCH_FAILED_STATUSES:
+                    logger.error("Evaluation batch %s ended with status '%s'.", batch_id, batch.status)
+                    raise LLMError(f"Batch {batch_id} ended with status '{batch.status}'.")
+                if poll_interval is None:
+                    return None
+                await asyncio.sleep(poll_interval)
+            if not batch.output_file_id:
+                return {}
+            output = await self.client.files.content(batch.output_file_id)
+        except APIError as e:
+            logger.error("OpenAI API error while fetching evaluation batch %s: %s", batch_id, e)
+            raise LLMError(f"OpenAI API error: {e}") from e
+
+        results = {}
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            try:
+                results[record["custom_id"]] = record["response"]["body"]["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                logger.warning("Evaluation batch %s: no result for request '%s'.", batch_id, record.get("custom_id"))
+        logger.info("Fetched %d results of evaluation batch %s.", len(results), batch_id)
+        return results
@@ -1,99 +1,152 @@
 # app/ui/gradio_interface.py
-import gradio as gr
 from PIL import Image
 import logging
 import asyncio # Required for running async methods if called from sync context (though Gradio handles it)
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
 
 # Assuming UserInteractionAgent is in app.agents.user_interaction_agent
-from app.agents.user_interaction_agent import UserInteractionAgent 
+from app.agents.user_interaction_agent import UserInteractionAgent, DEFAULT_SESSION_ID
+from app.agents.challenge_tool import CHALLENGE_FAILURE_MESSAGES
 # Assuming ImageService is in app.services.image_service
-from app.services.image_service import ImageService
+from app.services.image_service import CAPTION_FAILURE_MESSAGES, ImageService
+from app.config import EVALUATION_MODE_CAPTIONS, EVALUATION_MODE_MULTIMODAL
+
+# Gradio is imported in create_ui only: it is slow to import and callers that never build
+# the UI (tests, scripts) should not pay for it.
+if TYPE_CHECKING:
+    import gradio as gr
 
 logger = logging.getLogger(__name__)
 
+_TOPIC_PLACEHOLDER = "לחץ על 'צור לנו אתגר חדש' כדי להתחיל"
+
+# Events of one type that may run at once across all sessions (Gradio's default is 1).
+# Handlers share no per-request state, so users need not wait for each other.
+GRADIO_CONCURRENCY_LIMIT = 20
+
+def _session_id(request: Optional["gr.Request"]) -> str:
+    """Returns the Gradio session hash of the request, used to key per-user agent state."""
+    if request is not None and request.session_hash:
+        return request.session_hash
+    return DEFAULT_SESSION_ID
+
 class GradioInterface:
-    def __init__(self, agent: UserInteractionAgent, image_service: ImageService):
+    def __init__(self, agent: UserInteractionAgent, image_service: Optional[ImageService], batch_captions: bool = True,
+                 evaluation_mode: str = EVALUATION_MODE_CAPTIONS):
         """
         Initializes the GradioInterface.
         Args:
             agent: An instance of UserInteractionAgent.
-            image_service: An instance of ImageService for generating captions.
+            image_service: An instance of ImageService for generating captions. Only used in captions mode.
+            batch_captions: Caption submissions through the ImageService micro-batcher, which
+                batches both images (and concurrent requests from other sessions) into one model
+                call. When False, the two captions are generated concurrently in separate threads.
+            evaluation_mode: EVALUATION_MODE_MULTIMODAL to send the images straight to the agent,
+                or EVALUATION_MODE_CAPTIONS to caption them with the ImageService first.
         """
         self.agent = agent
         self.image_service = image_service
+        self.batch_captions = batch_captions
+        self.evaluation_mode = evaluation_mode
         logger.info("GradioInterface initialized with UserInteractionAgent and ImageService.")
 
-    async def _handle_user_message(self, user_input: str, history: list) -> tuple[str, list]:
+    async def _handle_user_message(self, user_input: str, history: list, request: Optional["gr.Request"] = None):
         """
         Generic handler for text input that might not be a specific command.
         This allows for more conversational interaction if the agent supports it.
+        The reply is streamed: each yield updates the last history entry with the text so far.
         (Currently not directly wired up to a separate input field, but can be used)
         """
-        logger.info(f"UI: Handling generic user message: '{user_input}'")
-        response = await self.agent.process_user_interaction(user_message=user_input)
-        history.append((user_input, response))
-        return "", history # Clear input, update history
+        logger.info("UI: Handling generic user message: '%s'", user_input)
+        history.append((user_input, ""))
+        response = ""
+        async for chunk in self.agent.stream_user_interaction(user_message=user_input, session_id=_session_id(request)):
+            response += chunk
+            history[-1] = (user_input, response)
+            yield "", history # Clear input, update history
 
-    async def _handle_generate_topic(self) -> str:
+    async def _handle_generate_topic(self, request: Optional["gr.Request"] = None) -> Tuple[str, str]:
         """
         Handles the 'generate topic' button click.
         Sends a message to the agent to generate a new topic.
+        Returns:
+            Tuple[str, str]: The text to display, and the value for the session's topic state:
+                the raw challenge, without the display prefix (empty if no challenge was created).
         """
         logger.info("UI: Generate topic button clicked.")
+        session_id = _session_id(request)
         # The user_message tells the agent the intent.
-        response = await self.agent.process_user_interaction(user_message="אתגר חדש") 
+        response = await self.agent.process_user_interaction(user_message="אתגר חדש", session_id=session_id)
         # The response here is expected to be the new topic itself or an error message.
-        if "Error:" in response or "שגיאה" in response or "מצטער" in response: # Basic error check
+        if response in CHALLENGE_FAILURE_MESSAGES:
             logger.error(f"Agent returned an error or issue for new challenge: {response}")
-        else:
-            logger.info(f"Agent generated new topic: {response[:100]}...") # Log snippet of topic
-        return response
+            return response, ""
+        logger.info("Agent generated new topic: %.100s...", response) # Log snippet of topic
+        # The state is passed back as the topic to evaluate against, so it must match the agent's
+        # stored topic exactly (prompts and evaluation cache keys are built from it).
+        return response, self.agent.get_current_topic(session_id) or ""
 
-    async def _handle_check_images(self, image1_pil: Optional[Image.Image], image2_pil: Optional[Image.Image], current_topic_display: str) -> str:
+    async def _handle_check_images(self, image1_pil: Optional[Image.Image], image2_pil: Optional[Image.Image], current_topic: str,
+                                   request: Optional["gr.Request"] = None) -> str:
         """
         Handles the 'check images' button click.
         Generates captions and sends them to the agent for evaluation.
         Args:
             image1_pil: PIL Image object from the first image input.
             image2_pil: PIL Image object from the second image input.
-            current_topic_display: The topic currently displayed in the UI (from topic_output Textbox).
+            current_topic: The session's topic state; empty until a challenge was created successfully.
+                It is the challenge shown to the user, so the agent evaluates against it.
+            request: The Gradio request, injected by Gradio; identifies the user session.
         Returns:
             str: The evaluation result from the agent.
         """
         logger.info("UI: Check images button clicked.")
 
-        if not current_topic_display or "לחץ על הכפתור" in current_topic_display or "שגיאה ב" in current_topic_display:
-            # Added "שגיאה ב" to catch errors in topic display from previous step
-            logger.warning("UI: Check images called but no valid topic is displayed.")
+        if not current_topic:
+            logger.warning("UI: Check images called but no challenge has been created in this session.")
             return "אנא צור אתגר תחילה על ידי לחיצה על 'צור לנו אתגר חדש'."
 
         if image1_pil is None or image2_pil is None:
             logger.warning("UI: Check images called but one or both images are missing.")
             return "יש להעלות שתי תמונות כדי לבדוק."
 
+        if self.evaluation_mode == EVALUATION_MODE_MULTIMODAL:
+            logger.info("Sending images to agent for multimodal evaluation.")
+            return await self.agent.evaluate_images(image1_pil, image2_pil, session_id=_session_id(request), topic=current_topic)
+
         # Ensure image_service is available
         if not self.image_service:
             logger.error("UI: ImageService not available.")
             return "שגיאה פנימית: שירות עיבוד התמונות אינו זמין."
 
-        logger.info("Generating caption for image 1...")
-        caption1 = await self.image_service.generate_caption(image1_pil)
-        if "Error:" in caption1 or not caption1: # Check for empty caption too
+        if self.batch_captions:
+            logger.info("Submitting both images to the caption micro-batcher...")
+            caption1, caption2 = await asyncio.gather(
+                self.image_service.submit(image1_pil),
+                self.image_service.submit(image2_pil),
+            )
+        else:
+            logger.info("Generating captions for both images concurrently...")
+            caption1, caption2 = await asyncio.gather(
+                self.image_service.generate_caption(image1_pil),
+                self.image_service.generate_caption(image2_pil),
+            )
+        if not caption1 or caption1 in CAPTION_FAILURE_MESSAGES: # Check for empty caption too
             logger.error(f"Failed to generate caption for Image 1: {caption1}")
             return f"שגיאה ביצירת תיאור לתמונה 1: {caption1 if caption1 else 'תיאור ריק'}"
-        logger.info(f"Caption 1: {caption1[:50]}...")
+        logger.info("Caption 1: %.50s...", caption1)
 
-        logger.info("Generating caption for image 2...")
-        caption2 = await self.image_service.generate_caption(image2_pil)
-        if "Error:" in caption2 or not caption2:
+        if not caption2 or caption2 in CAPTION_FAILURE_MESSAGES:
             logger.error(f"Failed to generate caption for Image 2: {caption2}")
             return f"שגיאה ביצירת תיאור לתמונה 2: {caption2 if caption2 else 'תיאור ריק'}"
-        logger.info(f"Caption 2: {caption2[:50]}...")
+        logger.info("Caption 2: %.50s...", caption2)
             
         logger.info("Sending image captions to agent for evaluation.")
         response = await self.agent.process_user_interaction(
             user_message="הערך בבקשה את ההגשות הללו עבור האתגר הנוכחי.", 
-            image_captions={"caption1": caption1, "caption2": caption2}
+            image_captions={"caption1": caption1, "caption2": caption2},
+            session_id=_session_id(request),
+            topic=current_topic
         )
         return response
 
@@ -101,6 +154,8 @@ class GradioInterface:
         """
         Creates the Gradio UI layout and defines interactions.
         """
+        import gradio as gr
+
         logger.info("UI: Creating Gradio blocks.")
         with gr.Blocks(css="footer {visibility: hidden}") as demo: # Simple CSS to hide Gradio footer
             gr.Markdown("# אתגר התמונות (Image Challenge) - מבוסס סוכנים")
@@ -114,7 +169,7 @@ class GradioInterface:
                 create_topic_button = gr.Button("צור לנו אתגר חדש")
             
             topic_output = gr.Textbox(
-                value="לחץ על 'צור לנו אתגר חדש' כדי להתחיל", 
+                value=_TOPIC_PLACEHOLDER,
                 label="האתגר הנוכחי (Current Challenge)", 
                 interactive=False,
                 lines=2 # Allow topic to wrap for 2 lines
@@ -127,13 +182,16 @@ class GradioInterface:
             with gr.Row():
                 check_button = gr.Button("בדוק אותנו! (Check Us!)")
             
+            # The session's current challenge, kept per browser session by Gradio.
+            topic_state = gr.State("")
+
             result_output = gr.Textbox(label="תוצאות הבדיקה (Evaluation Results)", lines=10, interactive=False) # Increased lines
 
             # --- Define button/component actions ---
             
-            async def _handle_show_rules_click():
+            async def _handle_show_rules_click(request: gr.Request):
                 logger.info("UI: Show rules button clicked.")
-                rules_text = await self.agent.process_user_interaction(user_message="הוראות המשחק")
+                rules_text = await self.agent.process_user_interaction(user_message="הוראות המשחק", session_id=_session_id(request))
                 # Toggle visibility: if already visible and contains rules, hide it. Otherwise, show it.
                 # This requires knowing the current state or making it always visible once clicked.
                 # Simpler: always show/refresh.
@@ -141,18 +199,31 @@ class GradioInterface:
             
             show_rules_button.click(fn=_handle_show_rules_click, inputs=[], outputs=[rules_output])
 
+            # Gradio injects the request by the resolved gr.Request annotation, which the
+            # methods above cannot carry without importing gradio at module level.
+            async def _handle_generate_topic_click(request: gr.Request) -> Tuple[str, str]:
+                return await self._handle_generate_topic(request)
+
+            async def _handle_check_images_click(image1_pil: Optional[Image.Image], image2_pil: Optional[Image.Image],
+                                                 current_topic: str, request: gr.Request) -> str:
+                return await self._handle_check_images(image1_pil, image2_pil, current_topic, request)
+
             create_topic_button.click(
-                fn=self._handle_generate_topic, 
+                fn=_handle_generate_topic_click, 
                 inputs=[], 
-                outputs=topic_output
+                outputs=[topic_output, topic_state]
             )
             
             check_button.click(
-                fn=self._handle_check_images,
-                inputs=[image_input1, image_input2, topic_output], # topic_output is Textbox component
-                outputs=result_output
+                fn=_handle_check_images_click,
+                inputs=[image_input1, image_input2, topic_state],
+                outputs=result_output,
+                # The micro-batcher only throttles BLIP captioning; the Gemini evaluation that follows
+                # (and the image uploads in multimodal mode) are bounded by Gradio's queue.
+                concurrency_limit=GRADIO_CONCURRENCY_LIMIT
             )
             
+            demo.queue(default_concurrency_limit=GRADIO_CONCURRENCY_LIMIT)
             self.demo = demo
         return demo
 
@@ -170,7 +241,7 @@ if __name__ == '__main__':
 
     # Mock UserInteractionAgent and ImageService for this structural test
     class MockAgent:
-        async def process_user_interaction(self, user_message: str, image_captions: Optional[Dict[str,str]] = None):
+        async def process_user_interaction(self, user_message: str, image_captions: Optional[Dict[str,str]] = None, session_id: str = DEFAULT_SESSION_ID, topic: Optional[str] = None):
             logger.info(f"MockAgent.process_user_interaction called with: '{user_message}', Captions: {image_captions is not None}")
             if "אתגר חדש" in user_message:
                 return "נושא אתגר לדוגמה מהסוכן המדומה."
@@ -180,12 +251,24 @@ if __name__ == '__main__':
                 return f"הערכה לדוגמה מהסוכן המדומה עבור: {image_captions['caption1'][:10]}... ו-{image_captions['caption2'][:10]}..."
             return "תגובה כללית מהסוכן המדומה."
 
+        async def stream_user_interaction(self, user_message: str, image_captions: Optional[Dict[str,str]] = None, session_id: str = DEFAULT_SESSION_ID):
+            yield await self.process_user_interaction(user_message, image_captions, session_id=session_id)
+
+        async def evaluate_images(self, image1: Image.Image, image2: Image.Image, session_id: str = DEFAULT_SESSION_ID, topic: Optional[str] = None):
+            return "הערכה לדוגמה מהסוכן המדומה עבור שתי התמונות."
+
     class MockImageService:
         async def generate_caption(self, image_pil: Image.Image) -> str:
             logger.info("MockImageService.generate_caption called.")
             if image_pil is None: return "Error: No image provided."
             return "תיאור תמונה מדומה."
 
+        async def generate_captions_batch(self, images: list) -> list:
+            return [await self.generate_caption(image) for image in images]
+
+        async def submit(self, image_pil: Image.Image) -> str:
+            return await self.generate_caption(image_pil)
+
     mock_agent = MockAgent()
     mock_image_service = MockImageService()
     
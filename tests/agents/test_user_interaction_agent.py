@@ -0,0 +1,248 @@
+# tests/agents/test_user_interaction_agent.py
+import asyncio
+import logging
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+import app.agents.user_interaction_agent as agent_module
+from app.agents.challenge_tool import CHALLENGE_UNAVAILABLE_MESSAGE
+from app.agents.user_interaction_agent import (
+    _NO_CHALLENGE_REPLY,
+    _ROUTE_GENERIC,
+    _ROUTE_NEW_CHALLENGE,
+    _ROUTE_RULES,
+    _UNSURE_REPLY,
+    UserInteractionAgent,
+    _route_intent,
+)
+from app.services.gemini_service import GeminiServiceError
+
+# Keeps this module's tests on one xdist worker (see --dist=loadgroup in pytest.ini).
+pytestmark = pytest.mark.xdist_group("user_interaction_agent")
+
+@pytest.fixture(autouse=True)
+def capture_agent_logs(caplog):
+    """Captures the agent's logs down to DEBUG for every test, so caplog.records can be asserted directly."""
+    caplog.set_level(logging.DEBUG, logger="app.agents.user_interaction_agent")
+
+@pytest.fixture
+def agent():
+    """
+    An agent over a stub Gemini service whose challenge tool returns 'Topic 0', 'Topic 1', ... in order.
+    Tests that start the challenge prefetch stop it themselves, inside their own event loop.
+    """
+    gemini_service = SimpleNamespace(generate=AsyncMock(return_value="Generic reply"))
+    agent = UserInteractionAgent(gemini_service=gemini_service)
+    agent.challenge_tool._execute = AsyncMock(side_effect=[f"Topic {i}" for i in range(10)])
+    return agent
+
+def _execute_in_turn(*steps):
+    """A challenge tool side effect whose n-th call runs the n-th step: a coroutine function or a plain result."""
+    calls = iter(steps)
+
+    async def execute():
+        step = next(calls)
+        return await step() if callable(step) else step
+    return execute
+
+async def _let_tasks_run(rounds: int = 5) -> None:
+    """Yields to the event loop a few times, so background tasks reach their next await."""
+    for _ in range(rounds):
+        await asyncio.sleep(0)
+
+# --- _route_intent Tests ---
+@pytest.mark.parametrize("message, expected_route", [
+    ("מה הכללים?", _ROUTE_RULES),
+    ("אפשר אתגר חדש?", _ROUTE_NEW_CHALLENGE),
+    ("שלום", _ROUTE_GENERIC),
+])
+def test_route_intent(message, expected_route):
+    """Test messages are routed by their keywords, and only the generic route builds a prompt."""
+    route, prompt = _route_intent(message, "Build a tower")
+
+    assert route == expected_route
+    assert bool(prompt) == (route == _ROUTE_GENERIC)
+
+def test_route_intent_generic_prompt_includes_topic():
+    """Test the generic prompt carries the user's message and the current topic."""
+    _, prompt = _route_intent("שלום", "Build a tower")
+
+    assert "Build a tower" in prompt
+    assert "שלום" in prompt
+
+# --- New challenge Tests ---
+@pytest.mark.asyncio
+async def test_new_challenge_without_prefetch_generates_inline(agent):
+    """Test a new challenge is generated on request when the producer is not running, and kept per session."""
+    response = await agent.process_user_interaction("אתגר חדש", session_id="a")
+
+    assert "Topic 0" in response
+    assert agent.get_current_topic("a") == "Topic 0"
+    assert agent.get_current_topic("b") is None
+    agent.challenge_tool._execute.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_new_challenge_failure_clears_session_topic(agent):
+    """Test a failed generation is returned as is and clears the session's previous topic."""
+    agent.challenge_tool._execute.side_effect = ["Topic 0", CHALLENGE_UNAVAILABLE_MESSAGE]
+    await agent.process_user_interaction("אתגר חדש", session_id="a")
+
+    response = await agent.process_user_interaction("אתגר חדש", session_id="a")
+
+    assert response == CHALLENGE_UNAVAILABLE_MESSAGE
+    assert agent.get_current_topic("a") is None
+
+@pytest.mark.asyncio
+async def test_new_challenge_served_from_prefetch_queue(agent):
+    """Test a started producer fills the queue and requests are served from it in order."""
+    agent.start_challenge_prefetch()
+    await _let_tasks_run()
+
+    assert agent._challenge_queue.full()
+    first = await agent.process_user_interaction("אתגר חדש", session_id="a")
+    second = await agent.process_user_interaction("אתגר חדש", session_id="b")
+    await agent.stop_challenge_prefetch()
+
+    assert "Topic 0" in first
+    assert "Topic 1" in second
+
+@pytest.mark.asyncio
+async def test_new_challenge_waits_for_producer_instead_of_generating(agent):
+    """Test a request arriving before the first challenge is ready awaits the producer's, with no parallel call."""
+    release = asyncio.Event()
+
+    async def slow_topic():
+        await release.wait()
+        return "Topic 0"
+
+    agent.challenge_tool._execute.side_effect = _execute_in_turn(slow_topic, asyncio.Event().wait)
+    agent.start_challenge_prefetch()
+    request = asyncio.create_task(agent.process_user_interaction("אתגר חדש", session_id="a"))
+    await _let_tasks_run()
+
+    assert agent.challenge_tool._execute.await_count == 1
+    release.set()
+    response = await request
+    await agent.stop_challenge_prefetch()
+
+    assert "Topic 0" in response
+
+@pytest.mark.asyncio
+async def test_new_challenge_falls_back_inline_while_producer_fails(agent):
+    """Test a request is generated inline while the producer backs off after a failure."""
+    agent.challenge_tool._execute.side_effect = _execute_in_turn(CHALLENGE_UNAVAILABLE_MESSAGE, "Inline topic")
+    agent.start_challenge_prefetch()
+    await _let_tasks_run()
+
+    response = await agent.process_user_interaction("אתגר חדש", session_id="a")
+    await agent.stop_challenge_prefetch()
+
+    assert "Inline topic" in response
+
+@pytest.mark.asyncio
+async def test_new_challenge_falls_back_inline_after_wait_timeout(agent, monkeypatch):
+    """Test a request generates its own challenge if the producer does not deliver in time."""
+    monkeypatch.setattr(agent_module, "CHALLENGE_PREFETCH_WAIT_SECONDS", 0)
+    agent.challenge_tool._execute.side_effect = _execute_in_turn(asyncio.Event().wait, "Inline topic")
+    agent.start_challenge_prefetch()
+    await _let_tasks_run()
+
+    response = await agent.process_user_interaction("אתגר חדש", session_id="a")
+    await agent.stop_challenge_prefetch()
+
+    assert "Inline topic" in response
+
+@pytest.mark.asyncio
+async def test_challenge_producer_backs_off_exponentially(agent, monkeypatch):
+    """Test the producer's retry delay doubles after each failure, up to the maximum."""
+    real_sleep = asyncio.sleep
+    delays = []
+
+    async def record_sleep(seconds):
+        if seconds:
+            delays.append(seconds)
+        await real_sleep(0)
+
+    monkeypatch.setattr(agent_module.asyncio, "sleep", record_sleep)
+    agent.challenge_tool._execute.side_effect = None
+    agent.challenge_tool._execute.return_value = CHALLENGE_UNAVAILABLE_MESSAGE
+    agent.start_challenge_prefetch()
+    await _let_tasks_run(rounds=20)
+    await agent.stop_challenge_prefetch()
+
+    assert delays[:4] == [agent_module.CHALLENGE_PREFETCH_RETRY_SECONDS * 2 ** i for i in range(4)]
+    assert max(delays) == agent_module.CHALLENGE_PREFETCH_MAX_RETRY_SECONDS
+
+@pytest.mark.asyncio
+async def test_stop_challenge_prefetch_cancels_producer(agent):
+    """Test stopping the prefetch cancels the producer task."""
+    agent.start_challenge_prefetch()
+    task = agent._challenge_producer_task
+    await _let_tasks_run()
+
+    await agent.stop_challenge_prefetch()
+
+    assert task.cancelled()
+
+# --- Evaluation and streaming Tests ---
+@pytest.mark.asyncio
+async def test_evaluate_images_without_topic(agent):
+    """Test evaluating images before a challenge exists asks for a challenge first."""
+    assert await agent.evaluate_images(object(), object(), session_id="a") == _NO_CHALLENGE_REPLY
+
+@pytest.mark.asyncio
+async def test_evaluate_images_uses_given_topic(agent):
+    """Test the caller's topic is evaluated against even after the agent's session topic expired."""
+    agent.evaluation_tool._execute_images = AsyncMock(return_value="Player 1 wins!")
+    image1, image2 = object(), object()
+
+    response = await agent.evaluate_images(image1, image2, session_id="a", topic="Build a tower")
+
+    assert "Player 1 wins!" in response
+    agent.evaluation_tool._execute_images.assert_awaited_once_with("Build a tower", image1, image2)
+
+@pytest.mark.asyncio
+async def test_caption_evaluation_prefers_given_topic(agent):
+    """Test caption evaluation uses the caller's topic over the session's stored one."""
+    agent.evaluation_tool._execute_raw = AsyncMock(return_value="Player 2 wins!")
+    await agent.process_user_interaction("אתגר חדש", session_id="a")
+
+    await agent.process_user_interaction("הערך", image_captions={"caption1": "c1", "caption2": "c2"},
+                                         session_id="a", topic="Shown topic")
+
+    agent.evaluation_tool._execute_raw.assert_awaited_once_with("Shown topic", "c1", "c2")
+
+@pytest.mark.asyncio
+async def test_stream_user_interaction_streams_generic_reply(agent):
+    """Test a generic message is streamed chunk by chunk from the Gemini service."""
+    async def stream(prompt):
+        for chunk in ("Hello ", "there"):
+            yield chunk
+
+    agent.gemini_service.generate_text_stream = stream
+
+    chunks = [chunk async for chunk in agent.stream_user_interaction("שלום", session_id="a")]
+
+    assert chunks == ["Hello ", "there"]
+
+@pytest.mark.asyncio
+async def test_stream_user_interaction_failure_before_first_chunk(agent):
+    """Test a stream that fails before any text yields the fallback reply."""
+    async def stream(prompt):
+        raise GeminiServiceError("down")
+        yield
+
+    agent.gemini_service.generate_text_stream = stream
+
+    chunks = [chunk async for chunk in agent.stream_user_interaction("שלום", session_id="a")]
+
+    assert chunks == [_UNSURE_REPLY]
+
+@pytest.mark.asyncio
+async def test_stream_user_interaction_rules_yielded_whole(agent):
+    """Test non-generic routes are answered in one chunk without streaming."""
+    chunks = [chunk async for chunk in agent.stream_user_interaction("מה הכללים?", session_id="a")]
+
+    assert chunks == [agent.game_rules]
@@ -0,0 +1,29 @@
+# tests/conftest.py
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Set to load the real services once per test process (integration runs); unit tests mock them.
+WARM_SERVICES_ENV = "PYTEST_WARM_SERVICES"
+
+def _is_xdist_controller(config) -> bool:
+    """Whether this process only distributes tests to xdist workers and runs none itself."""
+    return bool(getattr(config.option, "numprocesses", None)) and not hasattr(config, "workerinput")
+
+def pytest_sessionstart(session):
+    """
+    With PYTEST_WARM_SERVICES set, loads BLIP and the shared Gemini service before any test runs,
+    so the process-wide caches they live in are warm. Under xdist this runs on each worker only.
+    """
+    if not os.getenv(WARM_SERVICES_ENV) or _is_xdist_controller(session.config):
+        return
+    from app.services.gemini_service import get_gemini_service
+    from app.services.image_service import ImageService
+
+    ImageService() # Caches the loaded BLIP model for every later ImageService with the same settings.
+    try:
+        asyncio.run(get_gemini_service())
+    except RuntimeError as e:
+        logger.warning(f"Gemini service not warmed up: {e}")
@@ -0,0 +1,24 @@
+# tests/helpers.py
+"""Assertion helpers and test doubles shared by the test modules."""
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+def log_has(caplog, level: int, needle: str) -> bool:
+    """Whether a captured record at the given level contains needle, without building caplog.text."""
+    return any(record.levelno == level and needle in record.getMessage() for record in caplog.records)
+
+def stub_openai_client():
+    """A plain AsyncOpenAI stand-in; only the awaited endpoints are AsyncMocks, so their calls can be asserted."""
+    return SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=AsyncMock())),
+        embeddings=SimpleNamespace(create=AsyncMock(side_effect=Exception("embeddings not mocked"))),
+        files=SimpleNamespace(create=AsyncMock(), content=AsyncMock()),
+        batches=SimpleNamespace(create=AsyncMock(), retrieve=AsyncMock()),
+    )
+
+def reset_stub_client(client):
+    """Returns a stub_openai_client to its initial state in place: no configured results and no recorded calls."""
+    for endpoint in (client.chat.completions.create, client.embeddings.create, client.files.create,
+                     client.files.content, client.batches.create, client.batches.retrieve):
+        endpoint.reset_mock(return_value=True, side_effect=True)
+    client.embeddings.create.side_effect = Exception("embeddings not mocked")
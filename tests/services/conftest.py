@@ -0,0 +1,60 @@
+# tests/services/conftest.py
+"""OpenAI test doubles shared by the service tests."""
+import pytest
+
+from app.services.llm_service import LLMService, _get_client
+from tests.helpers import stub_openai_client
+
+class _ApiKeyStub:
+    """Plain stand-in for get_openai_api_key: returns value, or raises error if one is set."""
+    def __init__(self):
+        self.value = None
+        self.error = None
+        self.call_count = 0
+
+    def __call__(self):
+        self.call_count += 1
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+@pytest.fixture
+def mock_get_openai_api_key(monkeypatch):
+    # Patch where it's looked up by the service module
+    stub = _ApiKeyStub()
+    monkeypatch.setattr("app.services.llm_service.get_openai_api_key", stub)
+    return stub
+
+class _AsyncOpenAIStub:
+    """Plain stand-in for the AsyncOpenAI constructor: records each call's kwargs and returns client."""
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.client
+
+@pytest.fixture
+def mock_openai_client(monkeypatch):
+    mock_client_instance = stub_openai_client()
+    mock_openai_constructor = _AsyncOpenAIStub(mock_client_instance)
+    monkeypatch.setattr("app.services.llm_service.AsyncOpenAI", mock_openai_constructor)
+    
+    return mock_openai_constructor, mock_client_instance
+
+@pytest.fixture(scope="session")
+def shared_llm_service():
+    """
+    One LLMService over a stubbed AsyncOpenAI client, built once per test session.
+    The patches are only applied while it is constructed, so no later test sees them.
+    Tests should take it through a function-scoped fixture that resets its per-test state
+    (see the service fixture in test_llm_service.py).
+    """
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr("app.services.llm_service.get_openai_api_key", lambda: "test_api_key")
+        monkeypatch.setattr("app.services.llm_service.AsyncOpenAI", lambda **kwargs: stub_openai_client())
+        service = LLMService()
+    # Construction cached the stub as the shared client; later tests must build their own.
+    _get_client.cache_clear()
+    return service
@@ -1,49 +1,70 @@
 # tests/services/test_gemini_service.py
 import pytest
 import asyncio 
-from unittest.mock import patch, MagicMock
+from unittest.mock import MagicMock, AsyncMock
 import logging # Added import
+from types import SimpleNamespace
 
-from app.services.gemini_service import GeminiService, DEFAULT_GEMINI_MODEL 
+from tests.helpers import log_has
+from app.services.gemini_service import GeminiService, GeminiServiceError, DEFAULT_GEMINI_MODEL, get_gemini_service
+
+# Keeps this module's tests on one xdist worker (see --dist=loadgroup in pytest.ini).
+pytestmark = pytest.mark.xdist_group("gemini_service")
+
+@pytest.fixture(autouse=True)
+def capture_service_logs(caplog):
+    """Captures the service's logs down to DEBUG for every test, so caplog.records can be asserted directly."""
+    caplog.set_level(logging.DEBUG, logger="app.services.gemini_service")
 
 @pytest.fixture
-def mock_google_credentials(mocker):
-    return mocker.patch("app.services.gemini_service.get_google_application_credentials")
+def mock_google_credentials(monkeypatch):
+    get_credentials = MagicMock()
+    monkeypatch.setattr("app.services.gemini_service.get_google_application_credentials", get_credentials)
+    return get_credentials
 
 @pytest.fixture
-def mock_genai_configure(mocker):
-    return mocker.patch("app.services.gemini_service.genai.configure")
+def mock_genai_configure(monkeypatch):
+    configure = MagicMock()
+    monkeypatch.setattr("app.services.gemini_service.genai.configure", configure)
+    return configure
 
 @pytest.fixture
-def mock_generative_model(mocker):
+def mock_generative_model(monkeypatch):
     mock_model_instance = MagicMock()
-    mock_model_instance.generate_content = MagicMock()
+    mock_model_instance.generate_content_async = AsyncMock()
     
-    mock_gm_constructor = mocker.patch("app.services.gemini_service.genai.GenerativeModel", return_value=mock_model_instance)
+    mock_gm_constructor = MagicMock(return_value=mock_model_instance)
+    monkeypatch.setattr("app.services.gemini_service.genai.GenerativeModel", mock_gm_constructor)
     return mock_gm_constructor, mock_model_instance
 
+def _mock_response(parts=(), text=None, prompt_feedbacks=()):
+    """A plain stand-in for a GenerateContentResponse, with one text part per entry of parts."""
+    return SimpleNamespace(
+        parts=[SimpleNamespace(text=part) for part in parts],
+        text=text,
+        prompt_feedbacks=list(prompt_feedbacks),
+    )
+
 # --- GeminiService Initialization Tests ---
 def test_gemini_service_initialization_success(mock_google_credentials, mock_genai_configure, mock_generative_model, caplog):
     """Test successful GeminiService initialization."""
     mock_google_credentials.return_value = "fake/path/to/creds.json" 
     
-    with caplog.at_level(logging.INFO): 
-        service = GeminiService()
+    service = GeminiService()
     
     mock_google_credentials.assert_called_once()
     mock_genai_configure.assert_not_called() 
     
     mock_generative_model[0].assert_called_once_with(DEFAULT_GEMINI_MODEL)
     assert service.client is not None
-    assert "Gemini client initialized successfully." in caplog.text
+    assert log_has(caplog, logging.INFO, "Gemini client initialized successfully.")
 
 def test_gemini_service_initialization_no_credentials(mock_google_credentials, caplog):
     """Test GeminiService init failure if get_google_application_credentials itself raises ValueError."""
     mock_google_credentials.side_effect = ValueError("Credentials not set by mock")
     with pytest.raises(RuntimeError, match="GeminiService initialization failed due to configuration: Credentials not set by mock"):
-        with caplog.at_level(logging.ERROR): # Ensure ERROR logs are captured
-            GeminiService()
-    assert "Configuration error for GeminiService: Credentials not set by mock" in caplog.text
+        GeminiService()
+    assert log_has(caplog, logging.ERROR, "Configuration error for GeminiService: Credentials not set by mock")
 
 def test_gemini_service_initialization_model_failure(mock_google_credentials, mock_genai_configure, mock_generative_model, caplog):
     """Test GeminiService init failure if GenerativeModel constructor fails."""
@@ -51,9 +72,8 @@ def test_gemini_service_initialization_model_failure(mock_google_credentials, mo
     mock_generative_model[0].side_effect = Exception("Model init failed") 
     
     with pytest.raises(RuntimeError, match="GeminiService initialization failed: Model init failed"):
-        with caplog.at_level(logging.ERROR): # Ensure ERROR logs are captured
-            GeminiService()
-    assert "Failed to initialize Gemini client: Model init failed" in caplog.text
+        GeminiService()
+    assert log_has(caplog, logging.ERROR, "Failed to initialize Gemini client: Model init failed")
 
 
 # --- GeminiService generate_text Tests ---
@@ -63,38 +83,51 @@ async def test_generate_text_success(mock_google_credentials, mock_genai_configu
     mock_google_credentials.return_value = "fake/path/to/creds.json"
     service = GeminiService()
     
-    mock_response = MagicMock()
-    mock_part = MagicMock()
-    mock_part.text = "Generated test text"
-    mock_response.parts = [mock_part]
-    mock_response.text = None 
-    mock_response.prompt_feedbacks = []
+    mock_response = _mock_response(parts=["Generated test text"])
 
-    service.client.generate_content = MagicMock(return_value=mock_response) 
+    service.client.generate_content_async = AsyncMock(return_value=mock_response) 
     
     prompt = "Test prompt"
-    with caplog.at_level(logging.INFO): # Capture INFO logs for this part
-        result = await service.generate_text(prompt)
+    result = await service.generate_text(prompt)
     
-    service.client.generate_content.assert_called_once_with(prompt)
+    service.client.generate_content_async.assert_awaited_once_with(prompt)
     assert result == "Generated test text"
-    assert f"Generating text with model {DEFAULT_GEMINI_MODEL}" in caplog.text
-    assert "Gemini generated text successfully (from parts)" in caplog.text
+    assert log_has(caplog, logging.INFO, f"Generating text with model {DEFAULT_GEMINI_MODEL}")
+    assert log_has(caplog, logging.INFO, "Gemini generated text successfully (from parts)")
 
 
+@pytest.mark.asyncio
+async def test_generate_text_parallel(mock_google_credentials, mock_genai_configure, mock_generative_model):
+    """Test concurrent generate_text calls overlap instead of running one after another."""
+    mock_google_credentials.return_value = "fake/path/to/creds.json"
+    service = GeminiService()
+    mock_response = _mock_response(parts=["Generated test text"])
+
+    async def slow_generate(contents):
+        await asyncio.sleep(0.05)
+        return mock_response
+
+    service.client.generate_content_async = AsyncMock(side_effect=slow_generate)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    results = await asyncio.gather(*(service.generate_text(f"Prompt {i}") for i in range(5)))
+    elapsed = loop.time() - start
+
+    assert results == ["Generated test text"] * 5
+    assert elapsed < 5 * 0.05
+
 @pytest.mark.asyncio
 async def test_generate_text_api_error(mock_google_credentials, mock_genai_configure, mock_generative_model, caplog):
     """Test API error during text generation."""
     mock_google_credentials.return_value = "fake/path/to/creds.json"
     service = GeminiService()
-    service.client.generate_content = MagicMock(side_effect=Exception("API error"))
+    service.client.generate_content_async = AsyncMock(side_effect=Exception("API error"))
     
     prompt = "Test prompt for API error"
-    with caplog.at_level(logging.ERROR): # Capture ERROR logs
-        result = await service.generate_text(prompt)
+    result = await service.generate_text(prompt)
     
     assert "Error: LLM call failed - API error" in result
-    assert "Error during Gemini text generation: API error" in caplog.text
+    assert log_has(caplog, logging.ERROR, "Error during Gemini text generation: API error")
 
 @pytest.mark.asyncio
 async def test_generate_text_no_content_parts(mock_google_credentials, mock_genai_configure, mock_generative_model, caplog):
@@ -102,19 +135,15 @@ async def test_generate_text_no_content_parts(mock_google_credentials, mock_gena
     mock_google_credentials.return_value = "fake/path/to/creds.json"
     service = GeminiService()
     
-    mock_response = MagicMock()
-    mock_response.parts = [] 
-    mock_response.text = None  
-    mock_response.prompt_feedbacks = [] 
+    mock_response = _mock_response()
     
-    service.client.generate_content = MagicMock(return_value=mock_response)
+    service.client.generate_content_async = AsyncMock(return_value=mock_response)
     
     prompt = "Test prompt for no content parts"
-    with caplog.at_level(logging.WARNING): # Capture WARNING logs
-        result = await service.generate_text(prompt)
+    result = await service.generate_text(prompt)
     
     assert "Error: LLM returned no usable content or request was blocked." in result
-    assert f"Gemini response for prompt '{prompt[:70]}...' had no usable text parts or was blocked." in caplog.text
+    assert log_has(caplog, logging.WARNING, f"Gemini response for prompt '{prompt[:70]}...' had no usable text parts or was blocked.")
 
 @pytest.mark.asyncio
 async def test_generate_text_no_content_text_fallback(mock_google_credentials, mock_genai_configure, mock_generative_model, caplog):
@@ -122,20 +151,16 @@ async def test_generate_text_no_content_text_fallback(mock_google_credentials, m
     mock_google_credentials.return_value = "fake/path/to/creds.json"
     service = GeminiService()
     
-    mock_response = MagicMock()
-    mock_response.parts = [] 
-    mock_response.text = "Fallback text from .text attribute" 
-    mock_response.prompt_feedbacks = []
+    mock_response = _mock_response(text="Fallback text from .text attribute")
     
-    service.client.generate_content = MagicMock(return_value=mock_response)
+    service.client.generate_content_async = AsyncMock(return_value=mock_response)
     
     prompt = "Test prompt for text fallback"
-    with caplog.at_level(logging.INFO): # Capture INFO logs
-        result = await service.generate_text(prompt)
+    result = await service.generate_text(prompt)
     
     assert result == "Fallback text from .text attribute"
-    assert f"Generating text with model {DEFAULT_GEMINI_MODEL}" in caplog.text
-    assert "Gemini generated text successfully (from .text attribute)" in caplog.text
+    assert log_has(caplog, logging.INFO, f"Generating text with model {DEFAULT_GEMINI_MODEL}")
+    assert log_has(caplog, logging.INFO, "Gemini generated text successfully (from .text attribute)")
 
 
 @pytest.mark.asyncio
@@ -144,10 +169,6 @@ async def test_generate_text_blocked_prompt(mock_google_credentials, mock_genai_
     mock_google_credentials.return_value = "fake/path/to/creds.json"
     service = GeminiService()
     
-    mock_response = MagicMock()
-    mock_response.parts = []
-    mock_response.text = None
-    
     class MockPromptFeedback:
         def __init__(self, block_reason, safety_ratings):
             self.block_reason = block_reason
@@ -155,14 +176,100 @@ async def test_generate_text_blocked_prompt(mock_google_credentials, mock_genai_
         def __str__(self): 
             return f"Block Reason: {self.block_reason}, Ratings: {self.safety_ratings}"
 
-    mock_response.prompt_feedbacks = [MockPromptFeedback("SAFETY", [{"category": "HARM_CATEGORY_SEXUAL", "probability": "HIGH"}])]
+    mock_response = _mock_response(prompt_feedbacks=[MockPromptFeedback("SAFETY", [{"category": "HARM_CATEGORY_SEXUAL", "probability": "HIGH"}])])
     
-    service.client.generate_content = MagicMock(return_value=mock_response)
+    service.client.generate_content_async = AsyncMock(return_value=mock_response)
     
     prompt = "Test prompt for blocked"
-    with caplog.at_level(logging.WARNING): # Capture WARNING logs
-        result = await service.generate_text(prompt)
+    result = await service.generate_text(prompt)
     
     assert "Error: LLM returned no usable content or request was blocked." in result
-    assert "Gemini response for prompt 'Test prompt for blocked...' had no usable text parts or was blocked." in caplog.text
-    assert "Prompt Feedback: Block Reason: SAFETY" in caplog.text
+    assert log_has(caplog, logging.WARNING, "Gemini response for prompt 'Test prompt for blocked...' had no usable text parts or was blocked.")
+    assert log_has(caplog, logging.WARNING, "Prompt Feedback: Block Reason: SAFETY")
+
+# --- GeminiService generate_text_stream Tests ---
+class _MockStreamResponse:
+    """Async-iterable stand-in for a streamed GenerateContentResponse."""
+    def __init__(self, texts):
+        self._chunks = [_mock_response(parts=[text]) for text in texts]
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for chunk in self._chunks:
+            yield chunk
+
+@pytest.mark.asyncio
+async def test_generate_text_stream_success(mock_google_credentials, mock_genai_configure, mock_generative_model):
+    """Test streamed generation yields each chunk's text in order."""
+    mock_google_credentials.return_value = "fake/path/to/creds.json"
+    service = GeminiService()
+    service.client.generate_content_async = AsyncMock(return_value=_MockStreamResponse(["Hello ", "world"]))
+
+    chunks = [chunk async for chunk in service.generate_text_stream("Test prompt")]
+
+    service.client.generate_content_async.assert_awaited_once_with("Test prompt", stream=True)
+    assert chunks == ["Hello ", "world"]
+
+@pytest.mark.asyncio
+async def test_generate_text_stream_api_error(mock_google_credentials, mock_genai_configure, mock_generative_model, caplog):
+    """Test an API error during streaming raises GeminiServiceError."""
+    mock_google_credentials.return_value = "fake/path/to/creds.json"
+    service = GeminiService()
+    service.client.generate_content_async = AsyncMock(side_effect=Exception("API error"))
+
+    with pytest.raises(GeminiServiceError, match="LLM call failed - API error"):
+        [chunk async for chunk in service.generate_text_stream("Test prompt")]
+
+    assert log_has(caplog, logging.ERROR, "Error during Gemini text streaming: API error")
+
+# --- get_gemini_service Tests ---
+@pytest.mark.asyncio
+async def test_get_gemini_service_returns_single_instance(mock_google_credentials, mock_genai_configure, mock_generative_model, monkeypatch):
+    """Test concurrent first calls share one lazily created GeminiService."""
+    mock_google_credentials.return_value = "fake/path/to/creds.json"
+    monkeypatch.setattr("app.services.gemini_service._global_service", None)
+
+    services = await asyncio.gather(*(get_gemini_service() for _ in range(3)))
+
+    assert services[0] is services[1] is services[2]
+    mock_generative_model[0].assert_called_once_with(DEFAULT_GEMINI_MODEL)
+
+# --- GeminiService generate Tests ---
+@pytest.mark.asyncio
+async def test_generate_sends_prompt_and_images_together(mock_google_credentials, mock_genai_configure, mock_generative_model):
+    """Test a prompt and images are sent together in one generate_content_async call."""
+    mock_google_credentials.return_value = "fake/path/to/creds.json"
+    service = GeminiService()
+
+    mock_response = _mock_response(parts=["Image verdict"])
+    service.client.generate_content_async = AsyncMock(return_value=mock_response)
+    image1, image2 = MagicMock(), MagicMock()
+
+    result = await service.generate(["Judge these", image1, image2])
+
+    service.client.generate_content_async.assert_awaited_once_with(["Judge these", image1, image2])
+    assert result == "Image verdict"
+
+@pytest.mark.asyncio
+async def test_warmup_logs_failure(mock_google_credentials, mock_genai_configure, mock_generative_model, caplog):
+    """Test a failed warmup request is logged rather than raised."""
+    mock_google_credentials.return_value = "fake/path/to/creds.json"
+    service = GeminiService()
+    service.client.generate_content_async = AsyncMock(side_effect=Exception("API error"))
+
+    await service.warmup()
+
+    assert log_has(caplog, logging.WARNING, "Gemini warmup request failed: LLM call failed - API error")
+
+@pytest.mark.asyncio
+async def test_generate_blocked_raises(mock_google_credentials, mock_genai_configure, mock_generative_model):
+    """Test generate raises GeminiServiceError when the response has no usable text."""
+    mock_google_credentials.return_value = "fake/path/to/creds.json"
+    service = GeminiService()
+    mock_response = _mock_response()
+    service.client.generate_content_async = AsyncMock(return_value=mock_response)
+
+    with pytest.raises(GeminiServiceError, match="no usable content"):
+        await service.generate("Test prompt")
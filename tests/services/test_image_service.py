@@ -1,155 +1,335 @@
 # tests/services/test_image_service.py
 import pytest
 from PIL import Image
-from app.services.image_service import ImageService # Adjust import if needed
+from unittest.mock import ANY, MagicMock
+from tests.helpers import log_has
+from app.services.image_service import (
+    BLIP_MODEL_NAME,
+    CAPTION_ASYNC_ERROR,
+    CAPTION_GENERATION_ERROR,
+    CAPTION_MAX_WAIT_MS,
+    CAPTION_MODEL_UNAVAILABLE,
+    CAPTION_NO_IMAGE,
+    ImageService,
+)
 import logging # Required for caplog
+import asyncio
+import threading
+import torch
+
+# Keeps this module's tests on one xdist worker, so the shared ImageService is built once (see pytest.ini).
+pytestmark = pytest.mark.xdist_group("image_service")
+
+@pytest.fixture(autouse=True)
+def capture_service_logs(caplog):
+    """Captures the service's logs down to DEBUG for every test, so caplog.records can be asserted directly."""
+    caplog.set_level(logging.DEBUG, logger="app.services.image_service")
 
 # Mock PIL Image class for testing if real images aren't desired/available
 class MockPILImage:
-    def __init__(self, mode="RGB"):
+    def __init__(self, mode="RGB", pixels=b"pixels"):
         self.mode = mode
+        self.size = (1, 1)
+        self.pixels = pixels
         self.convert_called_with = None
 
+    def tobytes(self):
+        return self.pixels
+
     def convert(self, mode):
         self.mode = mode
         self.convert_called_with = mode
         return self
 
+@pytest.fixture(autouse=True)
+def reset_shared_blip_models(monkeypatch):
+    """Each test starts without a shared BLIP model, so from_pretrained mocks are always hit."""
+    monkeypatch.setattr("app.services.image_service._BLIP_MODELS", {})
+
 @pytest.fixture
-def mock_blip_processor(mocker):
-    mock_processor_instance = mocker.MagicMock()
-    mock_processor_instance.decode = mocker.MagicMock(return_value="A mock caption")
-    # Mock the __call__ method for processor(images=...)
-    # This mock structure allows us to chain .to() call
-    mock_inputs_to_device = mocker.MagicMock() # This is what processor(...).to(device) returns
-    mock_inputs = mocker.MagicMock(return_value=mock_inputs_to_device) # This is what processor(...) returns
-    mock_processor_instance.__call__ = mock_inputs
+def mock_blip_processor(monkeypatch):
+    mock_processor_instance = MagicMock()
+    mock_processor_instance.decode = MagicMock(return_value="A mock caption")
+    # processor(images=...) returns a MagicMock, so its .to(device) call can be inspected.
     
-    mock_from_pretrained_processor = mocker.patch(
-        "app.services.image_service.BlipProcessor.from_pretrained",
-        return_value=mock_processor_instance
-    )
+    mock_from_pretrained_processor = MagicMock(return_value=mock_processor_instance)
+    monkeypatch.setattr("app.services.image_service.BlipProcessor.from_pretrained", mock_from_pretrained_processor)
     return mock_from_pretrained_processor, mock_processor_instance
 
 @pytest.fixture
-def mock_blip_model(mocker):
-    mock_model_instance = mocker.MagicMock()
+def mock_blip_model(monkeypatch):
+    mock_model_instance = MagicMock()
     # Mock the generate method
-    mock_model_instance.generate = mocker.MagicMock(return_value=["mock_output_tensor"]) # generate returns a list of tensors (or tensor like objects)
+    mock_model_instance.generate = MagicMock(return_value=["mock_output_tensor"]) # generate returns a list of tensors (or tensor like objects)
 
     # This is the object returned by BlipForConditionalGeneration.from_pretrained(...)
-    mock_pretrained_model_object = mocker.MagicMock()
-    mock_pretrained_model_object.to = mocker.MagicMock(return_value=mock_model_instance) # .to(device) returns the model itself
+    mock_pretrained_model_object = MagicMock()
+    mock_pretrained_model_object.to = MagicMock(return_value=mock_model_instance) # .to(device) returns the model itself
     mock_pretrained_model_object.generate = mock_model_instance.generate # also make generate available directly if .to is chained weirdly
 
-    mock_from_pretrained_model = mocker.patch(
-        "app.services.image_service.BlipForConditionalGeneration.from_pretrained",
-        return_value=mock_pretrained_model_object
-    )
+    mock_from_pretrained_model = MagicMock(return_value=mock_pretrained_model_object)
+    monkeypatch.setattr("app.services.image_service.BlipForConditionalGeneration.from_pretrained", mock_from_pretrained_model)
     return mock_from_pretrained_model, mock_model_instance
 
 
 @pytest.fixture
-def mock_torch_cuda_is_available(mocker):
-    return mocker.patch("app.services.image_service.torch.cuda.is_available", return_value=False) # Assume CPU for tests
+def mock_torch_cuda_is_available(monkeypatch):
+    is_available = MagicMock(return_value=False) # Assume CPU for tests
+    monkeypatch.setattr("app.services.image_service.torch.cuda.is_available", is_available)
+    return is_available
+
+@pytest.fixture(scope="module")
+def shared_image_service():
+    """
+    One ImageService over mocked BLIP weights, built once and shared by the module's happy-path tests.
+    The patches are only applied while it is constructed.
+    """
+    processor = MagicMock()
+    model_loader = MagicMock()
+    model_loader.return_value.to.return_value = MagicMock()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr("app.services.image_service.torch.cuda.is_available", lambda: False)
+        monkeypatch.setattr("app.services.image_service._BLIP_MODELS", {})
+        monkeypatch.setattr("app.services.image_service.BlipProcessor.from_pretrained", MagicMock(return_value=processor))
+        monkeypatch.setattr("app.services.image_service.BlipForConditionalGeneration.from_pretrained", model_loader)
+        return ImageService(quantize_cpu=False)
+
+@pytest.fixture
+def image_service(shared_image_service):
+    """The shared ImageService, with its mocks, caption cache and micro-batcher reset for each test."""
+    service = shared_image_service
+    service.processor.reset_mock()
+    service.processor.decode.return_value = "A mock caption"
+    service.model.reset_mock()
+    service.model.generate.return_value = ["mock_output_tensor"]
+    service.device = "cpu"
+    service._caption_cache.clear()
+    # The micro-batcher belongs to the previous test's event loop.
+    service._submit_queue = None
+    service._batcher_task = None
+    return service
 
 def test_image_service_initialization(mock_blip_processor, mock_blip_model, mock_torch_cuda_is_available, caplog):
     """Test ImageService constructor loads model and processor."""
-    with caplog.at_level(logging.INFO):
-        service = ImageService()
+    service = ImageService(quantize_cpu=False)
     
-    mock_blip_processor[0].assert_called_once_with("Salesforce/blip-image-captioning-base", cache_dir="/app/hf_cache")
-    mock_blip_model[0].assert_called_once_with("Salesforce/blip-image-captioning-base", cache_dir="/app/hf_cache")
+    mock_blip_processor[0].assert_called_once_with(BLIP_MODEL_NAME, cache_dir=ANY)
+    mock_blip_model[0].assert_called_once_with(BLIP_MODEL_NAME, cache_dir=ANY, torch_dtype=torch.float32)
     
     # Check that the model's .to(device) method was called
     mock_blip_model[0].return_value.to.assert_called_once_with("cpu")
 
-    assert service.model is not None
-    assert service.processor is not None
-    assert "BLIP model and processor loaded successfully." in caplog.text
+    assert service.model is mock_blip_model[1]
+    assert service.processor is mock_blip_processor[1]
+    assert log_has(caplog, logging.INFO, "BLIP model and processor loaded successfully")
 
-def test_generate_caption_success(mock_blip_processor, mock_blip_model, mock_torch_cuda_is_available, caplog):
+@pytest.mark.asyncio
+async def test_generate_caption_success(image_service, caplog):
     """Test successful caption generation."""
-    service = ImageService()
-    
-    # The service uses the instances from the mocked from_pretrained
-    # So service.processor is mock_blip_processor[1]
-    # And service.model is the return_value of mock_blip_model[0].return_value.to() which is mock_blip_model[1]
-
     mock_image = MockPILImage()
     
-    with caplog.at_level(logging.INFO):
-        caption = service.generate_caption(mock_image)
+    caption = await image_service.generate_caption(mock_image)
     
-    service.processor.__call__.assert_called_once()
-    # Check if it was called with the image and return_tensors="pt"
-    # service.processor.__call__.assert_called_with(images=mock_image, return_tensors="pt") # This gets tricky with MagicMock equality
-
-    # Check that the result of processor() call had .to(device) called on it
-    service.processor.__call__.return_value.to.assert_called_once_with("cpu")
+    image_service.processor.assert_called_once_with(images=[mock_image], return_tensors="pt")
+    # Check that the processor outputs were moved to the device
+    image_service.processor.return_value.to.assert_called_once_with("cpu", dtype=image_service.dtype)
     
-    service.model.generate.assert_called_once()
-    service.processor.decode.assert_called_once_with(["mock_output_tensor"], skip_special_tokens=True)
+    image_service.model.generate.assert_called_once()
+    image_service.processor.decode.assert_called_once_with("mock_output_tensor", skip_special_tokens=True)
     
     assert caption == "A mock caption"
-    assert "Caption generated successfully" in caplog.text
+    assert log_has(caplog, logging.INFO, "Caption generated successfully")
+
+@pytest.mark.asyncio
+async def test_generate_caption_is_cached(image_service):
+    """Test captioning the same image bytes twice runs the processor and model only once."""
+    first = await image_service.generate_caption(MockPILImage(pixels=b"same"))
+    second = await image_service.generate_caption(MockPILImage(pixels=b"same"))
 
-def test_generate_caption_rgb_conversion(mock_blip_processor, mock_blip_model, mock_torch_cuda_is_available, caplog):
+    assert first == second == "A mock caption"
+    image_service.processor.assert_called_once()
+    assert image_service.model.generate.call_count == 1
+
+@pytest.mark.asyncio
+async def test_generate_caption_rgb_conversion(image_service, caplog):
     """Test image is converted to RGB if not already."""
-    service = ImageService()
     mock_image = MockPILImage(mode="RGBA")
     
-    with caplog.at_level(logging.INFO):
-        caption = service.generate_caption(mock_image)
+    caption = await image_service.generate_caption(mock_image)
         
     assert caption == "A mock caption" 
     assert mock_image.convert_called_with == "RGB"
-    assert "Image is not in RGB mode, converting." in caplog.text
+    assert log_has(caplog, logging.INFO, "Image is not in RGB mode, converting")
 
-def test_generate_caption_no_image(mock_blip_processor, mock_blip_model, mock_torch_cuda_is_available, caplog):
+@pytest.mark.asyncio
+async def test_generate_caption_no_image(image_service, caplog):
     """Test behavior when no image is provided."""
-    service = ImageService()
-    with caplog.at_level(logging.ERROR): # expecting an error log
-        caption = service.generate_caption(None)
-    assert "Error: No image provided" in caption
-    assert "generate_caption called with no image provided." in caplog.text
+    caption = await image_service.generate_caption(None)
+    assert caption == CAPTION_NO_IMAGE
+    assert log_has(caplog, logging.WARNING, "Image is None, cannot generate caption.")
 
-def test_generate_caption_processor_error(mock_blip_processor, mock_blip_model, mock_torch_cuda_is_available, caplog, mocker):
+@pytest.mark.asyncio
+async def test_generate_caption_processor_error(mock_blip_processor, mock_blip_model, mock_torch_cuda_is_available, caplog):
     """Test error handling if processor fails."""
-    service = ImageService()
-    # Override the specific processor instance's __call__ method used by the service
-    service.processor.__call__ = mocker.MagicMock(side_effect=Exception("Processor failed"))
+    service = ImageService(quantize_cpu=False)
+    # Make the shared processor instance fail when called
+    service.processor.side_effect = Exception("Processor failed")
     
     mock_image = MockPILImage()
-    with caplog.at_level(logging.ERROR): # Expecting an exception log
-        caption = service.generate_caption(mock_image)
+    caption = await service.generate_caption(mock_image)
     
-    assert "Error generating caption" in caption
-    assert "Error generating caption." in caplog.text # General message from logger.exception
-    assert "Processor failed" in caplog.text # Specific exception message
+    assert caption == CAPTION_GENERATION_ERROR
+    assert log_has(caplog, logging.ERROR, "Error during blocking caption generation: Processor failed")
 
-def test_generate_caption_model_error(mock_blip_processor, mock_blip_model, mock_torch_cuda_is_available, caplog, mocker):
+@pytest.mark.asyncio
+async def test_generate_caption_model_error(mock_blip_processor, mock_blip_model, mock_torch_cuda_is_available, caplog):
     """Test error handling if model.generate fails."""
-    service = ImageService()
+    service = ImageService(quantize_cpu=False)
     # Override the specific model instance's generate method
-    service.model.generate = mocker.MagicMock(side_effect=Exception("Model generation failed"))
+    service.model.generate = MagicMock(side_effect=Exception("Model generation failed"))
 
     mock_image = MockPILImage()
-    with caplog.at_level(logging.ERROR): # Expecting an exception log
-        caption = service.generate_caption(mock_image)
+    caption = await service.generate_caption(mock_image)
     
-    assert "Error generating caption" in caption
-    assert "Error generating caption." in caplog.text # General message from logger.exception
-    assert "Model generation failed" in caplog.text # Specific exception message
-
-def test_image_service_initialization_failure(mocker, mock_torch_cuda_is_available, caplog):
-    """Test ImageService constructor handles model loading failure."""
-    mocker.patch("app.services.image_service.BlipProcessor.from_pretrained", side_effect=Exception("Failed to load processor"))
-    mocker.patch("app.services.image_service.BlipForConditionalGeneration.from_pretrained", side_effect=Exception("Should not be reached if processor fails first"))
-
-    with pytest.raises(Exception, match="Failed to load processor"):
-        with caplog.at_level(logging.ERROR):
-            ImageService()
+    assert caption == CAPTION_GENERATION_ERROR
+    assert log_has(caplog, logging.ERROR, "Error during blocking caption generation: Model generation failed")
+
+@pytest.mark.asyncio
+async def test_image_service_initialization_failure(monkeypatch, mock_torch_cuda_is_available, caplog):
+    """Test ImageService constructor logs a model loading failure and later captions report it."""
+    monkeypatch.setattr("app.services.image_service.BlipProcessor.from_pretrained",
+                        MagicMock(side_effect=Exception("Failed to load processor")))
+    mock_model_loader = MagicMock()
+    monkeypatch.setattr("app.services.image_service.BlipForConditionalGeneration.from_pretrained", mock_model_loader)
+
+    service = ImageService()
     
-    assert "Failed to load BLIP model or processor." in caplog.text
-    assert "Failed to load processor" in caplog.text
+    mock_model_loader.assert_not_called()
+    assert service.model is None
+    assert log_has(caplog, logging.ERROR, "Error loading BLIP model: Failed to load processor")
+    assert await service.generate_caption(MockPILImage()) == CAPTION_MODEL_UNAVAILABLE
+
+@pytest.mark.asyncio
+async def test_generate_captions_batch_success(image_service):
+    """Test several images are captioned with a single processor/model call."""
+    image_service.processor.batch_decode.return_value = ["Caption one", "Caption two"]
+    images = [MockPILImage(pixels=b"one"), MockPILImage(mode="RGBA", pixels=b"two")]
+
+    captions = await image_service.generate_captions_batch(images)
+
+    assert captions == ["Caption one", "Caption two"]
+    assert images[1].convert_called_with == "RGB"
+    image_service.processor.assert_called_once()
+    image_service.model.generate.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_generate_captions_batch_missing_image(image_service):
+    """Test a missing image gets an error entry while the others are still captioned."""
+    image_service.processor.batch_decode.return_value = ["Caption two"]
+
+    captions = await image_service.generate_captions_batch([None, MockPILImage()])
+
+    assert captions == ["Error: No image provided for captioning.", "Caption two"]
+
+@pytest.mark.asyncio
+async def test_generate_captions_batch_uses_caption_cache(image_service):
+    """Test a resubmitted image is served from the caption cache without running the model."""
+    image_service.processor.batch_decode.return_value = ["Caption one"]
+    await image_service.generate_captions_batch([MockPILImage(pixels=b"one")])
+    image_service.processor.batch_decode.return_value = ["Caption two"]
+
+    captions = await image_service.generate_captions_batch([MockPILImage(pixels=b"one"), MockPILImage(pixels=b"two")])
+
+    assert captions == ["Caption one", "Caption two"]
+    assert image_service.model.generate.call_count == 2
+
+def test_blip_loaded_in_fp16_on_cuda(mock_blip_processor, mock_blip_model, monkeypatch):
+    """Test the BLIP weights are loaded directly in fp16 on CUDA, with inputs cast to match."""
+    monkeypatch.setattr("app.services.image_service.torch.cuda.is_available", lambda: True)
+
+    service = ImageService(quantize_cpu=False)
+
+    mock_blip_model[0].assert_called_once_with(BLIP_MODEL_NAME, cache_dir=ANY, torch_dtype=torch.float16)
+    mock_blip_model[0].return_value.to.assert_called_once_with("cuda")
+    assert service.dtype == torch.float16
+
+def test_image_service_shares_loaded_model(mock_blip_processor, mock_blip_model, mock_torch_cuda_is_available):
+    """Test a second ImageService reuses the BLIP model loaded by the first one."""
+    first = ImageService(quantize_cpu=False)
+    second = ImageService(quantize_cpu=False)
+
+    mock_blip_model[0].assert_called_once()
+    assert second.model is first.model
+    assert second.processor is first.processor
+
+def test_prepare_image_shrinks_large_images():
+    """Test large images are thumbnailed to MAX_INPUT_IMAGE_SIZE without modifying the original."""
+    image = Image.new("RGBA", (2048, 1024))
+
+    prepared = ImageService._prepare_image(image)
+
+    assert prepared.size == (512, 256)
+    assert prepared.mode == "RGB"
+    assert image.size == (2048, 1024)
+
+@pytest.mark.asyncio
+async def test_submit_coalesces_concurrent_requests(image_service):
+    """Test concurrent submit() calls are captioned together in one batched model call."""
+    image_service.processor.batch_decode.return_value = ["Caption one", "Caption two"]
+
+    captions = await asyncio.gather(
+        image_service.submit(MockPILImage(pixels=b"one")),
+        image_service.submit(MockPILImage(pixels=b"two")),
+    )
+    await image_service.stop_caption_batcher()
+
+    assert captions == ["Caption one", "Caption two"]
+    image_service.model.generate.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_stop_caption_batcher_fails_pending_submissions(image_service, monkeypatch):
+    """Test stopping the micro-batcher fails both the batch being captioned and the queued submissions."""
+    release = threading.Event()
+    monkeypatch.setattr(image_service.model, "generate", MagicMock(side_effect=lambda **kwargs: release.wait(5)))
+    in_flight = asyncio.ensure_future(image_service.submit(MockPILImage(pixels=b"one")))
+    await asyncio.sleep(3 * CAPTION_MAX_WAIT_MS / 1000) # Lets the batcher dispatch the first image.
+    queued = asyncio.ensure_future(image_service.submit(MockPILImage(pixels=b"two")))
+    await asyncio.sleep(0)
+
+    await image_service.stop_caption_batcher()
+    release.set()
+
+    assert await in_flight == CAPTION_ASYNC_ERROR
+    assert await queued == CAPTION_ASYNC_ERROR
+
+def test_preprocess_many_runs_processor_once(image_service):
+    """Test preprocess_many sends all images through a single processor call."""
+    images = [MockPILImage(pixels=b"one"), MockPILImage(pixels=b"two")]
+
+    image_service.preprocess_many(images)
+
+    image_service.processor.assert_called_once_with(images=images, return_tensors="pt")
+
+def test_image_service_onnx_falls_back_to_pytorch(mock_blip_processor, mock_blip_model, mock_torch_cuda_is_available, monkeypatch, caplog):
+    """Test use_onnx loads the PyTorch model when optimum/onnxruntime is not installed."""
+    monkeypatch.setattr("app.services.image_service.ORTModelForVision2Seq", None)
+
+    service = ImageService(use_onnx=True, quantize_cpu=False)
+
+    mock_blip_model[0].assert_called_once()
+    assert service.model is not None
+    assert log_has(caplog, logging.WARNING, "optimum[onnxruntime] is not installed")
+
+def test_release_cuda_memory_is_sampled(image_service, monkeypatch):
+    """Test the CUDA allocator cache is only trimmed when the sampling draw hits."""
+    image_service.device = "cuda"
+    empty_cache = MagicMock()
+    monkeypatch.setattr("app.services.image_service.torch.cuda.empty_cache", empty_cache)
+
+    monkeypatch.setattr("app.services.image_service.random.random", lambda: 0.5)
+    image_service._release_cuda_memory()
+    empty_cache.assert_not_called()
+
+    monkeypatch.setattr("app.services.image_service.random.random", lambda: 0.0)
+    image_service._release_cuda_memory()
+    empty_cache.assert_called_once()
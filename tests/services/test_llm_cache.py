@@ -0,0 +1,150 @@
+# tests/services/test_llm_cache.py
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+import logging
+
+from app.services.llm_cache import ResponseCache, SemanticCache, cached_generate
+from app.services.gemini_service import GeminiServiceError
+from tests.helpers import log_has
+
+# Keeps this module's tests on one xdist worker (see --dist=loadgroup in pytest.ini).
+pytestmark = pytest.mark.xdist_group("llm_cache")
+
+TEMPLATE_ID = "SubmissionEvaluator"
+SLOTS = {"topic": "Test Topic", "caption1": "Caption 1", "caption2": "Caption 2"}
+
+@pytest.fixture(autouse=True)
+def capture_service_logs(caplog):
+    """Captures the service's logs down to DEBUG for every test, so caplog.records can be asserted directly."""
+    caplog.set_level(logging.DEBUG, logger="app.services.llm_cache")
+
+@pytest.fixture
+def cache():
+    return ResponseCache(max_entries=2, ttl_seconds=60)
+
+@pytest.fixture
+def mock_gemini_service():
+    service = AsyncMock()
+    service.generate = AsyncMock(return_value="Evaluation result")
+    return service
+
+@pytest.mark.asyncio
+async def test_cached_generate_exact_hit(cache, mock_gemini_service, caplog):
+    """Test a repeated prompt is served from the cache."""
+    first = await cached_generate(mock_gemini_service, "prompt", TEMPLATE_ID, SLOTS, cache=cache)
+    second = await cached_generate(mock_gemini_service, "prompt", TEMPLATE_ID, SLOTS, cache=cache)
+
+    assert first == second == "Evaluation result"
+    mock_gemini_service.generate.assert_awaited_once_with("prompt")
+    assert log_has(caplog, logging.INFO, f"LLM cache hit for template '{TEMPLATE_ID}'.")
+
+@pytest.mark.asyncio
+async def test_cached_generate_normalized_slots_hit(cache, mock_gemini_service):
+    """Test slot values differing only in case/whitespace reuse the cached response."""
+    await cached_generate(mock_gemini_service, "prompt A", TEMPLATE_ID, SLOTS, cache=cache)
+    noisy_slots = {"topic": "  test TOPIC ", "caption1": "caption   1", "caption2": "CAPTION 2"}
+    result = await cached_generate(mock_gemini_service, "prompt B", TEMPLATE_ID, noisy_slots, cache=cache)
+
+    assert result == "Evaluation result"
+    mock_gemini_service.generate.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_cached_generate_does_not_cache_errors(cache, mock_gemini_service):
+    """Test service failures propagate and are not cached."""
+    mock_gemini_service.generate.side_effect = GeminiServiceError("LLM call failed - boom")
+    for _ in range(2):
+        with pytest.raises(GeminiServiceError):
+            await cached_generate(mock_gemini_service, "prompt", TEMPLATE_ID, SLOTS, cache=cache)
+
+    assert mock_gemini_service.generate.await_count == 2
+    assert len(cache) == 0
+
+def test_response_cache_expiry(cache, monkeypatch):
+    """Test entries are dropped once their TTL has passed."""
+    mock_monotonic = MagicMock(return_value=100.0)
+    monkeypatch.setattr("app.services.llm_cache.time.monotonic", mock_monotonic)
+    cache.set("prompt", "response")
+    assert cache.get("prompt") == "response"
+
+    mock_monotonic.return_value = 161.0
+    assert cache.get("prompt") is None
+
+def test_response_cache_evicts_least_recently_used(cache):
+    """Test the cache stays within max_entries, evicting the oldest entry."""
+    cache.set("p1", "r1")
+    cache.set("p2", "r2")
+    cache.get("p1")
+    cache.set("p3", "r3")
+
+    assert cache.get("p2") is None
+    assert cache.get("p1") == "r1"
+    assert cache.get("p3") == "r3"
+
+def test_semantic_cache_matches_similar_embeddings():
+    """Test a similar embedding in the same scope hits, while other scopes and dissimilar embeddings miss."""
+    semantic_cache = SemanticCache(threshold=0.9)
+    semantic_cache.set("topic", [[1.0, 0.0]], "response")
+
+    assert semantic_cache.has_scope("topic")
+    assert not semantic_cache.has_scope("other topic")
+    assert semantic_cache.get("topic", [[0.99, 0.05]]) == "response"
+    assert semantic_cache.get("topic", [[0.0, 1.0]]) is None
+    assert semantic_cache.get("other topic", [[1.0, 0.0]]) is None
+
+def test_semantic_cache_matches_position_by_position():
+    """Test a multi-part entry only matches when every part is similar at the same position."""
+    semantic_cache = SemanticCache(threshold=0.9)
+    semantic_cache.set("topic", [[1.0, 0.0], [0.0, 1.0]], "Player 1 wins!")
+
+    assert semantic_cache.get("topic", [[0.99, 0.05], [0.05, 0.99]]) == "Player 1 wins!"
+    assert semantic_cache.get("topic", [[0.0, 1.0], [1.0, 0.0]]) is None
+    assert semantic_cache.get("topic", [[1.0, 0.0], [1.0, 0.0]]) is None
+    assert semantic_cache.get("topic", [[1.0, 0.0]]) is None
+
+def test_semantic_cache_evicts_oldest_entries():
+    """Test the semantic cache keeps at most max_entries entries."""
+    semantic_cache = SemanticCache(max_entries=2)
+    for i in range(3):
+        semantic_cache.set(f"topic {i}", [[1.0, 0.0]], f"response {i}")
+
+    assert len(semantic_cache) == 2
+    assert semantic_cache.get("topic 0", [[1.0, 0.0]]) is None
+
+def test_response_cache_persists_to_sqlite(tmp_path):
+    """Test entries written with a path are served by a new cache opened on the same file."""
+    path = str(tmp_path / "llm_cache.sqlite")
+    first = ResponseCache(path=path)
+    first.set("prompt", "response", template_id=TEMPLATE_ID, slots=SLOTS)
+
+    second = ResponseCache(path=path)
+
+    assert second.get("prompt") == "response"
+    assert second.get("other prompt", template_id=TEMPLATE_ID, slots=SLOTS) == "response"
+    assert second.get("unknown prompt") is None
+
+def test_response_cache_sqlite_entries_expire(tmp_path):
+    """Test expired entries in the SQLite file are not served."""
+    path = str(tmp_path / "llm_cache.sqlite")
+    ResponseCache(path=path, ttl_seconds=-1).set("prompt", "response")
+
+    assert ResponseCache(path=path).get("prompt") is None
+
+def test_response_cache_opens_sqlite_on_first_use(tmp_path):
+    """Test creating a cache with a path does not touch the file until an entry is read or written."""
+    path = tmp_path / "llm_cache.sqlite"
+    cache = ResponseCache(path=str(path))
+
+    assert not path.exists()
+    cache.set("prompt", "response")
+    assert path.exists()
+
+@pytest.mark.asyncio
+async def test_response_cache_async_access_persists_to_sqlite(tmp_path):
+    """Test aset writes through to SQLite and aget on a new cache reads it back, off the event loop."""
+    path = str(tmp_path / "llm_cache.sqlite")
+    await ResponseCache(path=path).aset("prompt", "response", template_id=TEMPLATE_ID, slots=SLOTS)
+
+    second = ResponseCache(path=path)
+
+    assert await second.aget("other prompt", template_id=TEMPLATE_ID, slots=SLOTS) == "response"
+    assert await second.aget("unknown prompt") is None
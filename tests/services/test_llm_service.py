@@ -1,103 +1,171 @@
 # tests/services/test_llm_service.py
 import pytest
-from openai import APIError 
-from app.services.llm_service import LLMService 
+from openai import APIConnectionError, APIError
+import httpx
+from tenacity import wait_none
+from app.services.llm_service import (
+    _EVAL_MAX_CAPTION_CHARS,
+    _IDENTICAL_SUBMISSIONS_VERDICT,
+    EvaluationRequest,
+    LLMService,
+    LLMError,
+    _get_client,
+)
+from app.services.llm_cache import ResponseCache, SemanticCache
+import app.services.llm_service as llm_service_module
+import json
 import logging 
+import asyncio
+import re
+from functools import lru_cache
+from types import SimpleNamespace
+from unittest.mock import ANY, AsyncMock, MagicMock
 
-@pytest.fixture
-def mock_get_openai_api_key(mocker):
-    # Patch where it's looked up by the service module
-    return mocker.patch("app.services.llm_service.get_openai_api_key")
+from tests.helpers import log_has, reset_stub_client
+
+# Keeps this module's tests on one xdist worker (see --dist=loadgroup in pytest.ini).
+pytestmark = pytest.mark.xdist_group("llm_service")
+
+# Built once at import; the API error tests only set them as side effects.
+_TOPIC_API_ERR = APIError(message="API connection error", request=None, body=None)
+_EVAL_API_ERR = APIError(message="API eval error", request=None, body=None)
+_BAD_REQUEST_ERR = APIError(message="Bad request", request=None, body=None)
+
+# Expected error and log messages shared by several tests.
+_TOPIC_API_ERROR_MESSAGE = "OpenAI API error: API connection error"
+_EVAL_API_ERROR_MESSAGE = "OpenAI API error: API eval error"
+_MISSING_INPUTS_ERROR = "Topic and both captions must be provided for evaluation."
+_MISSING_INPUTS_LOG = "Evaluation called with missing topic or captions."
+
+@pytest.fixture(autouse=True)
+def capture_service_logs(caplog):
+    """Captures the service's logs down to DEBUG for every test, so caplog.records can be asserted directly."""
+    caplog.set_level(logging.DEBUG, logger="app.services.llm_service")
+
+@pytest.fixture(autouse=True)
+def clear_client_cache():
+    """Each test gets a fresh shared client, so AsyncOpenAI mocks are always hit."""
+    _get_client.cache_clear()
+    yield
+    _get_client.cache_clear()
+
+@pytest.fixture(autouse=True)
+def clear_evaluation_cache(monkeypatch):
+    """Each test starts with an empty evaluation cache, so API mocks are always hit."""
+    monkeypatch.setattr("app.services.llm_service._evaluation_cache", ResponseCache())
+    monkeypatch.setattr("app.services.llm_service._semantic_evaluation_cache", SemanticCache())
+
+@lru_cache(maxsize=None)
+def _chat_response(content):
+    """
+    A plain stand-in for a ChatCompletion whose single choice has the given message content.
+    Built once per content and shared across tests, so tests must not mutate it.
+    """
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
 
 @pytest.fixture
-def mock_openai_client(mocker):
-    mock_client_instance = mocker.MagicMock()
-    mock_chat_completions = mocker.MagicMock()
-    mock_chat_completions.create = mocker.MagicMock()
-    mock_client_instance.chat = mocker.MagicMock()
-    mock_client_instance.chat.completions = mock_chat_completions
-    
-    mock_openai_constructor = mocker.patch("app.services.llm_service.OpenAI", return_value=mock_client_instance)
-    
-    return mock_openai_constructor, mock_client_instance
+def service(shared_llm_service, clear_evaluation_cache):
+    """The shared LLMService with its client stub reset, this test's caches and an empty topic buffer."""
+    reset_stub_client(shared_llm_service.client)
+    shared_llm_service.cache = llm_service_module._evaluation_cache
+    shared_llm_service.semantic_cache = llm_service_module._semantic_evaluation_cache
+    shared_llm_service._topics.clear()
+    # Locks bind to the event loop they first wait on, and each test has its own loop.
+    shared_llm_service._topics_lock = asyncio.Lock()
+    return shared_llm_service
 
 # --- LLMService Initialization Tests ---
-def test_llm_service_initialization_success(mock_get_openai_api_key, mock_openai_client, caplog):
-    """Test successful LLMService initialization."""
-    mock_get_openai_api_key.return_value = "test_api_key"
-    
-    with caplog.at_level(logging.INFO):
-        service = LLMService()
-    
-    mock_get_openai_api_key.assert_called_once()
-    mock_openai_client[0].assert_called_once_with(api_key="test_api_key")
-    assert service.client is not None 
-    assert "OpenAI client initialized successfully." in caplog.text
-
-def test_llm_service_initialization_no_api_key(mock_get_openai_api_key, caplog):
-    """Test LLMService initialization failure when API key is missing."""
-    mock_get_openai_api_key.side_effect = ValueError("OPENAI_API_KEY environment variable not set by mock.")
-    
-    with pytest.raises(ValueError, match="OPENAI_API_KEY environment variable not set by mock."):
-        with caplog.at_level(logging.ERROR):
-            LLMService()
-    
-    # LLMService logs the error it catches from get_openai_api_key
-    assert "ValueError during LLMService initialization: OPENAI_API_KEY environment variable not set by mock." in caplog.text
+_NO_KEY_MESSAGE = "OPENAI_API_KEY environment variable not set by mock."
+
+class TestInit:
+    """Initialization builds a fresh LLMService, so these tests use the function-scoped mocks."""
+
+    @pytest.mark.parametrize("api_key, error, log_level, log_contains", [
+        ("test_api_key", None, logging.INFO, "OpenAI client initialized successfully."),
+        (None, ValueError(_NO_KEY_MESSAGE), logging.ERROR, f"ValueError during LLMService initialization: {_NO_KEY_MESSAGE}"),
+    ], ids=["success", "no_api_key"])
+    def test_initialization(self, mock_get_openai_api_key, mock_openai_client, caplog, api_key, error, log_level,
+                            log_contains):
+        """Test LLMService builds its client from the API key, and logs and re-raises a missing key."""
+        mock_get_openai_api_key.value = api_key
+        mock_get_openai_api_key.error = error
+
+        if error is None:
+            service = LLMService()
+            assert mock_openai_client[0].calls == [{"api_key": api_key, "http_client": ANY}]
+            assert service.client is not None
+        else:
+            with pytest.raises(type(error), match=re.escape(str(error))):
+                LLMService()
+            assert mock_openai_client[0].calls == []
+
+        assert mock_get_openai_api_key.call_count == 1
+        assert log_has(caplog, log_level, log_contains)
+
+    def test_instances_share_client(self, mock_get_openai_api_key, mock_openai_client):
+        """Test LLMService instances with the same API key reuse one OpenAI client."""
+        mock_get_openai_api_key.value = "test_api_key"
+
+        first = LLMService()
+        second = LLMService()
+
+        assert len(mock_openai_client[0].calls) == 1
+        assert second.client is first.client
+
+    @pytest.mark.parametrize("http2_available", [True, False])
+    def test_shared_client_uses_http2_when_available(self, mock_get_openai_api_key, mock_openai_client, monkeypatch,
+                                                     http2_available):
+        """Test the shared client's connection pool enables HTTP/2 exactly when h2 is installed."""
+        mock_get_openai_api_key.value = "test_api_key"
+        monkeypatch.setattr("app.services.llm_service.HTTP2_AVAILABLE", http2_available)
+        async_client = MagicMock()
+        monkeypatch.setattr("app.services.llm_service.httpx.AsyncClient", async_client)
+
+        LLMService()
+
+        assert async_client.call_args.kwargs["http2"] is http2_available
+        assert mock_openai_client[0].calls == [{"api_key": "test_api_key", "http_client": async_client.return_value}]
 
 # --- generate_challenge_topic Tests ---
-def test_generate_challenge_topic_success(mock_get_openai_api_key, mock_openai_client, caplog, mocker):
+@pytest.mark.asyncio
+async def test_generate_challenge_topic_success(service, caplog):
     """Test successful challenge topic generation."""
-    mock_get_openai_api_key.return_value = "test_api_key"
-    service = LLMService()
-
-    mock_response = mocker.MagicMock()
-    mock_choice = mocker.MagicMock()
-    mock_message = mocker.MagicMock()
-    mock_message.content = "Generated test topic"
-    mock_choice.message = mock_message
-    mock_response.choices = [mock_choice]
+    service.client.chat.completions.create.return_value = _chat_response('{"challenges": ["Generated test topic", "Second test topic"]}')
     
-    service.client.chat.completions.create.return_value = mock_response
+    topic = await service.generate_challenge_topic()
     
-    with caplog.at_level(logging.INFO):
-        topic = service.generate_challenge_topic()
-    
-    service.client.chat.completions.create.assert_called_once()
+    service.client.chat.completions.create.assert_awaited_once()
+    assert service.client.chat.completions.create.call_args.kwargs["response_format"] == {"type": "json_object"}
     assert topic == "Generated test topic"
-    assert f"Successfully generated challenge topic: {topic}" in caplog.text
+    assert log_has(caplog, logging.INFO, f"Successfully generated challenge topic: {topic}")
 
-def test_generate_challenge_topic_api_error(mock_get_openai_api_key, mock_openai_client, caplog):
-    """Test API error during topic generation."""
-    mock_get_openai_api_key.return_value = "test_api_key"
-    service = LLMService()
-    service.client.chat.completions.create.side_effect = APIError(message="API connection error", request=None, body=None)
-    
-    with caplog.at_level(logging.ERROR):
-        topic = service.generate_challenge_topic()
-    
-    assert "OpenAI API error: API connection error" in topic
-    # The logged message includes the error string from the APIError
-    assert "OpenAI API error while generating topic: API connection error" in caplog.text
+@pytest.mark.asyncio
+async def test_generate_challenge_topic_uses_buffered_batch(service):
+    """Test topics from one batch call are handed out on later calls without another API request."""
+    service.client.chat.completions.create.return_value = _chat_response('{"challenges": ["Topic one", "Topic two"]}')
 
+    topics = [await service.generate_challenge_topic() for _ in range(3)]
 
-def test_generate_challenge_topic_no_content(mock_get_openai_api_key, mock_openai_client, caplog, mocker):
-    """Test LLM returning no content for topic."""
-    mock_get_openai_api_key.return_value = "test_api_key"
-    service = LLMService()
+    assert topics == ["Topic one", "Topic two", "Topic one"]
+    assert service.client.chat.completions.create.await_count == 2
 
-    mock_response = mocker.MagicMock()
-    mock_choice = mocker.MagicMock()
-    mock_message = mocker.MagicMock()
-    mock_message.content = None 
-    mock_choice.message = mock_message
-    mock_response.choices = [mock_choice]
-    service.client.chat.completions.create.return_value = mock_response
+@pytest.mark.asyncio
+async def test_generate_challenge_topic_plain_text_reply(service):
+    """Test a reply that is not the requested JSON is used as a single topic."""
+    service.client.chat.completions.create.return_value = _chat_response("Plain topic")
 
-    with caplog.at_level(logging.WARNING):
-        topic = service.generate_challenge_topic()
-    assert "Error: LLM did not return a topic" in topic
-    assert "LLM did not return a topic." in caplog.text
+    assert await service.generate_challenge_topic() == "Plain topic"
+
+@pytest.mark.asyncio
+async def test_generate_challenge_topic_api_error(service, caplog):
+    """Test API error during topic generation raises LLMError."""
+    service.client.chat.completions.create.side_effect = _TOPIC_API_ERR
+    
+    with pytest.raises(LLMError, match=re.escape(_TOPIC_API_ERROR_MESSAGE)):
+        await service.generate_challenge_topic()
+    
+    # The logged message includes the error string from the APIError
+    assert log_has(caplog, logging.ERROR, "OpenAI API error while generating topic: API connection error")
 
 
 # --- evaluate_submissions Tests ---
@@ -105,69 +173,325 @@ EVAL_TOPIC = "Test Topic"
 EVAL_CAPTION1 = "Caption for image 1"
 EVAL_CAPTION2 = "Caption for image 2"
 
-def test_evaluate_submissions_success(mock_get_openai_api_key, mock_openai_client, caplog, mocker):
+@pytest.mark.asyncio
+async def test_evaluate_submissions_success(service, caplog):
     """Test successful submission evaluation."""
-    mock_get_openai_api_key.return_value = "test_api_key"
-    service = LLMService()
     
-    mock_response = mocker.MagicMock()
-    mock_choice = mocker.MagicMock()
-    mock_message = mocker.MagicMock()
-    mock_message.content = "Player 1 wins!"
-    mock_choice.message = mock_message
-    mock_response.choices = [mock_choice]
-    service.client.chat.completions.create.return_value = mock_response
+    service.client.chat.completions.create.return_value = _chat_response("Player 1 wins!")
     
-    with caplog.at_level(logging.INFO):
-        result = service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
+    result = await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
     
-    service.client.chat.completions.create.assert_called_once()
+    service.client.chat.completions.create.assert_awaited_once()
     assert result == "Player 1 wins!"
-    assert "Submissions evaluated successfully by LLM." in caplog.text
+    assert log_has(caplog, logging.INFO, "Submissions evaluated successfully by LLM.")
 
-def test_evaluate_submissions_missing_inputs(mock_get_openai_api_key, caplog):
-    """Test evaluation with missing inputs."""
-    mock_get_openai_api_key.return_value = "test_api_key"
-    service = LLMService() 
-    
-    with caplog.at_level(logging.WARNING):
-        result = service.evaluate_submissions("", EVAL_CAPTION1, EVAL_CAPTION2)
-    assert "Error: Topic and both captions must be provided for evaluation." in result
-    assert "Evaluation called with missing topic or captions." in caplog.text
-    caplog.clear() 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("topic, caption1, caption2", [
+    ("", EVAL_CAPTION1, EVAL_CAPTION2),
+    (EVAL_TOPIC, "", EVAL_CAPTION2),
+    (EVAL_TOPIC, EVAL_CAPTION1, ""),
+])
+async def test_evaluate_submissions_missing_inputs(service, caplog, topic, caption1, caption2):
+    """Test evaluation with a missing topic or caption raises before any API call."""
+    with pytest.raises(ValueError, match=re.escape(_MISSING_INPUTS_ERROR)):
+        await service.evaluate_submissions(topic, caption1, caption2)
+    assert log_has(caplog, logging.WARNING, _MISSING_INPUTS_LOG)
+    service.client.chat.completions.create.assert_not_called()
 
-    with caplog.at_level(logging.WARNING):
-        result = service.evaluate_submissions(EVAL_TOPIC, "", EVAL_CAPTION2)
-    assert "Error: Topic and both captions must be provided for evaluation." in result
-    assert "Evaluation called with missing topic or captions." in caplog.text
 
+@pytest.mark.asyncio
+async def test_evaluate_identical_captions_short_circuits(service):
+    """Test identical captions (up to case/whitespace) are declared a draw without an OpenAI call."""
 
-def test_evaluate_submissions_api_error(mock_get_openai_api_key, mock_openai_client, caplog):
-    """Test API error during evaluation."""
-    mock_get_openai_api_key.return_value = "test_api_key"
-    service = LLMService()
-    service.client.chat.completions.create.side_effect = APIError(message="API eval error", request=None, body=None)
+    result = await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, f"  {EVAL_CAPTION1.upper()} ")
+
+    assert result == _IDENTICAL_SUBMISSIONS_VERDICT
+    assert service.client.chat.completions.create.call_count == 0
+
+@pytest.mark.asyncio
+async def test_evaluate_captions_identical_after_truncation_short_circuit(service):
+    """Test captions that differ only past _EVAL_MAX_CAPTION_CHARS, and so reach the prompt equal, are a draw."""
+    prefix = "x" * _EVAL_MAX_CAPTION_CHARS
+
+    result = await service.evaluate_submissions(EVAL_TOPIC, prefix + " a red ball", prefix + " a blue cube")
+
+    assert result == _IDENTICAL_SUBMISSIONS_VERDICT
+    assert service.client.chat.completions.create.call_count == 0
+
+@pytest.mark.asyncio
+async def test_evaluate_truncates_long_caption(service):
+    """Test an overlong caption is cut to _EVAL_MAX_CAPTION_CHARS before it is sent."""
+    service.client.chat.completions.create.return_value = _chat_response("Player 1 wins!")
+
+    await service.evaluate_submissions(EVAL_TOPIC, "x" * (_EVAL_MAX_CAPTION_CHARS + 100), EVAL_CAPTION2)
+
+    user_message = service.client.chat.completions.create.call_args.kwargs["messages"][1]["content"]
+    assert "x" * _EVAL_MAX_CAPTION_CHARS in user_message
+    assert "x" * (_EVAL_MAX_CAPTION_CHARS + 1) not in user_message
+
+@pytest.mark.asyncio
+async def test_evaluate_submissions_api_error(service, caplog):
+    """Test API error during evaluation raises LLMError."""
+    service.client.chat.completions.create.side_effect = _EVAL_API_ERR
     
-    with caplog.at_level(logging.ERROR):
-        result = service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
+    with pytest.raises(LLMError, match=re.escape(_EVAL_API_ERROR_MESSAGE)):
+        await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
     
-    assert "OpenAI API error: API eval error" in result
-    assert "OpenAI API error during evaluation: API eval error" in caplog.text
+    assert log_has(caplog, logging.ERROR, "OpenAI API error during evaluation: API eval error")
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("method, args, expected", [
+    ("generate_challenge_topic", (), "LLM did not return a topic."),
+    ("evaluate_submissions", (EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2), "LLM did not return an evaluation."),
+])
+async def test_no_content_raises(service, caplog, method, args, expected):
+    """Test an LLM reply without content raises LLMError for topics and evaluations alike."""
+    service.client.chat.completions.create.return_value = _chat_response(None)
+
+    with pytest.raises(LLMError, match=re.escape(expected)):
+        await getattr(service, method)(*args)
+    assert log_has(caplog, logging.WARNING, expected)
+
+@pytest.mark.asyncio
+async def test_evaluate_submissions_cached(service):
+    """Test a repeated evaluation (up to case/whitespace) is served from the cache."""
+    service.client.chat.completions.create.return_value = _chat_response("Player 1 wins!")
+
+    first = await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
+    second = await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1.upper(), EVAL_CAPTION2)
 
-def test_evaluate_submissions_no_content(mock_get_openai_api_key, mock_openai_client, caplog, mocker):
-    """Test LLM returning no content for evaluation."""
-    mock_get_openai_api_key.return_value = "test_api_key"
+    assert first == second == "Player 1 wins!"
+    service.client.chat.completions.create.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_evaluate_submissions_error_not_cached(service):
+    """Test a failed evaluation is not cached."""
+    service.client.chat.completions.create.side_effect = _EVAL_API_ERR
+
+    for _ in range(2):
+        with pytest.raises(LLMError):
+            await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
+
+    assert service.client.chat.completions.create.await_count == 2
+
+@pytest.mark.asyncio
+async def test_evaluate_submissions_batch(service):
+    """Test a batch of submissions is evaluated concurrently, with a failed item returned as its exception."""
+    service.client.chat.completions.create.return_value = _chat_response("Player 1 wins!")
+
+    results = await service.evaluate_submissions_batch([
+        (EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2),
+        (EVAL_TOPIC, "", EVAL_CAPTION2),
+        ("Another Topic", EVAL_CAPTION1, EVAL_CAPTION2),
+    ])
+
+    assert results[0] == "Player 1 wins!"
+    assert isinstance(results[1], ValueError)
+    assert results[2] == "Player 1 wins!"
+    assert service.client.chat.completions.create.await_count == 2
+
+def _embeddings_by_text(vectors):
+    """An embeddings.create side effect returning, for each input text, its vector from the given dict."""
+    async def create(model, input):
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=vectors[text]) for i, text in enumerate(input)])
+    return create
+
+@pytest.mark.asyncio
+async def test_evaluate_submissions_semantic_cache_hit(service):
+    """Test paraphrased captions for the same topic reuse the earlier evaluation."""
+    service.client.chat.completions.create.return_value = _chat_response("Player 1 wins!")
+    service.client.embeddings.create.side_effect = _embeddings_by_text({
+        EVAL_CAPTION1: [1.0, 0.0], EVAL_CAPTION2: [0.0, 1.0], "A paraphrased caption": [0.99, 0.05],
+    })
+
+    await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
+    result = await service.evaluate_submissions(EVAL_TOPIC, "A paraphrased caption", EVAL_CAPTION2)
+
+    assert result == "Player 1 wins!"
+    service.client.chat.completions.create.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_evaluate_submissions_semantic_cache_ignores_swapped_captions(service):
+    """Test swapped submissions are evaluated afresh, since the cached verdict would name the wrong winner."""
+    service.client.chat.completions.create.side_effect = [_chat_response("Player 1 wins!"), _chat_response("Player 2 wins!")]
+    service.client.embeddings.create.side_effect = _embeddings_by_text({EVAL_CAPTION1: [1.0, 0.0], EVAL_CAPTION2: [0.0, 1.0]})
+
+    await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
+    result = await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION2, EVAL_CAPTION1)
+
+    assert result == "Player 2 wins!"
+    assert service.client.chat.completions.create.await_count == 2
+
+@pytest.mark.asyncio
+async def test_evaluate_captions_many_players(service):
+    """Test more than two captions are scored in a single request that lists every image."""
+    service.client.chat.completions.create.return_value = _chat_response("Player 3 wins!")
+
+    result = await service.evaluate_captions(EVAL_TOPIC, [EVAL_CAPTION1, EVAL_CAPTION2, "Caption for image 3"])
+
+    assert result == "Player 3 wins!"
+    service.client.chat.completions.create.assert_awaited_once()
+    prompt = service.client.chat.completions.create.call_args.kwargs["messages"][-1]["content"]
+    assert "תמונה 3: Caption for image 3" in prompt
+
+@pytest.mark.asyncio
+async def test_evaluate_submissions_static_prefix(service):
+    """Test evaluations for different topics share the same system message and prompt cache key, with the variable data only in the user message."""
+    service.client.chat.completions.create.return_value = _chat_response("Player 1 wins!")
+
+    await service.evaluate_submissions("Topic A", EVAL_CAPTION1, EVAL_CAPTION2)
+    await service.evaluate_submissions("Topic B", EVAL_CAPTION1, EVAL_CAPTION2)
+
+    first_call, second_call = service.client.chat.completions.create.call_args_list
+    first, second = first_call.kwargs["messages"], second_call.kwargs["messages"]
+    assert first[0] == second[0]
+    assert first_call.kwargs["prompt_cache_key"] == second_call.kwargs["prompt_cache_key"]
+    assert "Topic A" not in first[0]["content"]
+    assert first[1]["content"].startswith("אתגר: Topic A")
+
+@pytest.mark.asyncio
+async def test_requests_respect_concurrency_limit(mock_get_openai_api_key, mock_openai_client, monkeypatch):
+    """Test concurrent evaluations never have more OpenAI requests in flight than the semaphore allows."""
+    mock_get_openai_api_key.value = "test_api_key"
+    monkeypatch.setattr("app.services.llm_service._request_semaphore", asyncio.Semaphore(1))
     service = LLMService()
+    in_flight = 0
+    max_in_flight = 0
+
+    async def fake_create(**kwargs):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        response = _chat_response("Player 1 wins!")
+        return response
+
+    service.client.chat.completions.create = AsyncMock(side_effect=fake_create)
+
+    await asyncio.gather(*(service.evaluate_submissions(f"Topic {i}", EVAL_CAPTION1, EVAL_CAPTION2) for i in range(3)))
+
+    assert max_in_flight == 1
+
+@pytest.mark.asyncio
+async def test_llm_service_respects_own_max_concurrency(mock_get_openai_api_key, mock_openai_client):
+    """Test an explicit max_concurrency gives the instance its own cap on in-flight requests."""
+    mock_get_openai_api_key.value = "test_api_key"
+    service = LLMService(max_concurrency=2)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def fake_create(**kwargs):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return _chat_response("Player 1 wins!")
+
+    service.client.chat.completions.create = AsyncMock(side_effect=fake_create)
+
+    await service.evaluate_submissions_batch([(f"Topic {i}", EVAL_CAPTION1, EVAL_CAPTION2) for i in range(5)])
+
+    assert max_in_flight == 2
+
+class _MockChatStream:
+    """Async iterator over streamed chat completion chunks with the given text deltas."""
+    def __init__(self, texts):
+        self._chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))]) for text in texts]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self._chunks:
+            yield chunk
+
+@pytest.mark.asyncio
+async def test_stream_evaluation_yields_chunks_and_caches(service):
+    """Test the evaluation is streamed chunk by chunk and the full text is cached for the next request."""
+    service.client.chat.completions.create.return_value = _MockChatStream(["Player 1 ", None, "wins!"])
+
+    chunks = [chunk async for chunk in service.stream_evaluation(EVAL_TOPIC, [EVAL_CAPTION1, EVAL_CAPTION2])]
+    cached = [chunk async for chunk in service.stream_evaluation(EVAL_TOPIC, [EVAL_CAPTION1, EVAL_CAPTION2])]
+
+    assert chunks == ["Player 1 ", "wins!"]
+    assert cached == ["Player 1 wins!"]
+    service.client.chat.completions.create.assert_awaited_once()
+    assert service.client.chat.completions.create.call_args.kwargs["stream"] is True
+
+@pytest.mark.asyncio
+async def test_stream_evaluation_api_error(service):
+    """Test an API error while streaming an evaluation raises LLMError."""
+    service.client.chat.completions.create.side_effect = _EVAL_API_ERR
+
+    with pytest.raises(LLMError, match=re.escape(_EVAL_API_ERROR_MESSAGE)):
+        [chunk async for chunk in service.stream_evaluation(EVAL_TOPIC, [EVAL_CAPTION1, EVAL_CAPTION2])]
+
+@pytest.mark.asyncio
+async def test_requests_cap_output_tokens(service):
+    """Test topic and evaluation requests set max_tokens and their sampling temperature."""
+    service.client.chat.completions.create.return_value = _chat_response('{"challenges": ["Topic one"]}')
+
+    await service.generate_challenge_topics(2)
+    await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
+
+    topic_call, eval_call = service.client.chat.completions.create.call_args_list
+    assert topic_call.kwargs["max_tokens"] == 160
+    assert topic_call.kwargs["temperature"] == 0.9
+    assert eval_call.kwargs["max_tokens"] == 200
+    assert eval_call.kwargs["temperature"] == 0.3
+
+@pytest.mark.asyncio
+async def test_transient_errors_are_retried(mock_get_openai_api_key, mock_openai_client, monkeypatch):
+    """Test a dropped connection is retried, while a plain API error is raised without retrying."""
+    mock_get_openai_api_key.value = "test_api_key"
+    monkeypatch.setattr(LLMService._create_chat.retry, "wait", wait_none())
+    service = LLMService()
+    mock_response = _chat_response("Player 1 wins!")
+    connection_error = APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+    service.client.chat.completions.create.side_effect = [connection_error, mock_response]
+
+    result = await service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
+
+    assert result == "Player 1 wins!"
+    assert service.client.chat.completions.create.await_count == 2
+
+    service.client.chat.completions.create.reset_mock(side_effect=True)
+    service.client.chat.completions.create.side_effect = _BAD_REQUEST_ERR
+    with pytest.raises(LLMError):
+        await service.evaluate_submissions("Other topic", EVAL_CAPTION1, EVAL_CAPTION2)
+    service.client.chat.completions.create.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_submit_batch_evaluations(service):
+    """Test evaluations are uploaded as one JSONL file and submitted as a single batch job."""
+    service.client.files.create.return_value = SimpleNamespace(id="file-1")
+    service.client.batches.create.return_value = SimpleNamespace(id="batch-1")
+
+    batch_id = await service.submit_batch_evaluations([
+        EvaluationRequest("a", EVAL_TOPIC, [EVAL_CAPTION1, EVAL_CAPTION2]),
+        EvaluationRequest("b", EVAL_TOPIC, [EVAL_CAPTION2, EVAL_CAPTION1]),
+    ])
+
+    assert batch_id == "batch-1"
+    _, content = service.client.files.create.call_args.kwargs["file"]
+    lines = [json.loads(line) for line in content.decode("utf-8").splitlines()]
+    assert [line["custom_id"] for line in lines] == ["a", "b"]
+    assert lines[0]["url"] == "/v1/chat/completions"
+    service.client.batches.create.assert_awaited_once_with(
+        input_file_id="file-1", endpoint="/v1/chat/completions", completion_window="24h"
+    )
+
+@pytest.mark.asyncio
+async def test_fetch_batch_results(service):
+    """Test an unfinished job returns None and a completed one maps custom_ids to evaluation text."""
+    running = SimpleNamespace(status="in_progress")
+    completed = SimpleNamespace(status="completed", output_file_id="file-out")
+    service.client.batches.retrieve.side_effect = [running, completed]
+    output_line = {"custom_id": "a", "response": {"body": {"choices": [{"message": {"content": "Player 1 wins!"}}]}}}
+    failed_line = {"custom_id": "b", "response": None, "error": {"message": "failed"}}
+    service.client.files.content.return_value = SimpleNamespace(text=json.dumps(output_line) + "\n" + json.dumps(failed_line))
 
-    mock_response = mocker.MagicMock()
-    mock_choice = mocker.MagicMock()
-    mock_message = mocker.MagicMock()
-    mock_message.content = None 
-    mock_choice.message = mock_message
-    mock_response.choices = [mock_choice]
-    service.client.chat.completions.create.return_value = mock_response
-
-    with caplog.at_level(logging.WARNING):
-        result = service.evaluate_submissions(EVAL_TOPIC, EVAL_CAPTION1, EVAL_CAPTION2)
-    assert "Error: LLM did not return an evaluation" in result
-    assert "LLM did not return an evaluation." in caplog.text
+    assert await service.fetch_batch_results("batch-1") is None
+    assert await service.fetch_batch_results("batch-1") == {"a": "Player 1 wins!"}
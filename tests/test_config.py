@@ -0,0 +1,46 @@
+# tests/test_config.py
+import pytest
+from app.config import (
+    DEFAULT_LLM_MAX_CONCURRENCY,
+    get_llm_max_concurrency,
+    get_openai_api_key,
+    invalidate_config_cache,
+)
+
+# Keeps this module's tests on one xdist worker (see --dist=loadgroup in pytest.ini).
+pytestmark = pytest.mark.xdist_group("config")
+
+@pytest.fixture(autouse=True)
+def clear_config_cache():
+    """Each test reads the environment afresh."""
+    invalidate_config_cache()
+    yield
+    invalidate_config_cache()
+
+def test_get_openai_api_key_is_cached(monkeypatch):
+    """Test the API key is read from the environment once and reused until the cache is invalidated."""
+    monkeypatch.setenv("OPENAI_API_KEY", "first_key")
+    assert get_openai_api_key() == "first_key"
+
+    monkeypatch.setenv("OPENAI_API_KEY", "second_key")
+    assert get_openai_api_key() == "first_key"
+
+    invalidate_config_cache()
+    assert get_openai_api_key() == "second_key"
+
+def test_get_openai_api_key_missing(monkeypatch):
+    """Test a missing API key raises ValueError."""
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    with pytest.raises(ValueError, match="OPENAI_API_KEY environment variable not set"):
+        get_openai_api_key()
+
+@pytest.mark.parametrize("value, expected", [
+    ("", DEFAULT_LLM_MAX_CONCURRENCY),
+    ("5", 5),
+    ("0", DEFAULT_LLM_MAX_CONCURRENCY),
+    ("many", DEFAULT_LLM_MAX_CONCURRENCY),
+])
+def test_get_llm_max_concurrency(monkeypatch, value, expected):
+    """Test LLM_MAX_CONCURRENCY is parsed, falling back to the default when unset or invalid."""
+    monkeypatch.setenv("LLM_MAX_CONCURRENCY", value)
+    assert get_llm_max_concurrency() == expected
@@ -0,0 +1,47 @@
+# tests/ui/test_gradio_interface.py
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+from app.agents.user_interaction_agent import UserInteractionAgent
+from app.config import EVALUATION_MODE_CAPTIONS, EVALUATION_MODE_MULTIMODAL
+from app.ui.gradio_interface import GradioInterface
+
+# Keeps this module's tests on one xdist worker (see --dist=loadgroup in pytest.ini).
+pytestmark = pytest.mark.xdist_group("gradio_interface")
+
+@pytest.fixture
+def agent():
+    """An agent over a stub Gemini service whose challenge tool returns 'Topic 0' and whose evaluators are mocked."""
+    agent = UserInteractionAgent(gemini_service=SimpleNamespace(generate=AsyncMock(return_value="Generic reply")))
+    agent.challenge_tool._execute = AsyncMock(return_value="Topic 0")
+    agent.evaluation_tool._execute_raw = AsyncMock(return_value="Player 1 wins!")
+    agent.evaluation_tool._execute_images = AsyncMock(return_value="Player 1 wins!")
+    return agent
+
+@pytest.mark.asyncio
+async def test_generate_topic_keeps_raw_topic_in_state(agent):
+    """Test the displayed reply carries the agent's prefix while the topic state holds the raw challenge."""
+    interface = GradioInterface(agent, image_service=None)
+
+    display, topic_state = await interface._handle_generate_topic()
+
+    assert "Topic 0" in display and display != "Topic 0"
+    assert topic_state == "Topic 0"
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("evaluation_mode", [EVALUATION_MODE_CAPTIONS, EVALUATION_MODE_MULTIMODAL])
+async def test_check_images_evaluates_unprefixed_topic(agent, evaluation_mode):
+    """Test the evaluator receives the raw topic from the state, not the displayed reply."""
+    image_service = SimpleNamespace(generate_caption=AsyncMock(side_effect=["c1", "c2"]))
+    interface = GradioInterface(agent, image_service=image_service, batch_captions=False, evaluation_mode=evaluation_mode)
+    image1, image2 = object(), object()
+    _, topic_state = await interface._handle_generate_topic()
+
+    await interface._handle_check_images(image1, image2, topic_state)
+
+    if evaluation_mode == EVALUATION_MODE_MULTIMODAL:
+        agent.evaluation_tool._execute_images.assert_awaited_once_with("Topic 0", image1, image2)
+    else:
+        agent.evaluation_tool._execute_raw.assert_awaited_once_with("Topic 0", "c1", "c2")